@@ -0,0 +1,242 @@
+""" Runs the stages of the data pipeline headless.
+
+Every stage reads its paths from global_consts, which can be configured with
+a TOML file (--config or $FONTGEN_CONFIG), environment variables
+(FONTGEN_PATH_RAW=...) or --set PATH_RAW=/data/raw/.
+
+The stages working on fonts take --workers (worker processes, fonts are then
+processed in isolation, see src/data/isolation.py) and --shard i/N to process
+only the fonts of one shard (see fontdb_handler.select_shard), so a stage can
+run as several batch jobs. Shards write their results to shard outputs, which
+the reduce step merges (see src/data/shards.py). collect takes neither: it
+walks the raw directory once (unzipping archives in place) and writes the
+font database in one piece. benchmark sweeps its own worker counts on a
+synthetic corpus.
+
+Usage:
+    python -m src download [--dbs GoogleFontsDB] [--git-jobs 4] [--url-lists] [--workers 10] [--shard 0/4]
+    python -m src collect [--variable-instances named]
+    python -m src filter [--workers 8] [--shard 0/4]
+    python -m src classify [--chars ß] [--workers 8] [--shard 0/4]
+    python -m src render-export [--size 64] [--split train] [--format bits] [--workers 8] [--shard 0/4]
+    python -m src benchmark [--quick]
+    python -m src reduce <stage> --num-shards 4
+    python -m src run-sharded <stage> --num-shards 4 [--parallel 2] [-- <stage args>]
+"""
+
+import argparse
+import json
+import os
+import sys
+from .data import global_consts as g
+from .data import fontdb_handler, metrics, quarantine, shards
+
+REQUIRED_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789ÄäÖöÜüß"
+
+
+def _font_paths(args, split=None):
+    paths = fontdb_handler.font_file_list() if split is None else list(fontdb_handler.iter_split(split))
+    return fontdb_handler.select_shard(paths, args.shard)
+
+
+def _render_output(args):
+    return args.output or os.path.join(g.PATH_PROCESSED, f"glyphs_{args.split or 'all'}_{args.size}")
+
+
+def run_download(args):
+    from .data import blobstore, downloader
+    if args.dbs:
+        downloader.get_font_dbs({db_name: True for db_name in fontdb_handler.select_shard(args.dbs, args.shard)},
+                                max_concurrent=args.git_jobs,
+                                depth=None if args.full_history else 1)
+    if args.update_glyphazzn:
+        downloader.update_glyphazzn_list()
+    if args.url_lists:
+        store = blobstore.BlobStore()
+        downloader.download_files_from_txts(workers=args.workers, shard=args.shard, store=store)
+        store.save(shards.output_path('download', args.shard) if args.shard else None)
+
+
+def run_collect(args):
+    from .data import datacollector
+    datacollector.collectfonts(variable_instances=None if args.variable_instances == 'none'
+                               else args.variable_instances,
+                               grid_steps=args.grid_steps)
+
+
+def run_filter(args):
+    from .data import datafilter
+    if args.shard:
+        os.makedirs(g.PATH_SHARDS, exist_ok=True)
+    datafilter.filter_fonts(required_chars=args.chars,
+                            isolated=args.isolated or args.workers > 1,
+                            timeout=args.timeout,
+                            memory_limit_mb=args.memory_limit_mb,
+                            workers=args.workers,
+                            font_file_paths=_font_paths(args),
+                            results_path=shards.output_path('filter', args.shard) if args.shard else None)
+
+
+def run_classify(args):
+    # Importing the classifier loads CLIP
+    from .data import classifier, renderplan
+    font_file_paths = _font_paths(args)
+    # All chars are rendered in one pass per font
+    plan = renderplan.RenderPlan()
+    requests = {char: plan.add(char) for char in args.chars}
+    glyphs, rendered = plan.render(font_file_paths, isolated=args.isolated or args.workers > 1,
+                                   timeout=args.timeout, memory_limit_mb=args.memory_limit_mb,
+                                   workers=args.workers, compact=True)
+    merged = {}
+    for char in args.chars:
+        results = classifier.evaluate_image(font_file_paths, char, glyphs=(glyphs[requests[char]], rendered))
+        for font_path, chars in results.items():
+            merged.setdefault(font_path, {}).update(chars)
+        print(f"{char}: {sum(result[char] for result in results.values())} of {len(results)} fonts usable")
+    if args.shard:
+        os.makedirs(g.PATH_SHARDS, exist_ok=True)
+        with open(shards.output_path('classify', args.shard), 'w', encoding='utf-8') as file:
+            json.dump(merged, file, indent=1, ensure_ascii=False)
+    else:
+        fontdb_handler.update_clip_filter(merged)
+
+
+def run_render_export(args):
+    from .data import datarenderer
+    output = _render_output(args)
+    if args.shard:
+        output = shards.output_path(os.path.basename(output), args.shard, extension='')
+    num_rendered = datarenderer.export_dataset(_font_paths(args, args.split), output, size=args.size,
+                                               chars=args.chars,
+                                               isolated=args.isolated or args.workers > 1,
+                                               workers=args.workers,
+                                               glyph_format=args.format)
+    print(f"Rendered {num_rendered} fonts to {output}.npy")
+
+
+def run_benchmark(args):
+    import shutil
+    import tempfile
+    from .benchmark import pipeline_bench
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='font_benchmark_')
+    try:
+        pipeline_bench.save_results(pipeline_bench.run_benchmarks(work_dir, quick=args.quick), args.out)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    print(f"Results written to {args.out}")
+
+
+def run_reduce(args):
+    output = _render_output(args) if args.stage == 'render-export' else None
+    shards.reduce(args.stage, args.num_shards, output=output, cleanup=not args.keep_shards)
+
+
+def run_sharded(args):
+    global_args = (['--config', args.config] if args.config else []) + \
+        [argument for assignment in args.set for argument in ('--set', assignment)]
+    stage_args = args.stage_args
+    # Parsed like the shards do, for the output name of render-export
+    stage = build_parser().parse_args([args.stage, *stage_args])
+    shards.run_local(args.stage, args.num_shards, stage_args, global_args, parallel=args.parallel)
+    output = _render_output(stage) if args.stage == 'render-export' else None
+    shards.reduce(args.stage, args.num_shards, output=output, cleanup=not args.keep_shards)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--config', default=None, help='TOML file with constants of global_consts')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='Override a constant of global_consts, e.g. PATH_RAW=/data/raw/')
+    parser.add_argument('--metrics', default=None, help='JSON-lines file for timings and counters')
+
+    stage = argparse.ArgumentParser(add_help=False)
+    stage.add_argument('--workers', type=int, default=1)
+    stage.add_argument('--shard', type=fontdb_handler.parse_shard, default=None, metavar='i/N',
+                       help='Only process the fonts of shard i of N')
+    isolation = argparse.ArgumentParser(add_help=False)
+    isolation.add_argument('--isolated', action='store_true',
+                           help='Process every font in a worker process, implied by --workers > 1')
+    isolation.add_argument('--timeout', type=float, default=60.)
+    isolation.add_argument('--memory-limit-mb', type=int, default=4096)
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_download = subparsers.add_parser('download', parents=[stage])
+    parser_download.add_argument('--dbs', nargs='*', default=[], help='Repositories of source.json to fetch')
+    parser_download.add_argument('--git-jobs', type=int, default=4, help='Repositories fetched at the same time')
+    parser_download.add_argument('--full-history', action='store_true', help='Fetch all commits instead of the head')
+    parser_download.add_argument('--url-lists', action='store_true', help='Download the fonts of the URL lists')
+    parser_download.add_argument('--update-glyphazzn', action='store_true')
+    parser_download.set_defaults(func=run_download)
+
+    parser_collect = subparsers.add_parser('collect')
+    parser_collect.add_argument('--variable-instances', choices=['named', 'grid', 'none'], default='named')
+    parser_collect.add_argument('--grid-steps', type=int, default=3)
+    parser_collect.set_defaults(func=run_collect)
+
+    parser_filter = subparsers.add_parser('filter', parents=[stage, isolation])
+    parser_filter.add_argument('--chars', default=REQUIRED_CHARS)
+    parser_filter.set_defaults(func=run_filter)
+
+    parser_classify = subparsers.add_parser('classify', parents=[stage, isolation])
+    parser_classify.add_argument('--chars', default='ß', help='Chars to classify, one pass per char')
+    parser_classify.set_defaults(func=run_classify)
+
+    parser_render = subparsers.add_parser('render-export', parents=[stage, isolation])
+    parser_render.add_argument('--size', type=int, default=64)
+    parser_render.add_argument('--chars', default=REQUIRED_CHARS)
+    parser_render.add_argument('--split', default=None, help='Only fonts of a split (see assign_splits)')
+    parser_render.add_argument('--format', default='uint8', choices=['uint8', 'bits'],
+                               help="uint8 keeps anti-aliasing, bits stores thresholded glyphs with 1 bit per pixel")
+    parser_render.add_argument('--output', default=None,
+                               help='Output path without extension. Defaults to <PATH_PROCESSED>/glyphs_<split>_<size>')
+    parser_render.set_defaults(func=run_render_export)
+
+    parser_benchmark = subparsers.add_parser('benchmark')
+    parser_benchmark.add_argument('--out', default='benchmark_results.json')
+    parser_benchmark.add_argument('--quick', action='store_true')
+    parser_benchmark.add_argument('--work-dir', default=None)
+    parser_benchmark.set_defaults(func=run_benchmark)
+
+    parser_reduce = subparsers.add_parser('reduce', help='Merge the shard outputs of a stage')
+    parser_reduce.add_argument('stage', choices=shards.STAGES)
+    parser_reduce.add_argument('--num-shards', type=int, required=True)
+    parser_reduce.add_argument('--keep-shards', action='store_true', help="Don't delete the shard outputs")
+    parser_reduce.add_argument('--size', type=int, default=64, help='render-export: size of the glyphs')
+    parser_reduce.add_argument('--split', default=None, help='render-export: split of the fonts')
+    parser_reduce.add_argument('--output', default=None, help='render-export: output path without extension')
+    parser_reduce.set_defaults(func=run_reduce)
+
+    parser_sharded = subparsers.add_parser('run-sharded', help='Run all shards of a stage locally and reduce')
+    parser_sharded.add_argument('stage', choices=shards.STAGES)
+    parser_sharded.add_argument('--num-shards', type=int, required=True)
+    parser_sharded.add_argument('--parallel', type=int, default=None, help='Shards running at the same time')
+    parser_sharded.add_argument('--keep-shards', action='store_true', help="Don't delete the shard outputs")
+    parser_sharded.set_defaults(func=run_sharded)
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # Arguments after '--' are passed to the stage by run-sharded
+    stage_args = argv[argv.index('--') + 1:] if '--' in argv else []
+    args = build_parser().parse_args(argv[:argv.index('--')] if '--' in argv else argv)
+    args.stage_args = stage_args
+    overrides = {}
+    for assignment in args.set:
+        name, _, value = assignment.partition('=')
+        overrides[name.strip()] = value
+    g.configure(args.config, **overrides)
+    if args.metrics is not None:
+        metrics.configure(args.metrics)
+    if getattr(args, 'shard', None):
+        # Shards must not write the shared failure registry, the reduce step merges their failures
+        os.makedirs(g.PATH_SHARDS, exist_ok=True)
+        quarantine.defer_failures(shards.failures_path(args.command, args.shard))
+    args.func(args)
+    if args.metrics is not None:
+        metrics.write_summary(run=args.command)
+
+
+if __name__ == '__main__':
+    main()
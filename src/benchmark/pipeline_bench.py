@@ -0,0 +1,295 @@
+""" Benchmarks for the hot paths of the data pipeline.
+
+Builds a synthetic font corpus (see synthetic_fonts.py) and times rendering,
+the filter functions, writing filter results, the CLIP classifier and font
+collection across parameter sweeps. Every case runs in a fresh process, so
+caches start cold and the peak RSS belongs to the case alone.
+
+Usage:
+    python -m src.benchmark.pipeline_bench run [--out results.json] [--quick]
+    python -m src.benchmark.pipeline_bench compare <old.json> <new.json>
+"""
+
+import argparse
+import datetime
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from . import synthetic_fonts
+
+REQUIRED_CHARS = synthetic_fonts.REQUIRED_CHARS
+
+
+def _peak_rss_mb():
+    # Peak of the process and of its largest finished child (e.g. a render worker), reported
+    # separately: the max of both hides the parent's memory, the sum overstates parallel workers
+    usage_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return usage_self / divisor, usage_children / divisor
+
+
+def _render_chunk(args):
+    from ..data import datarenderer
+    font_file_paths, size, chars = args
+    return datarenderer.render_fonts(font_file_paths, size=size, chars=chars, use_registry=False).shape[0]
+
+
+def bench_render(font_file_paths, size, chars, workers):
+    from ..data import datarenderer
+    if workers == 1:
+        datarenderer.render_fonts(font_file_paths, size=size, chars=chars, use_registry=False)
+    else:
+        chunks = [(font_file_paths[idx::workers], size, chars) for idx in range(workers)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_render_chunk, chunks))
+    return {'fonts': len(font_file_paths), 'glyphs': len(font_file_paths) * len(chars)}
+
+
+def bench_filter(font_file_paths, filter_name, chars):
+    from ..data import datafilter, fontcache
+    func = getattr(datafilter, filter_name)
+    for font_file_path in font_file_paths:
+        kwargs = {'chars_to_check': chars,
+                  'font_file_path': font_file_path}
+        if filter_name != 'font_file_is_corrupted':
+            kwargs['font'] = fontcache.get_ttfont(font_file_path)
+        func(**kwargs)
+    return {'fonts': len(font_file_paths)}
+
+
+def bench_write_filter_results(font_file_paths, db_dir):
+    from ..data import global_consts as g
+    from ..data import fontdb_handler
+    g.PATH_TO_JSON_FONT_DB = os.path.join(db_dir, g.JSON_FONT_DB)
+    with open(g.PATH_TO_JSON_FONT_DB, 'w', encoding='utf-8') as file:
+        json.dump({path: {'usable': True} for path in font_file_paths}, file)
+    filter_dictionary = {path: {'usable': False, 'filters': ['out_of_bounds']}
+                         for path in font_file_paths[::2]}
+    fontdb_handler.write_filter_results(filter_dictionary)
+    return {'fonts': len(font_file_paths)}
+
+
+def bench_classifier(font_file_paths, char):
+    from ..data import classifier
+    classifier.evaluate_image(list(font_file_paths), char, text_query=[f"letter {char}", "a box"])
+    return {'fonts': len(font_file_paths)}
+
+
+def bench_collectfonts(corpus_dir, work_dir):
+    from ..data import global_consts as g
+    from ..data import datacollector
+    raw_dir = os.path.join(work_dir, 'raw')
+    shutil.copytree(corpus_dir, raw_dir)
+    g.PATH_RAW = raw_dir
+    g.PATH_TO_JSON_FONT_DB = os.path.join(raw_dir, g.JSON_FONT_DB)
+    datacollector.collectfonts()
+    with open(g.PATH_TO_JSON_FONT_DB, 'r', encoding='utf-8') as file:
+        return {'fonts': len(json.load(file))}
+
+
+STAGES = {'render': bench_render,
+          'filter': bench_filter,
+          'write_filter_results': bench_write_filter_results,
+          'classifier': bench_classifier,
+          'collectfonts': bench_collectfonts}
+
+# Modules that are imported before the clock starts
+STAGE_MODULES = {'render': ['datarenderer'],
+                 'filter': ['datafilter'],
+                 'write_filter_results': ['fontdb_handler'],
+                 'classifier': ['classifier'],
+                 'collectfonts': ['datacollector']}
+
+
+def _run_case(stage, kwargs):
+    if stage == 'classifier':
+        # Never download CLIP during a benchmark, only use a cached model
+        os.environ.setdefault('HF_HUB_OFFLINE', '1')
+    for module in STAGE_MODULES[stage]:
+        importlib.import_module(f"..data.{module}", __package__)
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            counts = STAGES[stage](**kwargs)
+        finally:
+            sys.stdout = stdout
+    seconds = time.perf_counter() - start
+    peak_rss_mb, peak_rss_children_mb = _peak_rss_mb()
+    return {'seconds': seconds, 'counts': counts, 'peak_rss_mb': peak_rss_mb,
+            'peak_rss_children_mb': peak_rss_children_mb}
+
+
+def run_case(stage, params, **kwargs):
+    """ Runs one benchmark case in a fresh process.
+
+    Args:
+        stage (str): Name of the stage in STAGES
+        params (Dictionary): Parameters that identify the case in the results
+        **kwargs: Arguments of the stage function
+
+    Returns:
+        Dictionary: Stage, params, seconds, throughput per counted unit and peak RSS of the
+            benchmark process and of its largest child process, or the error if the stage failed
+    """
+    context = multiprocessing.get_context('spawn')
+    try:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(_run_case, stage, kwargs).result()
+    except Exception as e:
+        print(f"{stage} {params}: skipped ({type(e).__name__}: {e})")
+        return {'stage': stage, 'params': params, 'error': f"{type(e).__name__}: {e}"}
+
+    entry = {'stage': stage, 'params': params,
+             'seconds': result['seconds'], 'peak_rss_mb': result['peak_rss_mb'],
+             'peak_rss_children_mb': result['peak_rss_children_mb']}
+    for unit, count in result['counts'].items():
+        entry[f"{unit}_per_sec"] = count / result['seconds']
+    print(f"{stage} {params}: " + ", ".join(f"{key}={value:.1f}" for key, value in entry.items()
+                                            if key.endswith('_per_sec')))
+    return entry
+
+
+def run_benchmarks(work_dir, quick=False):
+    """ Builds the synthetic corpus and runs all parameter sweeps.
+
+    Args:
+        work_dir (str): Directory for the corpus and temporary files
+        quick (bool, optional): Smaller corpus and sweeps. Defaults to False.
+
+    Returns:
+        list: Result of run_case for every case
+    """
+    num_fonts = 20 if quick else 100
+    corpus_dir = os.path.join(work_dir, 'corpus')
+    big_corpus_dir = os.path.join(work_dir, 'corpus_big')
+    print("Building synthetic fonts...")
+    font_file_paths = synthetic_fonts.build_corpus(corpus_dir, num_fonts=num_fonts, num_glyphs=100)
+    big_font_file_paths = synthetic_fonts.build_corpus(big_corpus_dir, num_fonts=num_fonts // 4,
+                                                       num_glyphs=2000 if quick else 20000,
+                                                       points_per_contour=24, metadata=False)
+    corpora = {'small': font_file_paths, 'big_cmap': big_font_file_paths}
+
+    sizes = [32, 64] if quick else [16, 32, 64, 128]
+    charsets = [REQUIRED_CHARS[:9], REQUIRED_CHARS] if quick else \
+        [REQUIRED_CHARS[:1], REQUIRED_CHARS[:9], REQUIRED_CHARS[:16], REQUIRED_CHARS]
+    worker_counts = [1, 2] if quick else [1, 2, 4, os.cpu_count() or 1]
+
+    results = []
+    for size in sizes:
+        for chars in charsets:
+            results.append(run_case('render', {'size': size, 'num_chars': len(chars), 'workers': 1},
+                                    font_file_paths=font_file_paths, size=size, chars=chars, workers=1))
+    for workers in sorted(set(worker_counts)):
+        results.append(run_case('render', {'size': 64, 'num_chars': len(REQUIRED_CHARS), 'workers': workers},
+                                font_file_paths=font_file_paths, size=64, chars=REQUIRED_CHARS,
+                                workers=workers))
+
+    for corpus, paths in corpora.items():
+        for filter_name in ['font_file_is_corrupted', 'has_not_all_chars', 'has_empty_glyphs', 'out_of_bounds']:
+            results.append(run_case('filter', {'filter': filter_name, 'corpus': corpus},
+                                    font_file_paths=paths, filter_name=filter_name, chars=REQUIRED_CHARS))
+
+    db_dir = os.path.join(work_dir, 'db')
+    os.makedirs(db_dir, exist_ok=True)
+    for num_entries in ([1000] if quick else [1000, 10000, 50000]):
+        paths = [f"synthetic/font{idx:06d}.ttf" for idx in range(num_entries)]
+        results.append(run_case('write_filter_results', {'num_fonts': num_entries},
+                                font_file_paths=paths, db_dir=db_dir))
+
+    results.append(run_case('classifier', {'char': 'ß', 'corpus': 'small'},
+                            font_file_paths=font_file_paths, char='ß'))
+
+    collect_dir = os.path.join(work_dir, 'collect')
+    os.makedirs(collect_dir, exist_ok=True)
+    results.append(run_case('collectfonts', {'corpus': 'small'},
+                            corpus_dir=corpus_dir, work_dir=collect_dir))
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def save_results(results, path):
+    """ Writes benchmark results with information about the commit and machine as json. """
+    report = {'meta': {'commit': _git_commit(),
+                       'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'cpu_count': os.cpu_count()},
+              'results': results}
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=4)
+
+
+def compare_results(path_old, path_new):
+    """ Prints the throughput ratio new/old for every case found in both result files.
+
+    Returns:
+        list: Tuples (stage, params, metric, old value, new value, ratio)
+    """
+    with open(path_old, 'r', encoding='utf-8') as file:
+        old = json.load(file)
+    with open(path_new, 'r', encoding='utf-8') as file:
+        new = json.load(file)
+
+    def key(entry):
+        return entry['stage'], json.dumps(entry['params'], sort_keys=True)
+    old_results = {key(entry): entry for entry in old['results']}
+
+    print(f"old: {old['meta']['commit']}  new: {new['meta']['commit']}")
+    comparison = []
+    for entry in new['results']:
+        if key(entry) not in old_results:
+            continue
+        old_entry = old_results[key(entry)]
+        for metric, value in entry.items():
+            if not metric.endswith('_per_sec') or metric not in old_entry:
+                continue
+            # A stage that counted nothing before has no meaningful ratio
+            ratio = value / old_entry[metric] if old_entry[metric] else float('nan')
+            comparison.append((entry['stage'], entry['params'], metric, old_entry[metric], value, ratio))
+            print(f"{entry['stage']:22s} {json.dumps(entry['params']):60s} {metric:16s} "
+                  f"{old_entry[metric]:12.1f} -> {value:12.1f}  x{ratio:.2f}")
+    return comparison
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_run = subparsers.add_parser('run')
+    parser_run.add_argument('--out', default='benchmark_results.json')
+    parser_run.add_argument('--quick', action='store_true')
+    parser_run.add_argument('--work-dir', default=None)
+    parser_compare = subparsers.add_parser('compare')
+    parser_compare.add_argument('old')
+    parser_compare.add_argument('new')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        work_dir = args.work_dir or tempfile.mkdtemp(prefix='font_benchmark_')
+        try:
+            save_results(run_benchmarks(work_dir, quick=args.quick), args.out)
+        finally:
+            if args.work_dir is None:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        print(f"Results written to {args.out}")
+    else:
+        compare_results(args.old, args.new)
@@ -0,0 +1,121 @@
+""" Generates a synthetic font corpus with fontTools for benchmarks.
+
+The fonts cover the chars the pipeline checks for and can be padded with
+additional (CJK) codepoints to get large cmaps. Outlines are random polygons,
+so rendering and parsing costs scale with the number of glyphs and points.
+No network access or real dataset is needed.
+"""
+
+import os
+import numpy as np
+from fontTools.fontBuilder import FontBuilder
+from fontTools.pens.ttGlyphPen import TTGlyphPen
+
+REQUIRED_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789ÄäÖöÜüß"
+UNITS_PER_EM = 1000
+EXTRA_CODEPOINTS_START = 0x4E00  # CJK Unified Ideographs
+
+
+def _draw_random_glyph(pen, rng, num_contours, points_per_contour):
+    for _ in range(num_contours):
+        center = rng.uniform([150, 50], [550, 650])
+        radius = rng.uniform(60, 150)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, points_per_contour))[::-1]
+        radii = radius * rng.uniform(0.6, 1.0, points_per_contour)
+        points = np.stack([center[0] + radii * np.cos(angles),
+                           center[1] + radii * np.sin(angles)], axis=1).round().astype(int)
+        pen.moveTo(tuple(points[0]))
+        for point in points[1:]:
+            pen.lineTo(tuple(point))
+        pen.closePath()
+
+
+def build_font(path, num_glyphs=100, points_per_contour=12, num_contours=2,
+               chars=REQUIRED_CHARS, seed=0, family_name="Synthetic"):
+    """ Builds a TrueType font with random outlines.
+
+    Args:
+        path (str): Path of the font file
+        num_glyphs (int, optional): Number of mapped glyphs. At least len(chars)
+            glyphs are built, the rest are mapped to CJK codepoints. Defaults to 100.
+        points_per_contour (int, optional): Outline points per contour. Defaults to 12.
+        num_contours (int, optional): Contours per glyph. Defaults to 2.
+        chars (str, optional): Chars that are mapped. Defaults to REQUIRED_CHARS.
+        seed (int, optional): Seed for the outlines. Defaults to 0.
+        family_name (str, optional): Family name. Defaults to "Synthetic".
+
+    Returns:
+        str: The path of the font file
+    """
+    rng = np.random.default_rng(seed)
+    codepoints = [ord(char) for char in chars]
+    codepoints += list(range(EXTRA_CODEPOINTS_START,
+                             EXTRA_CODEPOINTS_START + max(num_glyphs - len(codepoints), 0)))
+
+    glyph_order = ['.notdef'] + [f"uni{code:04X}" for code in codepoints]
+    glyphs = {'.notdef': TTGlyphPen(None).glyph()}
+    for glyph_name in glyph_order[1:]:
+        pen = TTGlyphPen(None)
+        _draw_random_glyph(pen, rng, num_contours, points_per_contour)
+        glyphs[glyph_name] = pen.glyph()
+
+    builder = FontBuilder(UNITS_PER_EM, isTTF=True)
+    builder.setupGlyphOrder(glyph_order)
+    builder.setupCharacterMap(dict(zip(codepoints, glyph_order[1:])))
+    builder.setupGlyf(glyphs)
+    builder.setupHorizontalMetrics({name: (700, getattr(glyphs[name], 'xMin', 0))
+                                    for name in glyph_order})
+    builder.setupHorizontalHeader(ascent=800, descent=-200)
+    builder.setupNameTable({'familyName': family_name, 'styleName': 'Regular'})
+    builder.setupOS2(sTypoAscender=800, sTypoDescender=-200, usWinAscent=800, usWinDescent=200)
+    builder.setupPost()
+    builder.save(path)
+    return path
+
+
+def build_corpus(target_dir, num_fonts=50, num_glyphs=100, points_per_contour=12,
+                 fonts_per_family=4, metadata=True):
+    """ Builds a directory tree of synthetic fonts like the Google Fonts repository.
+
+    Every family gets its own directory with a METADATA.pb file.
+
+    Args:
+        target_dir (str): Directory of the corpus
+        num_fonts (int, optional): Number of fonts. Defaults to 50.
+        num_glyphs (int, optional): Mapped glyphs per font. Defaults to 100.
+        points_per_contour (int, optional): Outline points per contour. Defaults to 12.
+        fonts_per_family (int, optional): Fonts per family directory. Defaults to 4.
+        metadata (bool, optional): Write METADATA.pb files. Defaults to True.
+
+    Returns:
+        list: Paths of the font files
+    """
+    font_file_paths = []
+    for idx in range(num_fonts):
+        family_idx = idx // fonts_per_family
+        family_dir = os.path.join(target_dir, f"family{family_idx:04d}")
+        os.makedirs(family_dir, exist_ok=True)
+        filename = f"Family{family_idx:04d}-Style{idx % fonts_per_family}.ttf"
+        font_file_paths.append(build_font(os.path.join(family_dir, filename), num_glyphs,
+                                          points_per_contour, seed=idx,
+                                          family_name=f"Family{family_idx:04d}"))
+
+    if metadata:
+        for family_idx in range((num_fonts + fonts_per_family - 1) // fonts_per_family):
+            family_dir = os.path.join(target_dir, f"family{family_idx:04d}")
+            lines = [f'name: "Family{family_idx:04d}"',
+                     'license: "OFL"',
+                     'category: "SANS_SERIF"']
+            for style in range(fonts_per_family):
+                filename = f"Family{family_idx:04d}-Style{style}.ttf"
+                if os.path.exists(os.path.join(family_dir, filename)):
+                    lines += ['fonts {',
+                              f'  name: "Family{family_idx:04d}"',
+                              '  style: "normal"',
+                              f'  weight: {100 * (style + 1)}',
+                              f'  filename: "{filename}"',
+                              '}']
+            lines += ['subsets: "latin"', 'subsets: "menu"']
+            with open(os.path.join(family_dir, 'METADATA.pb'), 'w', encoding='utf-8') as file:
+                file.write('\n'.join(lines) + '\n')
+    return font_file_paths
@@ -0,0 +1,281 @@
+""" Content-addressed store for raw font files.
+
+Every font file is stored once under its sha256 (the content ID) in
+directories sharded by the first bytes of the hash:
+
+    blobs/3f/a2/3fa2...e1.ttf
+
+The index (00blobs.json in the store) maps content IDs to the blob and its
+provenance, i.e. every URL or relative path the content was seen under.
+Fonts with the same basename from different sources get different content
+IDs and can't overwrite each other, duplicates are stored once. Blob paths
+in the index are relative to the store, so the store can be moved with the
+raw directory.
+
+Files in the working tree (e.g. the downloads in raw/) are hardlinks to the
+blobs, so they don't take extra space.
+
+Usage:
+    store = BlobStore()
+    content_id = store.put_file('../data/raw/x/Regular.ttf')
+    store.path(content_id)
+    store.import_font_db()      # adds 'content_id' to every entry of the font database
+    store.save()
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from . import global_consts as g
+from . import fontcache, fontdb_handler, metrics
+
+
+def blob_relative_path(content_id, extension=''):
+    """ Returns the path of a blob relative to the store, sharded by the first two bytes of the ID. """
+    return os.path.join(content_id[:2], content_id[2:4], content_id + extension.lower())
+
+
+def _provenance_key(path):
+    # Paths below the raw directory are stored relative to it, so they stay valid when it moves
+    relative_path = os.path.relpath(os.path.normpath(path), os.path.normpath(g.PATH_RAW))
+    if relative_path.startswith('..'):
+        return os.path.normpath(path).replace(os.sep, '/')
+    return relative_path.replace(os.sep, '/')
+
+
+class BlobStore:
+    """ Content-addressed font files with an index of their provenance. """
+
+    def __init__(self, root=None):
+        """
+        Args:
+            root (str, optional): Directory of the store. Defaults to None: global_consts.PATH_BLOBS.
+        """
+        self.root = root = root if root is not None else g.PATH_BLOBS
+        self._lock = threading.Lock()
+        try:
+            with open(os.path.join(root, g.JSON_BLOB_INDEX), 'r', encoding='utf-8') as file:
+                self.index = json.load(file)
+        except FileNotFoundError:
+            self.index = {}
+
+    def save(self, path=None):
+        """ Writes the index.
+
+        Args:
+            path (str, optional): File of the index, e.g. the output of a shard (see shards.py).
+                Defaults to None: the index in the store.
+        """
+        path = path or os.path.join(self.root, g.JSON_BLOB_INDEX)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            with metrics.timer('db_write', num_fonts=len(self.index), db='blob_index'):
+                with open(path, 'w', encoding='utf-8') as file:
+                    json.dump(self.index, file, indent=1)
+
+    def merge_index(self, index):
+        """ Adds the entries of another index of the same store (e.g. written by a shard). """
+        with self._lock:
+            for content_id, entry in index.items():
+                own = self.index.setdefault(content_id, entry)
+                if own is not entry:
+                    own['provenance'].extend(source for source in entry['provenance']
+                                             if source not in own['provenance'])
+
+    def __contains__(self, content_id):
+        return content_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def path(self, content_id):
+        """ Returns the path of the blob of a content ID. Raises KeyError for unknown IDs. """
+        return os.path.join(self.root, self.index[content_id]['file'])
+
+    def provenance(self, content_id):
+        """ Returns the URLs and paths the content was seen under. """
+        return self.index[content_id]['provenance']
+
+    def _add(self, content_id, extension, size, provenance, write):
+        # write(path) creates the blob; it is only called for new content
+        with self._lock:
+            entry = self.index.get(content_id)
+            if entry is None:
+                entry = {'file': blob_relative_path(content_id, extension), 'size': size, 'provenance': []}
+            if provenance is not None and provenance not in entry['provenance']:
+                entry['provenance'].append(provenance)
+        blob_path = os.path.join(self.root, entry['file'])
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            write(blob_path)
+            metrics.count('blob_bytes', size)
+        else:
+            metrics.count('blob_duplicates')
+        with self._lock:
+            self.index[content_id] = entry
+        return content_id
+
+    def put_bytes(self, data, name, provenance=None):
+        """ Stores the content of a file.
+
+        Args:
+            data (bytes): Content of the file
+            name (str): File name or URL, its extension is kept for the blob
+            provenance (str, optional): Where the content comes from, e.g. the URL. Defaults to name.
+
+        Returns:
+            str: Content ID
+        """
+        def write(blob_path):
+            # Written to a temporary file first, so an interrupted write leaves no broken blob
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(blob_path), delete=False) as file:
+                file.write(data)
+            os.replace(file.name, blob_path)
+
+        return self._add(hashlib.sha256(data).hexdigest(), os.path.splitext(name)[1], len(data),
+                         provenance if provenance is not None else name, write)
+
+    def put_file(self, path, provenance=None, link=True):
+        """ Stores a file.
+
+        Args:
+            path (str): Path of the file
+            provenance (str, optional): Where the file comes from. Defaults to the path (relative
+                to the raw directory if it is inside).
+            link (bool, optional): Hardlink the blob to the file instead of copying it. Falls back
+                to copying across file systems. Defaults to True.
+
+        Returns:
+            str: Content ID
+        """
+        def write(blob_path):
+            if link:
+                try:
+                    os.link(path, blob_path)
+                    return
+                except OSError:
+                    pass
+            partial_path = blob_path + '.part'
+            shutil.copyfile(path, partial_path)
+            os.replace(partial_path, blob_path)
+
+        return self._add(fontdb_handler.file_sha256(path), os.path.splitext(path)[1], os.path.getsize(path),
+                         provenance if provenance is not None else _provenance_key(path), write)
+
+    def checkout(self, content_id, directory, name):
+        """ Hardlinks a blob into a directory (e.g. for collectfonts and METADATA.pb lookups).
+
+        If a different file with the name exists, the short content ID is appended to
+        the name instead of overwriting it.
+
+        Returns:
+            str: Path of the file in the directory
+        """
+        os.makedirs(directory, exist_ok=True)
+        blob_path = self.path(content_id)
+        target = os.path.join(directory, name)
+        if os.path.exists(target):
+            if os.path.samefile(target, blob_path) or fontdb_handler.file_sha256(target) == content_id:
+                return target
+            stem, extension = os.path.splitext(name)
+            target = os.path.join(directory, f"{stem}-{content_id[:12]}{extension}")
+            if os.path.exists(target):
+                return target
+        try:
+            os.link(blob_path, target)
+        except OSError:
+            shutil.copyfile(blob_path, target)
+        return target
+
+    def dedupe(self, paths):
+        """ Stores files and replaces duplicates in the working tree by hardlinks to their blob.
+
+        Returns:
+            int: Bytes freed
+        """
+        freed = 0
+        for path in paths:
+            content_id = self.put_file(path)
+            blob_path = self.path(content_id)
+            if os.path.samefile(path, blob_path):
+                continue
+            partial_path = path + '.part'
+            try:
+                os.link(blob_path, partial_path)
+            except OSError:
+                continue
+            freed += os.path.getsize(path)
+            os.replace(partial_path, path)
+        return freed
+
+    def import_font_db(self, link=True):
+        """ Stores the files of all fonts in the json font database and adds their 'content_id'
+            (also as 'sha256', see fontdb_handler.assign_splits) to the entries.
+
+        Instances of variable fonts share the content ID of their font file.
+
+        Returns:
+            int: Number of fonts that could not be read
+        """
+        font_db = fontdb_handler.load_font_db()
+        content_ids, missing = {}, 0
+        for font_path, entry in font_db.items():
+            font_file_path = fontcache.split_instance_path(font_path)[0]
+            if font_file_path not in content_ids:
+                try:
+                    content_ids[font_file_path] = self.put_file(font_file_path, link=link)
+                except OSError:
+                    content_ids[font_file_path] = None
+            if content_ids[font_file_path] is None:
+                missing += 1
+                continue
+            entry['content_id'] = entry['sha256'] = content_ids[font_file_path]
+
+        with metrics.timer('db_write', num_fonts=len(font_db)):
+            with open(g.PATH_TO_JSON_FONT_DB, 'w', encoding='utf-8') as file:
+                json.dump(font_db, file, indent=4)
+        return missing
+
+
+def font_db_by_content(font_db=None):
+    """ Groups the json font database by content ID (see BlobStore.import_font_db).
+
+    Returns:
+        Dictionary: Content ID as key and {'paths': [...], 'entry': entry of the first path}
+            as value. Entries without content ID are left out.
+    """
+    if font_db is None:
+        font_db = fontdb_handler.load_font_db()
+    by_content = {}
+    for font_path, entry in font_db.items():
+        if 'content_id' in entry:
+            by_content.setdefault(entry['content_id'], {'paths': [], 'entry': entry})['paths'].append(font_path)
+    return by_content
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--root', default=None)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('import', help='Store the fonts of the font database')
+    parser_dedupe = subparsers.add_parser('dedupe', help='Replace duplicate font files by hardlinks')
+    parser_dedupe.add_argument('directory', nargs='?', default=None, help='Defaults to PATH_RAW')
+    args = parser.parse_args()
+
+    store = BlobStore(args.root)
+    if args.command == 'import':
+        missing = store.import_font_db()
+        print(f"{len(store)} blobs, {missing} fonts could not be read")
+    else:
+        blob_root = os.path.normpath(store.root)
+        directory = g.PATH_RAW if args.directory is None else args.directory
+        paths = [os.path.join(root, file) for root, _, files in os.walk(directory)
+                 if not os.path.normpath(root).startswith(blob_root)
+                 for file in files if file.lower().endswith(('.ttf', '.otf'))]
+        print(f"Freed {store.dedupe(paths) / 2**20:.1f} MiB")
+    store.save()
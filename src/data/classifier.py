@@ -8,7 +8,7 @@ from PIL import Image
 import numpy as np
 
 from tqdm import tqdm
-from . import datarenderer
+from . import datarenderer, fontcache, metrics
 from . import global_consts as g
 
 
@@ -22,7 +22,8 @@ processor = CLIPProcessor.from_pretrained(
     "openai/clip-vit-large-patch14", token=api_key)
 
 
-def evaluate_image(image_paths, char, text_query=None, verbose=False) -> dict:
+def evaluate_image(image_paths, char, text_query=None, verbose=False, isolated=False, workers=None,
+                   glyphs=None) -> dict:
     """ Evaluate images
 
     Args:
@@ -30,12 +31,17 @@ def evaluate_image(image_paths, char, text_query=None, verbose=False) -> dict:
         text_query (List[String]): List of text queries, first category is
             the one to be evaluated
         verbose (bool, optional): Print additional information. Defaults to False.
+        isolated (bool, optional): Render the fonts in worker processes with a time and
+            memory limit (see isolation.py). Defaults to False.
+        workers (int, optional): Number of worker processes if isolated. Defaults to the number of CPUs.
+        glyphs (tuple, optional): The char already rendered at size 64 for the fonts that could be
+            rendered and their indices in image_paths, e.g. from a RenderPlan (see renderplan.py).
+            Defaults to None: rendered here.
 
     Returns:
         Dictionary: Returns True if the image is classified as the first category
-            in text_query, False otherwise
+            in text_query, False otherwise or if the font could not be rendered
     """
-    results = {}
     warnings.filterwarnings('ignore', message='text_config_dict is provided*')
 
     # Load the text queries
@@ -46,8 +52,14 @@ def evaluate_image(image_paths, char, text_query=None, verbose=False) -> dict:
 
     # Load the images into a numpy array
     # The numpy array will have the shape ([img_data], size, size, [char]])
-    print('Rendering images...')
-    image_arrays = datarenderer.render_fonts(image_paths, chars=char)
+    if glyphs is None:
+        print('Rendering images...')
+        glyphs = datarenderer.render_fonts(image_paths, chars=char, isolated=isolated,
+                                           workers=workers, compact=True)
+    image_arrays, rendered = glyphs
+    # Fonts that could not be rendered are not usable for the char
+    results = {image_paths[idx]: {char: False}
+               for idx in sorted(set(range(len(image_paths))) - set(rendered))}
 
     # Convert images to PIL images
     # CLIP expects RGB and 224x224 images, so we convert the grayscale images to RGB
@@ -64,16 +76,18 @@ def evaluate_image(image_paths, char, text_query=None, verbose=False) -> dict:
         start_index = i
         end_index = min(i + batch_size, len(images))
         batch_images = images[start_index:end_index]
-        inputs = processor(text=text_query,
-                           images=batch_images,
-                           return_tensors="pt",
-                           padding=True)
-        outputs = model(**inputs)
-        logits_per_image = outputs.logits_per_image
-        probs = logits_per_image.softmax(dim=1).detach().numpy()
+        with metrics.timer('clip_batch', batch_size=len(batch_images)):
+            inputs = processor(text=text_query,
+                               images=batch_images,
+                               return_tensors="pt",
+                               padding=True)
+            outputs = model(**inputs)
+            logits_per_image = outputs.logits_per_image
+            probs = logits_per_image.softmax(dim=1).detach().numpy()
+        metrics.count('clip_images', len(batch_images))
 
         for j, probset in enumerate(probs):
-            global_index = i + j
+            global_index = rendered[i + j]
             #print(f"Prob: {probset}")
             if verbose:
                 # For testing, print the probabilities
@@ -87,5 +101,7 @@ def evaluate_image(image_paths, char, text_query=None, verbose=False) -> dict:
 
     if verbose:
         print(f'Classification dictionary: {results}')
+        print(f'Font cache: {fontcache.cache_stats()}')
 
     return results
+
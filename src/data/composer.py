@@ -0,0 +1,225 @@
+""" Builds umlauts (Ä, ä, Ö, ö, Ü, ü) as composite glyphs from existing glyphs.
+
+Many fonts without umlauts still contain the base letters and a dieresis
+(U+0308 combining or U+00A8 spacing). For those, the umlauts are composed
+directly from base letter and mark with fontTools, which is much cheaper than
+generating them with the model. The mark is placed with the mark-to-base
+anchors of the GPOS table if available and otherwise by the bounding boxes.
+
+Only chars that can't be composed (ß, fonts without dieresis) need the model.
+"""
+
+import os
+from fontTools import ttLib
+from fontTools.pens.boundsPen import BoundsPen
+from fontTools.pens.transformPen import TransformPen
+from . import global_consts as g
+from . import fontcache, fontdb_handler, fontwriter
+
+DIERESIS_BASES = {'Ä': 'A', 'ä': 'a', 'Ö': 'O', 'ö': 'o', 'Ü': 'U', 'ü': 'u'}
+# The combining dieresis is preferred, because GPOS anchors are defined for marks
+DIERESIS_MARKS = [0x0308, 0x00A8]
+
+
+def find_components(font, chars="ÄäÖöÜü"):
+    """ Finds base and mark glyphs for the chars that can be composed.
+
+    Args:
+        font (ttLib.TTFont): The font
+        chars (str, optional): Chars to check. Defaults to "ÄäÖöÜü".
+
+    Returns:
+        Dictionary: Char as key and (base glyph name, mark glyph name) as value
+    """
+    cmap = font.getBestCmap() or {}
+    mark = next((cmap[code] for code in DIERESIS_MARKS if code in cmap), None)
+    if mark is None:
+        return {}
+    return {char: (cmap[ord(DIERESIS_BASES[char])], mark)
+            for char in chars
+            if char in DIERESIS_BASES and ord(DIERESIS_BASES[char]) in cmap}
+
+
+def composable_chars(font_file_path, chars="ÄäÖöÜü"):
+    """ Returns the chars missing in a font that can be composed.
+
+    Args:
+        font_file_path (str): Path to font file (ttf, otf)
+        chars (str, optional): Chars to check. Defaults to "ÄäÖöÜü".
+
+    Returns:
+        list: Chars that are not in the cmap but can be composed
+    """
+    font = fontcache.get_ttfont(font_file_path)
+    cmap = font.getBestCmap() or {}
+    components = find_components(font, chars)
+    return [char for char in chars if ord(char) not in cmap and char in components]
+
+
+def _bounds(glyph_set, glyph_name):
+    pen = BoundsPen(glyph_set)
+    glyph_set[glyph_name].draw(pen)
+    return pen.bounds
+
+
+def _gpos_offset(font, base, mark):
+    if 'GPOS' not in font or font['GPOS'].table.LookupList is None:
+        return None
+    for lookup in font['GPOS'].table.LookupList.Lookup:
+        for subtable in lookup.SubTable:
+            if lookup.LookupType == 9:
+                subtable = subtable.ExtSubTable
+            if getattr(subtable, 'LookupType', lookup.LookupType) != 4 or subtable.Format != 1:
+                continue
+            mark_glyphs = subtable.MarkCoverage.glyphs
+            base_glyphs = subtable.BaseCoverage.glyphs
+            if mark not in mark_glyphs or base not in base_glyphs:
+                continue
+            mark_record = subtable.MarkArray.MarkRecord[mark_glyphs.index(mark)]
+            base_record = subtable.BaseArray.BaseRecord[base_glyphs.index(base)]
+            base_anchor = base_record.BaseAnchor[mark_record.Class]
+            if base_anchor is None:
+                continue
+            return (base_anchor.XCoordinate - mark_record.MarkAnchor.XCoordinate,
+                    base_anchor.YCoordinate - mark_record.MarkAnchor.YCoordinate)
+    return None
+
+
+def mark_offset(font, base, mark):
+    """ Computes the offset of the mark relative to the base glyph.
+
+    Uses the GPOS mark-to-base anchors if available. Otherwise the mark is
+    centered over the base and keeps the distance to the base that it has
+    to the x-height.
+
+    Args:
+        font (ttLib.TTFont): The font
+        base (str): Glyph name of the base letter
+        mark (str): Glyph name of the dieresis
+
+    Returns:
+        tuple: (dx, dy) in font units
+    """
+    offset = _gpos_offset(font, base, mark)
+    if offset is not None:
+        return offset
+
+    glyph_set = font.getGlyphSet()
+    base_bounds = _bounds(glyph_set, base)
+    mark_bounds = _bounds(glyph_set, mark)
+    if base_bounds is None or mark_bounds is None:
+        return (0, 0)
+
+    cmap = font.getBestCmap()
+    x_height = None
+    if ord('x') in cmap:
+        x_bounds = _bounds(glyph_set, cmap[ord('x')])
+        x_height = None if x_bounds is None else x_bounds[3]
+    if x_height is None and 'OS/2' in font:
+        x_height = getattr(font['OS/2'], 'sxHeight', None)
+    if not x_height:
+        x_height = 0.5 * font['head'].unitsPerEm
+
+    gap = max(mark_bounds[1] - x_height, 0.04 * font['head'].unitsPerEm)
+    dx = (base_bounds[0] + base_bounds[2]) / 2 - (mark_bounds[0] + mark_bounds[2]) / 2
+    dy = base_bounds[3] + gap - mark_bounds[1]
+    return (int(round(dx)), int(round(dy)))
+
+
+def compose_glyphs(font_file_path, output_path=None, chars="ÄäÖöÜü", overwrite=False):
+    """ Writes a copy of a font with composite umlauts.
+
+    Args:
+        font_file_path (str): Path to font file (ttf, otf)
+        output_path (str, optional): Path of the new font file. Defaults to
+            '<name>_composed.<ext>' next to the source font.
+        chars (str, optional): Chars to compose. Defaults to "ÄäÖöÜü".
+        overwrite (bool, optional): Replace chars the font already has. Defaults to False.
+
+    Returns:
+        Dictionary: 'output_path' (None if nothing was composed) and the list of 'composed' chars
+    """
+    if output_path is None:
+        root, ext = os.path.splitext(font_file_path)
+        output_path = f"{root}_composed{ext}"
+
+    font = ttLib.TTFont(font_file_path)
+    cmap = font.getBestCmap() or {}
+    components = find_components(font, chars)
+    is_cff = fontwriter.check_outlines(font)
+
+    composed = []
+    for char in chars:
+        if char not in components or (ord(char) in cmap and not overwrite):
+            continue
+        base, mark = components[char]
+        dx, dy = mark_offset(font, base, mark)
+
+        def draw(pen):
+            if is_cff:
+                glyph_set = font.getGlyphSet()
+                glyph_set[base].draw(pen)
+                glyph_set[mark].draw(TransformPen(pen, (1, 0, 0, 1, dx, dy)))
+            else:
+                pen.addComponent(base, (1, 0, 0, 1, 0, 0))
+                pen.addComponent(mark, (1, 0, 0, 1, dx, dy))
+
+        fontwriter.add_glyph(font, char, draw, advance=font['hmtx'][base][0])
+        composed.append(char)
+
+    if not composed:
+        font.close()
+        return {'output_path': None, 'composed': []}
+    try:
+        fontwriter.save_font(font, output_path)
+    finally:
+        font.close()
+    return {'output_path': output_path, 'composed': composed}
+
+
+def compose_font_db(chars="ÄäÖöÜü", output_dir=None):
+    """ Composes the missing umlauts of all fonts in the json font database that were
+        excluded by has_not_all_chars and adds the completed copies to the database.
+
+    The completed fonts only become usable if all the chars missing in the original
+    font could be composed. They are filtered like every other font afterwards.
+
+    Args:
+        chars (str, optional): Chars to compose. Defaults to "ÄäÖöÜü".
+        output_dir (str, optional): Directory for the new font files. Defaults to
+            '<PATH_PROCESSED>/composed/'.
+
+    Returns:
+        Dictionary: Path of the original font as key and result of compose_glyphs as value
+    """
+    if output_dir is None:
+        output_dir = os.path.join(g.PATH_PROCESSED, 'composed')
+    os.makedirs(output_dir, exist_ok=True)
+
+    font_db = fontdb_handler.load_font_db()
+    results = {}
+    new_entries = {}
+    for idx, (font_file_path, font_info) in enumerate(font_db.items()):
+        chars_missing = font_info.get('chars_not_in_font_cmap')
+        # Instances of variable fonts would need variations for the new glyphs
+        if not chars_missing or 'composed_from' in font_info or 'instance' in font_info:
+            continue
+        try:
+            if not set(chars_missing).issubset(composable_chars(font_file_path, chars)):
+                continue
+            root, ext = os.path.splitext(os.path.basename(font_file_path))
+            output_path = os.path.join(output_dir, f"{idx:06d}_{root}{ext}")
+            results[font_file_path] = compose_glyphs(font_file_path, output_path, chars)
+        except Exception as e:
+            print(f"Error while composing font {font_file_path}: {e}")
+            continue
+
+        new_entries[os.path.normpath(output_path)] = {
+            'usable': True,
+            'composed_from': font_file_path,
+            'composed_chars': results[font_file_path]['composed'],
+            **({'metadata': font_info['metadata']} if 'metadata' in font_info else {})}
+
+    fontdb_handler.add_fonts(new_entries)
+    print(f"Composed umlauts for {len(new_entries)} fonts.")
+    return results
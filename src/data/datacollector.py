@@ -12,62 +12,202 @@
     python datacollector.py <source_directory> <destination_directory>
 """
 
+import itertools
 import os
 import json
 import zipfile
 import re
+import numpy as np
 from . import global_consts as g
+from . import fontcache
 
 METADATA = 'METADATA.pb'
 ZIPTYPE = '.zip'
 FONTTYPES = ['.ttf', '.otf']
 
 
+# Fields that can occur more than once in METADATA.pb and are always stored as list
+REPEATED_FIELDS = {'fonts', 'subsets', 'axes', 'category', 'languages', 'fallbacks',
+                   'registry_default_overrides', 'files', 'sample_glyphs'}
+# Fields of the family and of the font entry that are written to the font database
+FAMILY_FIELDS = ['designer', 'license', 'category', 'subsets', 'date_added', 'axes']
+FONT_FIELDS = ['full_name', 'post_script_name', 'style', 'weight']
+
+_TOKEN = re.compile(r'''\s+|\#[^\n]*|("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|[{}<>:;,\[\]]|[^\s{}<>:;,\[\]"'\#]+)''')
+_metadata_cache = {}
+
+
+def _unquote(token):
+    # Escapes (including octal escaped UTF-8 bytes) are resolved on bytes level
+    raw = token[1:-1]
+    try:
+        return raw.encode('utf-8').decode('unicode_escape').encode('latin-1').decode('utf-8')
+    except (UnicodeDecodeError, UnicodeEncodeError):
+        return raw
+
+
+def _scalar(token):
+    if token[0] in '"\'':
+        return _unquote(token)
+    if token in ('true', 'True'):
+        return True
+    if token in ('false', 'False'):
+        return False
+    for convert in (int, float):
+        try:
+            return convert(token)
+        except ValueError:
+            pass
+    # Enum value
+    return token
+
+
+def _parse_message(tokens, pos, closing=None):
+    message = {}
+    while pos < len(tokens) and tokens[pos] != closing:
+        name = tokens[pos]
+        pos += 1
+        if tokens[pos] == ':':
+            pos += 1
+        if tokens[pos] in '{<':
+            value, pos = _parse_message(tokens, pos + 1, '}' if tokens[pos] == '{' else '>')
+            pos += 1
+        else:
+            value = _scalar(tokens[pos])
+            pos += 1
+            # Adjacent strings are concatenated
+            while pos < len(tokens) and isinstance(value, str) and tokens[pos][0] in '"\'':
+                value += _unquote(tokens[pos])
+                pos += 1
+        if pos < len(tokens) and tokens[pos] in ';,':
+            pos += 1
+
+        if name in REPEATED_FIELDS:
+            message.setdefault(name, []).append(value)
+        elif name in message:
+            previous = message[name]
+            message[name] = (previous if isinstance(previous, list) else [previous]) + [value]
+        else:
+            message[name] = value
+    return message, pos
+
+
+def parse_textproto(content):
+    """ Parses a protobuf message in text format (like METADATA.pb) without schema.
+
+    Nested messages become dictionaries, fields in REPEATED_FIELDS or fields that
+    occur more than once become lists.
+
+    Args:
+        content (str): The message in text format
+
+    Returns:
+        Dictionary: The parsed message
+    """
+    tokens = [match.group(1) for match in _TOKEN.finditer(content) if match.group(1)]
+    return _parse_message(tokens, 0)[0]
+
+
+def _load_metadata(metadata_path):
+    key = (os.path.normpath(metadata_path), os.stat(metadata_path).st_mtime_ns)
+    if key not in _metadata_cache:
+        with open(metadata_path, 'r', encoding='utf-8') as file:
+            message = parse_textproto(file.read())
+
+        general_info = {field: message[field] for field in FAMILY_FIELDS if field in message}
+        if 'name' in message:
+            general_info['family'] = message['name']
+        # Old files have a single category, the first one is the primary category
+        if general_info.get('category'):
+            general_info['categories'] = general_info['category']
+            general_info['category'] = general_info['category'][0]
+
+        fonts_info = {font_info.get('filename'): {**general_info,
+                                                  **{field: font_info[field] for field in FONT_FIELDS
+                                                     if field in font_info}}
+                      for font_info in message.get('fonts', [])}
+        _metadata_cache[key] = general_info, fonts_info
+    return _metadata_cache[key]
+
+
+def load_directory_metadata(metadata_path):
+    """ Parses a METADATA.pb file once and returns the metadata of every font file in it.
+
+    The result is cached per file (and modification time), so the file is not
+    parsed again for every font of the family.
+
+    Args:
+        metadata_path (str): Path to the METADATA.pb file
+
+    Returns:
+        Dictionary: Filename of the font as key and its metadata as value
+    """
+    return _load_metadata(metadata_path)[1]
+
+
 def parse_metadata(metadata_path, filename):
     """Parses the metadata file and extracts required fields."""
 
-    with open(metadata_path, 'r', encoding='utf-8') as file:
-        content = file.read()
-
-    general_info = {}
-
-    lines = content.split('\n')
-    for line in lines:
-        if line.startswith('license:'):
-            general_info['license'] = line.split(':')[1].strip().strip('"')
-        if line.startswith('category:'):
-            general_info['category'] = line.split(':')[1].strip().strip('"')
-        if line.startswith('subsets:'):
-            if 'subsets' not in general_info:
-                general_info['subsets'] = [
-                    line.split(':')[1].strip().strip('"')]
-            else:
-                general_info['subsets'].append(
-                    line.split(':')[1].strip().strip('"'))
-
-    specific_info = {}
-    fonts_data = re.findall(r'fonts \{(.*?)\}', content, re.DOTALL)
-    for font_data in fonts_data:
-        font_info = {}
-        for line in font_data.split('\n'):
-            if line.strip() and ':' in line:
-                key, value = line.split(':', 1)
-                # Speichern aller Schlüssel, aber später nur 'style' und 'weight' verwenden
-                font_info[key.strip()] = value.strip().strip('"')
-        if font_info.get('filename') == filename:
-            # Auswahl nur der spezifischen Informationen 'style' und 'weight'
-            specific_info = {k: v for k, v in font_info.items() if k in [
-                'style', 'weight']}
-            break
-
-    metadata = {**general_info, **specific_info}
-    return metadata
-
-
-def collectfonts():
+    general_info, fonts_info = _load_metadata(metadata_path)
+    # Font files that are not listed get the information about the family
+    return dict(fonts_info.get(filename, general_info))
+
+
+def variable_font_instances(font_file_path, mode='named', grid_steps=3):
+    """ Enumerates locations of a variable font.
+
+    Args:
+        font_file_path (str): Path to font file
+        mode (str, optional): 'named' for the named instances in fvar, 'grid' for a grid
+            of grid_steps values from minimum to maximum per axis. Defaults to 'named'.
+        grid_steps (int, optional): Values per axis in grid mode. Defaults to 3.
+
+    Returns:
+        list: Tuples (instance path, instance info with 'name' and 'location'). Empty for
+            static fonts or fonts that can't be read.
+    """
+    try:
+        font = fontcache.get_ttfont(font_file_path)
+        if 'fvar' not in font:
+            return []
+        fvar = font['fvar']
+    except Exception:
+        return []
+
+    if mode == 'named':
+        name_table = font['name'] if 'name' in font else None
+        locations = []
+        for instance in fvar.instances:
+            name = name_table.getDebugName(instance.subfamilyNameID) if name_table is not None else None
+            locations.append((name, dict(instance.coordinates)))
+    elif mode == 'grid':
+        axis_values = [[(axis.axisTag, float(value))
+                        for value in np.linspace(axis.minValue, axis.maxValue, grid_steps)]
+                       for axis in fvar.axes]
+        locations = [(None, dict(combination)) for combination in itertools.product(*axis_values)]
+    else:
+        raise ValueError(f"Unknown instance mode: {mode}")
+
+    instances = []
+    for name, location in locations:
+        path = fontcache.instance_path(os.path.normpath(font_file_path), location)
+        instances.append((path, {'name': name, 'location': location}))
+    return instances
+
+
+def collectfonts(variable_instances='named', grid_steps=3):
     """Goes through source directory and all subdirectories
     and writes a json file with all the font information.
 
+    Variable fonts are registered as one entry per instance (instance path
+    'font.ttf#wght=700', see fontcache.instance_path) instead of one entry
+    for the default instance.
+
+    Args:
+        variable_instances (str, optional): 'named' for the named instances, 'grid' for a
+            grid of axis locations, None to register variable fonts as a single entry.
+            Defaults to 'named'.
+        grid_steps (int, optional): Values per axis in grid mode. Defaults to 3.
     """
 
     source_directory = g.PATH_RAW
@@ -76,6 +216,7 @@ def collectfonts():
     file_ttf = 0
     file_otf = 0
     file_usable = 0
+    file_variable = 0
 
     fonts_metadata = {}
 
@@ -85,7 +226,10 @@ def collectfonts():
 
     # Search all folders and subfolders in source directory
     print("Collecting fonts...")
-    for root, _, files in os.walk(source_directory):
+    for root, dirs, files in os.walk(source_directory):
+        # The blobs of the content-addressed store are linked into the tree already
+        if os.path.normpath(root) == os.path.normpath(source_directory) and 'blobs' in dirs:
+            dirs.remove('blobs')
         for file in files:
             file_counter += 1
             if file.lower().endswith(tuple(FONTTYPES)):
@@ -107,7 +251,16 @@ def collectfonts():
                         font_info['metadata'] = parse_metadata(
                             metadata_path, file)
 
-                    fonts_metadata[normalized_filepath] = font_info
+                    instances = variable_font_instances(normalized_filepath, variable_instances, grid_steps) \
+                        if variable_instances is not None else []
+                    if instances:
+                        file_variable += 1
+                        file_usable += len(instances) - 1
+                    for path, instance in instances:
+                        fonts_metadata[path] = {**font_info, 'font_file': normalized_filepath,
+                                                'instance': instance}
+                    if not instances:
+                        fonts_metadata[normalized_filepath] = font_info
 
     # Write json
     os.makedirs(os.path.dirname(g.PATH_TO_JSON_FONT_DB), exist_ok=True)
@@ -119,6 +272,7 @@ def collectfonts():
     print(f"Fonts files: {file_ttf + file_otf}")
     print(f"- TTF files: {file_ttf}")
     print(f"- OTF files: {file_otf}")
+    print(f"- Variable fonts: {file_variable}")
     print(f"Usable files: {file_usable}")
 
 
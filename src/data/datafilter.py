@@ -1,8 +1,10 @@
+import json
 import os
+from contextlib import ExitStack
 from tqdm import tqdm
 from fontTools import ttLib
 from . import global_consts as g
-from . import datarenderer, fontdb_handler
+from . import datarenderer, fontdb_handler, fontcache, isolation, metrics, quarantine
 import numpy as np
 
 
@@ -20,16 +22,17 @@ def has_not_all_chars(font: ttLib.TTFont, chars_to_check: str, *args, **kwargs):
     return not chars_to_check.issubset(chars_in_font)
 
 
-def has_empty_glyphs(font_file_path, chars_to_check: str = None, *args, **kwargs):
+def has_empty_glyphs(font_file_path, chars_to_check: str = None, glyphs=None, *args, **kwargs):
+    # glyphs: chars_to_check rendered at size 2 and normalized, e.g. by a RenderPlan (see renderplan.py)
     if chars_to_check is None:
-        font = ttLib.TTFont(font_file_path)
+        font = fontcache.get_ttfont(font_file_path)
         chars_to_check = {chr(c) for c in font['cmap'].getBestCmap().keys()}
 
     try:
-        glyph_array = datarenderer.render_font(font_file_path,
-                                               chars=chars_to_check,
-                                               size=2,
-                                               normalize=True)
+        glyph_array = glyphs if glyphs is not None else datarenderer.render_font(font_file_path,
+                                                                                  chars=chars_to_check,
+                                                                                  size=2,
+                                                                                  normalize=True)
         glyph_array = 1. - glyph_array
         empty_entries = (np.sum(glyph_array, axis=(0, 1)) == 0)
         return np.any(empty_entries)
@@ -59,7 +62,7 @@ def out_of_bounds(font, bounds=(-0.4, -0.4, 1.8, 1.3), *args, **kwargs):
 
 def font_file_is_corrupted(font_file_path, *args, **kwargs):
     try:
-        font = ttLib.TTFont(font_file_path)
+        font = fontcache.get_ttfont(font_file_path)
         _ = font['cmap']
         cmap = font['cmap'].getBestCmap() # cmap is None if cmap is corrupted? Maybe a little picky, but ok for now.
         return cmap is None
@@ -83,6 +86,92 @@ def no_good_cmap(font, *args, **kwargs):
     return cmap is None
 
 
+def filter_font(font_file_path, required_chars, filter_funcs, glyphs=None):
+    """ Applies the filters to a single font.
+
+    Args:
+        font_file_path (str): Path to font file (ttf, otf)
+        required_chars (str): Characterset that is required for font to be considered complete.
+        filter_funcs (list): List of filters that are getting applied to the font.
+        glyphs (np.array, optional): required_chars rendered at size 2 and normalized.
+            Defaults to None: rendered when needed.
+
+    Returns:
+        tuple: Names of the filters that excluded the font ('corrupted_file' if the file
+            could not be read, empty if the font is usable) and the font database entry
+            with the filter results (None if the font is usable)
+    """
+    # Checking for common errors and exclude the font if it has one
+    # Check if file is corrupted
+    with metrics.timer('filter.font_file_is_corrupted', font=font_file_path):
+        is_corrupted = font_file_is_corrupted(font_file_path)
+    if is_corrupted:
+        return ['corrupted_file'], {'usable': False, 'filters': ['corrupted']}
+
+    font = fontcache.get_ttfont(font_file_path)
+    if glyphs is None and has_empty_glyphs in filter_funcs:
+        # Rendered once for the filter and the list of empty glyphs
+        try:
+            glyphs = datarenderer.render_font(font_file_path, chars=required_chars, size=2, normalize=True)
+        except Exception:
+            glyphs = None
+
+    kwargs = {'chars_to_check': required_chars,
+              'font': font,
+              'font_file_path': font_file_path,
+              'glyphs': glyphs}
+
+    excluded_by = []
+    entry = {}
+    for func in filter_funcs:
+        with metrics.timer(f'filter.{func.__name__}', font=font_file_path):
+            is_filtered = func(**kwargs)
+        if not is_filtered:
+            continue
+        excluded_by.append(func.__name__)
+        entry.setdefault("usable", False)
+        entry.setdefault("filters", []).append(str(func.__name__))
+
+        if func.__name__ == 'has_not_all_chars':
+            try:
+                chars_in_font = {chr(c) for c in font['cmap'].getBestCmap().keys()}
+                chars_missing = [c for c in required_chars if c not in chars_in_font]
+                # Carful: Here are only missing chars that we checked for. There might be more missing chars.
+                # A cmap can include 1000s of chars from different languages.
+                entry.setdefault('chars_not_in_font_cmap', chars_missing)
+            except OverflowError:
+                # TODO: Clarify if this is a problem futher down the line. Can this be fixed without excluding the font?
+                entry.setdefault("filters", []).append("Not all chars: OverflowError")
+        if func.__name__ == 'has_empty_glyphs':
+            try:
+                glyph_array = glyphs if glyphs is not None else datarenderer.render_font(font_file_path,
+                                                                                          chars=required_chars,
+                                                                                          size=2,
+                                                                                          normalize=True)
+                glyph_array = 1. - glyph_array
+                empty_entries = (np.sum(glyph_array, axis=(0, 1)) == 0)
+                empty_chars = [c for i, c in enumerate(required_chars) if empty_entries[i]]
+                entry.setdefault('chars_with_empty_glyphs', empty_chars)
+            except:
+                entry.setdefault("filters", []).append("Empty glyphs: Exception")
+
+    return excluded_by, (entry if excluded_by else None)
+
+
+def store_filter_results(filter_dictionary):
+    """ Writes filter results to the json font database and records the fonts
+        that can't be parsed in the failure registry.
+
+    Args:
+        filter_dictionary (Dictionary): Path of the font as key and its entry of filter results as value
+    """
+    fontdb_handler.write_filter_results(filter_dictionary)
+    # Fonts that can't be parsed are skipped by the renderer from now on
+    quarantine.record_failures({font_file_path: 'corrupted'
+                                for font_file_path, entry in filter_dictionary.items()
+                                if 'corrupted' in entry.get('filters', [])}, 'parse')
+
+
 def filter_fonts(required_chars="ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789ÄäÖöÜüß",
                  filter_funcs=[
                                 #cmap_is_corrupted,
@@ -90,132 +179,134 @@ def filter_fonts(required_chars="ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstu
                                 has_not_all_chars,
                                 has_empty_glyphs,
                                 out_of_bounds
-                 ]):
+                 ],
+                 metrics_path=None,
+                 profile_path=None,
+                 sample_profile=False,
+                 isolated=False,
+                 timeout=isolation.TIMEOUT,
+                 memory_limit_mb=isolation.MEMORY_LIMIT_MB,
+                 workers=None,
+                 font_file_paths=None,
+                 results_path=None,
+                 glyphs=None):
     """ Filters fonts in json font database and writes a log file with the results.
 
     Args:
         required_chars (str, optional): Characterset that is required for font to be considered complete. Defaults to "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789ÄäÖöÜüß".
         filter_funcs (list, optional): List of filters that are getting applied to fonts. Defaults to [ cmap_is_corrupted, no_good_cmap, has_not_all_chars, has_empty_glyphs, out_of_bounds ].
+        metrics_path (str, optional): JSON-lines file for timings per font and stage. Defaults to None.
+        profile_path (str, optional): Profile the run and write the profile to this file. Defaults to None.
+        sample_profile (bool, optional): Use the sampling profiler instead of cProfile. Defaults to False.
+        isolated (bool, optional): Filter every font in a worker process with a time and memory
+            limit (see isolation.py). Fonts that exceed a limit or crash the worker are excluded
+            with the filter 'timeout', 'memory_limit' or 'crashed'. Defaults to False.
+        timeout (float, optional): Wall-clock limit per font in seconds if isolated. Defaults to 60.
+        memory_limit_mb (int, optional): Memory limit per worker if isolated. Defaults to 4096.
+        workers (int, optional): Number of worker processes if isolated. Defaults to the number of CPUs.
+        font_file_paths (list, optional): Fonts to filter, e.g. a shard (see fontdb_handler.select_shard).
+            Defaults to None: all usable fonts of the database.
+        results_path (str, optional): Write the filter results and counts to this json file instead
+            of the database, e.g. the output of a shard (see shards.py). The log file is written
+            next to it. Defaults to None.
+        glyphs (Dictionary, optional): Path of the font as key and required_chars rendered at size 2
+            and normalized as value, e.g. from a RenderPlan shared with other stages (see renderplan.py).
+            Not used if isolated. Defaults to None: rendered per font.
 
     Returns:
         Dictionary: Returns dictionary with filter results.
     """
     
-    path_raw_dir = g.PATH_RAW
-    path_font_db_json = g.PATH_TO_JSON_FONT_DB
+    if metrics_path is not None:
+        metrics.configure(metrics_path)
+    with ExitStack() as profiling:
+        if profile_path is not None:
+            profiling.enter_context(metrics.sample_stacks(profile_path) if sample_profile
+                                    else metrics.profile(profile_path))
+
+        path_raw_dir = g.PATH_RAW
+        path_font_db_json = g.PATH_TO_JSON_FONT_DB
     
     
-    # with open(path_font_db_json, 'r', encoding='utf-8') as file:
-    #     font_db = json.load(file)
+        # with open(path_font_db_json, 'r', encoding='utf-8') as file:
+        #     font_db = json.load(file)
     
-    # Result of filtering is stored in a dictionary. At the end of this function,
-    # this dictionary is written to the json font database.    
-    filter_dictionary = {}
+        # Result of filtering is stored in a dictionary. At the end of this function,
+        # this dictionary is written to the json font database.    
+        filter_dictionary = {}
     
-    font_files_pathes = fontdb_handler.font_file_list()
-    #font_files_pathes = [font_db[font_path] for font_path in font_db.keys()]
-
-    filter_counter_dict = {}
-    filter_counter_dict['num_font_files_processed'] = len(font_files_pathes)
-    filter_counter_dict['num_usable_fonts'] = 0
-
-    # Writing a log file
-    num_log_file = 0
-    log_file_name = f'log_filter_fonts{num_log_file}.txt'
-    while os.path.exists(os.path.join(path_raw_dir, log_file_name)):
-        num_log_file += 1
-        log_file_name = f'log_filter_fonts{num_log_file}.txt'
-
-    with open(os.path.join(path_raw_dir, log_file_name), 'a', encoding='utf-8') as log_file:
-
-        for idx, font_file_path in tqdm(enumerate(font_files_pathes)):
-
-            log_file.write(f"{idx},{font_file_path},")
-            # Checking for common errors and exclude the font if it has one
-            # Check if file is corrupted
-            if font_file_is_corrupted(font_file_path):
-                log_file.write("EXCLUDED, corrupted file\n")
-                filter_counter_dict['corrupted_file'] = filter_counter_dict.get(
-                    'corrupted_file', 0) + 1
-                
-                if font_file_path not in filter_dictionary:
-                    filter_dictionary[font_file_path] = {}
-                filter_dictionary[font_file_path].setdefault(
-                    "usable", False)
-                filter_dictionary[font_file_path].setdefault(
-                        "filters", []).append("corrupted")
-                continue
-
-            font = ttLib.TTFont(font_file_path)
-
-
-            kwargs = {'chars_to_check': required_chars,
-                      'font': font,
-                      'font_file_path': font_file_path}
-
-            filtered = False
-            for func in filter_funcs:
-                if func(**kwargs):
-                    log_file.write(f"EXCLUDED, {func.__name__}\n")
-                    filter_counter_dict[func.__name__] = filter_counter_dict.get(
-                        func.__name__, 0) + 1
-                    filtered = True
-                    
-                    if font_file_path not in filter_dictionary:
-                        filter_dictionary[font_file_path] = {}
-                    
-                    filter_dictionary[font_file_path].setdefault(
-                        "usable", False)
-                    filter_dictionary[font_file_path].setdefault(
-                        "filters", []).append(str(func.__name__))
-
-                    if filtered and func.__name__ == 'has_not_all_chars':
-                        if font_file_path not in filter_dictionary:
-                            filter_dictionary[font_file_path] = {}
-                        
-                        try:
-                            chars_in_font = {chr(c) for c in font['cmap'].getBestCmap().keys()}
-                            chars_missing = [c for c in required_chars if c not in chars_in_font]
-                            # Carful: Here are only missing chars that we checked for. There might be more missing chars.
-                            # A cmap can include 1000s of chars from different languages.   
-                            filter_dictionary[font_file_path].setdefault('chars_not_in_font_cmap', chars_missing)
-                        except OverflowError:
-                            # TODO: Clarify if this is a problem futher down the line. Can this be fixed without excluding the font?
-                            filter_dictionary[font_file_path].setdefault(
-                                "filters", []).append("Not all chars: OverflowError")
-                    if filtered and func.__name__ == 'has_empty_glyphs':
-                        if font_file_path not in filter_dictionary:
-                            filter_dictionary[font_file_path] = {}                        
-                        
-                        
-                        try:
-                            glyph_array = datarenderer.render_font(font_file_path,
-                                                                   chars=required_chars,
-                                                                   size=2,
-                                                                   normalize=True)
-                            glyph_array = 1. - glyph_array
-                            empty_entries = (np.sum(glyph_array, axis=(0, 1)) == 0)
-                            empty_chars = [c for i, c in enumerate(required_chars) if empty_entries[i]]
-                            filter_dictionary[font_file_path].setdefault('chars_with_empty_glyphs', empty_chars)
-                        except:
-                            filter_dictionary[font_file_path].setdefault("filters", []).append("Empty glyphs: Exception")
-                # else:
-                #     filter_detail_dictionary[func.__name__] = False
-            if filtered:
-                continue
-
-            log_file.write("INCLUDED\n")
-            filter_counter_dict['num_usable_fonts'] = filter_counter_dict['num_usable_fonts'] + 1
+        font_files_pathes = fontdb_handler.font_file_list() if font_file_paths is None else list(font_file_paths)
+        #font_files_pathes = [font_db[font_path] for font_path in font_db.keys()]
+
+        filter_counter_dict = {}
+        filter_counter_dict['num_font_files_processed'] = len(font_files_pathes)
+        filter_counter_dict['num_usable_fonts'] = 0
+
+        if isolated:
+            results = isolation.run_isolated(filter_font, font_files_pathes,
+                                             args=(required_chars, filter_funcs),
+                                             timeout=timeout,
+                                             memory_limit_mb=memory_limit_mb,
+                                             workers=workers)
+        else:
+            results = [None] * len(font_files_pathes)
+
+        # Writing a log file
+        if results_path is not None:
+            log_file_path = os.path.splitext(results_path)[0] + '.log'
+        else:
+            num_log_file = 0
+            log_file_name = f'log_filter_fonts{num_log_file}.txt'
+            while os.path.exists(os.path.join(path_raw_dir, log_file_name)):
+                num_log_file += 1
+                log_file_name = f'log_filter_fonts{num_log_file}.txt'
+            log_file_path = os.path.join(path_raw_dir, log_file_name)
+
+        with open(log_file_path, 'a', encoding='utf-8') as log_file:
+
+            for idx, font_file_path in tqdm(enumerate(font_files_pathes), disable=isolated):
+                log_file.write(f"{idx},{font_file_path},")
+                if isolated:
+                    result = results[idx]
+                    metrics.record('filter_font', result['seconds'], font=font_file_path,
+                                   status=result['status'])
+                    if result['status'] != 'ok':
+                        # The font hung, crashed or raised: it gets the verdict as filter
+                        log_file.write(f"EXCLUDED, {result['status']} ({result['error']})\n")
+                        filter_counter_dict[result['status']] = filter_counter_dict.get(result['status'], 0) + 1
+                        filter_dictionary[font_file_path] = isolation.verdict_entry(result)
+                        continue
+                    excluded_by, entry = result['result']
+                else:
+                    with metrics.timer('filter_font', font=font_file_path):
+                        excluded_by, entry = filter_font(font_file_path, required_chars, filter_funcs,
+                                                         glyphs=(glyphs or {}).get(font_file_path))
+
+                for name in excluded_by:
+                    log_file.write("EXCLUDED, corrupted file\n" if name == 'corrupted_file'
+                                   else f"EXCLUDED, {name}\n")
+                    filter_counter_dict[name] = filter_counter_dict.get(name, 0) + 1
+                if entry is not None:
+                    filter_dictionary[font_file_path] = entry
+                    continue
+
+                log_file.write("INCLUDED\n")
+                filter_counter_dict['num_usable_fonts'] = filter_counter_dict['num_usable_fonts'] + 1
             
-        log_file.write("\n\nFilter results:\n")
-        for key, value in filter_counter_dict.items():
-            log_file.write(f"{key}: {value}\n")
+            log_file.write("\n\nFilter results:\n")
+            for key, value in filter_counter_dict.items():
+                log_file.write(f"{key}: {value}\n")
+            log_file.write(f"font cache: {fontcache.cache_stats()}\n")
             
-        # Write filter results to json font database
-        fontdb_handler.write_filter_results(filter_dictionary)
+            if results_path is not None:
+                with open(results_path, 'w', encoding='utf-8') as file:
+                    json.dump({'filter_results': filter_dictionary, 'counts': filter_counter_dict}, file, indent=4)
+            else:
+                store_filter_results(filter_dictionary)
 
+    metrics.write_summary(run='filter_fonts', **filter_counter_dict)
     print(
-        f"Processed {idx+1} fonts. Found {filter_counter_dict['num_usable_fonts']} usable fonts.")
+        f"Processed {len(font_files_pathes)} fonts. Found {filter_counter_dict['num_usable_fonts']} usable fonts.")
     return filter_counter_dict
 
 
@@ -230,7 +321,7 @@ def analyse_font_file(
     filter_dictionary = {}
 
     try:
-        font = ttLib.TTFont(font_file)
+        font = fontcache.get_ttfont(font_file)
     except:
         return "Corrupted file! File could not be opened."
     try:
@@ -1,6 +1,9 @@
+import json
+import os
 import numpy as np
-from PIL import Image, ImageFont, ImageDraw
+from PIL import Image, ImageDraw
 import matplotlib.pyplot as plt
+from . import fontcache, isolation, metrics, quarantine
 
 
 def render_font(font_path, 
@@ -25,17 +28,19 @@ def render_font(font_path,
     """
     font_size = int(0.7*size)
     text_start = (int(0.15*size), int(0.15*size))
-    font = ImageFont.truetype(font_path, font_size)
+    font = fontcache.get_freetype_font(font_path, font_size)
     # Reserve memory for the arrays
     arrays = np.empty((size, size, len(chars)))
     
-    for idx, char in enumerate(chars):
-        # Modes: 1 (1-bit pixels, black and white, stored with one pixel per byte)
-        #        L (8-bit pixels, black and white)
-        image = Image.new('L', (size, size), 255)
-        draw = ImageDraw.Draw(image)
-        draw.text(text_start, char, font=font, fill=0)
-        arrays[:, :, idx] = np.array(image)
+    with metrics.timer('render', font=font_path, size=size, num_chars=len(chars)):
+        for idx, char in enumerate(chars):
+            # Modes: 1 (1-bit pixels, black and white, stored with one pixel per byte)
+            #        L (8-bit pixels, black and white)
+            image = Image.new('L', (size, size), 255)
+            draw = ImageDraw.Draw(image)
+            draw.text(text_start, char, font=font, fill=0)
+            arrays[:, :, idx] = np.array(image)
+    metrics.count('glyphs_rendered', len(chars))
 
     if normalize:
         arrays = arrays / 255.
@@ -52,61 +57,280 @@ def render_fonts(font_file_paths: list,
                  chars: str="ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789ÄäÖöÜüß",
                  normalize: bool=False,
                  invert: bool=False,
-                 dtype=np.float16):
+                 dtype=np.float16,
+                 isolated: bool=False,
+                 timeout: float=isolation.TIMEOUT,
+                 memory_limit_mb: int=isolation.MEMORY_LIMIT_MB,
+                 workers: int=None,
+                 use_registry: bool=True,
+                 return_mask: bool=False,
+                 compact: bool=False):
     """
     Renders glyphs of multiple fonts as a numpy array.
+
+    Rows of fonts that could not be rendered are left blank (background color).
+    Failures are recorded in the failure registry next to the font database,
+    and fonts that keep failing are skipped up front (see quarantine.py).
     
     Args:
         font_file_paths (list): List of font file paths
         size (int, optional): Size of the image (size x size). Defaults to 64.
         chars (str, optional): Characters to render. Defaults to "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789ÄäÖöÜüß".
         normalize (bool, optional): Normalize the array. Defaults to False.
+        isolated (bool, optional): Render every font in a worker process with a time and
+            memory limit (see isolation.py). Defaults to False.
+        timeout (float, optional): Wall-clock limit per font in seconds if isolated. Defaults to 60.
+        memory_limit_mb (int, optional): Memory limit per worker if isolated. Defaults to 4096.
+        workers (int, optional): Number of worker processes if isolated. Defaults to the number of CPUs.
+        use_registry (bool, optional): Skip quarantined fonts and record failures. Defaults to True.
+        return_mask (bool, optional): Also return a boolean array that is True for the
+            fonts that were rendered. Defaults to False.
+        compact (bool, optional): Drop the rows of fonts that were not rendered and also
+            return the indices of the rendered fonts in font_file_paths. Defaults to False.
     
     Returns:
-        np.array: Array of shape (len(font_file_paths), size, size, len(chars))
+        np.array: Array of shape (len(font_file_paths), size, size, len(chars)),
+            followed by the mask if return_mask, or
+            array of shape (num_rendered, size, size, len(chars)) and the indices if compact
     """
-    # reserve memory for the arrays
-    arrays = np.empty((len(font_file_paths), size, size, len(chars))).astype(dtype)
-
-    for idx, font_file_path in enumerate(font_file_paths):
-        try:
-            arrays[idx, :, :, :] = render_font(font_file_path, size, chars, normalize, invert, dtype)
-        except Exception as e:
-            print(f"Error while rendering font {font_file_path}: {e}")
+    background = 0. if invert else (1. if normalize else 255.)
+    arrays = np.full((len(font_file_paths), size, size, len(chars)), background, dtype=dtype)
+    valid = np.zeros(len(font_file_paths), dtype=bool)
+    errors = {}
+
+    use_registry = use_registry and quarantine.registry_available()
+    config = quarantine.render_config(size)
+    skipped = quarantine.known_bad(font_file_paths, config) if use_registry else set()
+    if skipped:
+        metrics.count('render_quarantined', len(skipped))
+        print(f"Skipping {len(skipped)} quarantined fonts")
+    todo = [idx for idx, font_file_path in enumerate(font_file_paths) if font_file_path not in skipped]
+
+    if isolated:
+        results = isolation.run_isolated(render_font, [font_file_paths[idx] for idx in todo],
+                                         args=(size, chars, normalize, invert, dtype),
+                                         timeout=timeout,
+                                         memory_limit_mb=memory_limit_mb,
+                                         workers=workers,
+                                         progress=False)
+        for idx, result in zip(todo, results):
+            if result['status'] == 'ok':
+                arrays[idx, :, :, :] = result['result']
+                valid[idx] = True
+            else:
+                metrics.count(f"render_{result['status']}")
+                errors[font_file_paths[idx]] = f"{result['status']} ({result['error']})"
+    else:
+        for idx in todo:
+            try:
+                arrays[idx, :, :, :] = render_font(font_file_paths[idx], size, chars, normalize, invert, dtype)
+                valid[idx] = True
+            except Exception as e:
+                errors[font_file_paths[idx]] = f"{type(e).__name__}: {e}"
+
+    for font_file_path, error in errors.items():
+        metrics.count('render_errors')
+        print(f"Error while rendering font {font_file_path}: {error}")
+    if use_registry:
+        quarantine.record_failures(errors, config)
+
+    if compact:
+        indices = np.flatnonzero(valid)
+        return arrays[indices], indices
+    if return_mask:
+        return arrays, valid
     return arrays
 
+GLYPH_FORMATS = ('uint8', 'bits')
+INK_THRESHOLD = 128
+
+
+def encode_glyphs(arrays, glyph_format: str='uint8', threshold: int=INK_THRESHOLD):
+    """ Encodes rendered glyphs (0-255, not inverted) for storage and transport.
+
+    'uint8' keeps the anti-aliased values (2x smaller than float16), 'bits'
+    thresholds the glyphs and packs 8 pixels per byte (16x smaller than float16).
+
+    Args:
+        arrays (np.array): Glyphs of shape (..., size, size, num_chars)
+        glyph_format (str, optional): One of GLYPH_FORMATS. Defaults to 'uint8'.
+        threshold (int, optional): Pixels below are ink for 'bits'. Defaults to 128.
+
+    Returns:
+        np.array: uint8 array of shape (..., size, size, num_chars) for 'uint8' or
+            (..., ceil(size * size * num_chars / 8)) for 'bits', a set bit is ink
+    """
+    if glyph_format == 'uint8':
+        return np.asarray(arrays).astype(np.uint8)
+    if glyph_format == 'bits':
+        arrays = np.asarray(arrays)
+        # The explicit length also works for zero fonts, where -1 is ambiguous
+        ink = arrays.reshape(*arrays.shape[:-3], int(np.prod(arrays.shape[-3:]))) < threshold
+        return np.packbits(ink, axis=-1)
+    raise ValueError(f"Unknown glyph format: {glyph_format}")
+
+
+def decode_glyphs(encoded, glyph_format: str, shape, dtype=np.float32):
+    """ Decodes glyphs of encode_glyphs to normalized values (0 ink, 1 background).
+
+    Args:
+        encoded (np.array): Result of encode_glyphs
+        glyph_format (str): One of GLYPH_FORMATS
+        shape (tuple): Shape of one sample (size, size, num_chars)
+        dtype (np.dtype, optional): Data type of the result. Defaults to np.float32.
+
+    Returns:
+        np.array: Array of shape (..., size, size, num_chars)
+    """
+    if glyph_format == 'uint8':
+        return (encoded / 255.).astype(dtype)
+    if glyph_format == 'bits':
+        ink = np.unpackbits(encoded, axis=-1, count=int(np.prod(shape)))
+        return (1 - ink).astype(dtype).reshape(*encoded.shape[:-1], *shape)
+    raise ValueError(f"Unknown glyph format: {glyph_format}")
+
+
+def load_dataset(path, mmap_mode='r'):
+    """ Loads a dataset written by export_dataset.
+
+    Args:
+        path (str): Output path of export_dataset, without extension
+        mmap_mode (str, optional): Memory map the glyphs, see np.load. Defaults to 'r'.
+
+    Returns:
+        tuple: Encoded glyphs and the info (chars, size, format, shape, font_file_paths)
+    """
+    with open(path + '.json', 'r', encoding='utf-8') as file:
+        info = json.load(file)
+    info.setdefault('format', 'uint8')
+    info.setdefault('shape', [info['size'], info['size'], len(info['chars'])])
+    return np.load(path + '.npy', mmap_mode=mmap_mode), info
+
+
+def export_dataset(font_file_paths, output_path, size: int=64,
+                   chars: str="ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789ÄäÖöÜüß",
+                   isolated: bool=False, workers: int=None, glyph_format: str='uint8', glyphs=None):
+    """ Renders fonts and saves the glyphs for training.
+
+    Writes <output_path>.npy with the glyphs encoded by encode_glyphs (one row
+    per rendered font) and <output_path>.json with the paths of the rendered
+    fonts, the chars, the format and the shape of a sample. See load_dataset.
+
+    glyphs can pass the uint8 glyphs of the rendered fonts and their indices in
+    font_file_paths, e.g. from a RenderPlan shared with other stages (see renderplan.py).
+
+    Returns:
+        int: Number of rendered fonts
+    """
+    font_file_paths = list(font_file_paths)
+    if glyphs is None:
+        glyphs = render_fonts(font_file_paths, size=size, chars=chars, dtype=np.uint8,
+                              isolated=isolated, workers=workers, compact=True)
+    arrays, indices = glyphs
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    np.save(output_path + '.npy', encode_glyphs(arrays, glyph_format))
+    with open(output_path + '.json', 'w', encoding='utf-8') as file:
+        json.dump({'chars': chars, 'size': size, 'format': glyph_format, 'shape': [size, size, len(chars)],
+                   'font_file_paths': [font_file_paths[idx] for idx in indices]},
+                  file, indent=1, ensure_ascii=False)
+    return len(indices)
+
+
+def glyph_mosaic(tiles, num_cols: int, padding: int=2, pad_value=255):
+    """
+    Composes a list of glyph images into a single image (contact sheet).
+
+    Tiles are placed row by row. Tiles of different sizes are padded to the
+    size of the largest tile.
+
+    Args:
+        tiles (list or np.array): 2D arrays or an array of shape (num_tiles, height, width)
+        num_cols (int): Number of tiles per row
+        padding (int, optional): Pixels between the tiles. Defaults to 2.
+        pad_value (optional): Value of the padding pixels. Defaults to 255.
+
+    Returns:
+        np.array: Array of shape (num_rows * (height + padding) - padding, num_cols * (width + padding) - padding)
+    """
+    # Channels (e.g. RGB or a trailing axis of size 1) are averaged to grayscale
+    tiles = [np.asarray(tile) if np.ndim(tile) == 2 else np.asarray(tile).mean(axis=-1)
+             for tile in tiles]
+    num_tiles = len(tiles)
+    num_rows = int(np.ceil(num_tiles / num_cols))
+    height = max(tile.shape[0] for tile in tiles) + padding
+    width = max(tile.shape[1] for tile in tiles) + padding
+
+    canvas = np.full((num_rows * num_cols, height, width), pad_value,
+                     dtype=np.result_type(*tiles))
+    for idx, tile in enumerate(tiles):
+        canvas[idx, :tile.shape[0], :tile.shape[1]] = tile
+
+    canvas = canvas.reshape(num_rows, num_cols, height, width).transpose(0, 2, 1, 3)
+    canvas = canvas.reshape(num_rows * height, num_cols * width)
+    return canvas[:canvas.shape[0] - padding, :canvas.shape[1] - padding]
+
+
+def save_mosaic(mosaic, path, value_range=(0., 255.)):
+    """
+    Writes a mosaic as grayscale PNG without going through matplotlib.
+
+    Args:
+        mosaic (np.array): 2D array, e.g. from glyph_mosaic
+        path (str): Path of the PNG file
+        value_range (tuple, optional): Values mapped to black and white. Defaults to (0., 255.).
+    """
+    low, high = value_range
+    image = (np.asarray(mosaic, dtype=np.float32) - low) / (high - low)
+    image = np.clip(image * 255., 0, 255).astype(np.uint8)
+    Image.fromarray(image, mode='L').save(path)
+
+
 def plot_glyphs(font_file_paths,
                 size: int=64,
                 chars: str="Äß",
                 figsize=(20, 20),
-                show_index: bool=False):
+                show_index: bool=False,
+                save_path: str=None):
     """
     Plots the same glyphs of different fonts.
 
+    All fonts are rendered once and every char is shown as a single mosaic image.
+
     Args:
         font_file_paths (list): List of font file paths
         size (int, optional): Size of the image (size x size). Defaults to 64.
         chars (str, optional): Characters to render. Defaults to "Äß".
         figsize (tuple, optional): Size of the figure. Defaults to (20, 20).
+        show_index (bool, optional): Show the index of the font on each glyph. Defaults to False.
+        save_path (str, optional): If set, the mosaics are written as PNG files
+            '<save_path>_<index of char>.png' instead of being plotted. Defaults to None.
 
     Returns:
         None
     """
     num_fonts = len(font_file_paths)
     size_port_grid = int(np.ceil(np.sqrt(num_fonts)))
+    padding = 2
+
+    arrays = render_fonts(font_file_paths, size, chars)
+
+    for idx_char in range(len(chars)):
+        mosaic = glyph_mosaic(arrays[:, :, :, idx_char], size_port_grid, padding=padding)
+
+        if save_path is not None:
+            save_mosaic(mosaic, f"{save_path}_{idx_char}.png")
+            continue
+
+        fig, ax = plt.subplots(figsize=figsize)
+        ax.imshow(mosaic, cmap='gray')
+        #turing the axis ticks off
+        ax.set_xticks([])
+        ax.set_yticks([])
+        if show_index:
+            for idx in range(num_fonts):
+                ax.text((idx % size_port_grid) * (size + padding),
+                        (idx // size_port_grid) * (size + padding),
+                        str(idx), va='top', color='red')
 
-    for char in chars:
-        fig, ax = plt.subplots(size_port_grid, 
-                               size_port_grid, 
-                               figsize=figsize)
-
-        for idx, font_file_path in enumerate(font_file_paths):
-            font_array = render_font(font_file_path, size, char)
-            ax[idx // size_port_grid, idx % size_port_grid].imshow(font_array[:, :, 0], cmap='gray')
-            #turing the axis ticks off
-            ax[idx // size_port_grid, idx % size_port_grid].set_xticks([])
-            ax[idx // size_port_grid, idx % size_port_grid].set_yticks([])
-            if show_index:
-                ax[idx // size_port_grid, idx % size_port_grid].set_title(idx)
-
-        plt.show()
\ No newline at end of file
+        plt.show()
@@ -1,22 +1,28 @@
 """This module provides functions to download font libraries from github repositories."""
 import os
-import subprocess
 import json
 import re
 from concurrent.futures import ThreadPoolExecutor
 import requests
 from . import global_consts as g
+from . import blobstore, fontdb_handler, gitfetch, metrics
 
 
 GLYZPHAZZN_URL = 'https://storage.googleapis.com/magentadata/models/svg_vae/glyphazzn_urls.txt'
 
 
-def get_font_dbs(db_flags):
-    """ Prepare the download of font libraries from github repositories.
+def get_font_dbs(db_flags, max_concurrent=4, depth=1, partial=True):
+    """ Fetch the enabled font libraries from their github repositories concurrently
+        (see gitfetch.py).
 
     Args:
         db_flags (Dictionary): Sets flags to download specific databases
+        max_concurrent (int, optional): Repositories fetched at the same time. Defaults to 4.
+        depth (int, optional): Commits to fetch, None for the full history. Defaults to 1.
+        partial (bool, optional): Fetch only the blobs of the sparse-checkout directories. Defaults to True.
 
+    Returns:
+        Dictionary: Name of the database as key and the report of gitfetch.fetch_repos as value
     """
 
     path_target = g.PATH_RAW
@@ -26,20 +32,26 @@ def get_font_dbs(db_flags):
     with open(database_config, 'r') as infile:
         databases = json.load(infile)
 
-    for key, value in db_flags.items():
-        if (key in databases) and (value):
-            get_github_db(path_target,
-                          key,
-                          databases[key]['url'],
-                          databases[key]['directories'],
-                          databases[key]['private'])
+    repos = [{'name': key,
+              'url': databases[key]['url'],
+              'directories': databases[key]['directories'],
+              'private': databases[key]['private']}
+             for key, value in db_flags.items() if (key in databases) and (value)]
+    reports = gitfetch.fetch_repos(repos, path_target, max_concurrent=max_concurrent,
+                                   depth=depth, partial=partial)
+    for db_name, report in reports.items():
+        if report['status'] == 'ok':
+            print(f"{db_name}: {report['commit'][:12]}, {report['bytes'] / 2**20:.1f} MiB "
+                  f"in {report['seconds']:.1f}s")
+        else:
+            print(f"{db_name}: Error: {report['error']}")
+    return reports
 
 
 def get_github_db(path_target, db_name, repo_url, directory_list=None, private=False):
-    """ Get font libraries from github repositories by cloning
-        or fetching data. To make sure that locally deleted files
-        are pulled from the remote repository, the local repository
-        is resetted to the remote repository.
+    """ Get font libraries from github repositories by fetching the head of main.
+        To make sure that locally deleted files are pulled from the remote
+        repository, the checkout is forced to the fetched commit.
 
     Args:
         path_target (String): Path to the target directory
@@ -48,72 +60,10 @@ def get_github_db(path_target, db_name, repo_url, directory_list=None, private=F
         directory_list (list, optional): Selected directories. Defaults to None
         private (bool, optional): Flag if the repository is private. Defaults to False
     """
-
-    print(f"Accessing {db_name}.")
-
-    path_db = os.path.join(path_target, db_name)
-
-    # Check if target directory already exists
-    if not os.path.isdir(path_db):
-        os.makedirs(path_db)
-
-    # Prepare SSH key for private repositories
-    env = None
-    if private:
-        env = os.environ.copy()
-        ssh_key_path = os.path.join(path_target, db_name + "_key")
-        env["GIT_SSH_COMMAND"] = f"ssh -i {ssh_key_path}"
-        print("Loaded key for repository access.")
-
-    # Check if target directory is already a git repository
-    # if not, initialize it
-    is_repo_initialized = os.path.isdir(os.path.join(path_db, '.git'))
-    if not is_repo_initialized:
-        print("Initializing Repo")
-        subprocess.run(['git', 'init', path_db], check=True)
-        subprocess.run(['git', 'config', 'core.sparseCheckout', 'true'],
-                       cwd=path_db,
-                       check=True)
-
-    # Check if a remote repository exists
-    # if not, add it
-    existing_remotes = subprocess.check_output(
-        ['git', 'remote'], cwd=path_db).decode().split()
-    if 'origin' not in existing_remotes:
-        print("Füge Remote hinzu")
-        subprocess.run(['git', 'remote', 'add', '-f', 'origin', repo_url],
-                       cwd=path_db,
-                       check=True,
-                       env=env)
-
-    # If only specific directories should be cloned or updated,
-    # write the sparse checkout configuration file
-    if len(directory_list) != 0:
-        with open(os.path.join(path_db, '.git', 'info', 'sparse-checkout'), 'w') as file:
-            for directory in directory_list:
-                file.write(directory + '\n')
-        print(f"{len(directory_list)} directories for transfer.")
-
-    # Execution:
-    # Always do fetch and checkout
-    # Do hard reset of local repo only if repo was already initialized
-    try:
-        print("Transferring files...")
-        subprocess.run(['git', 'fetch', 'origin', 'main'],
-                       cwd=path_db,
-                       check=True,
-                       env=env)
-
-        if is_repo_initialized:
-            subprocess.run(['git', 'reset', '--hard', 'origin/main'],
-                           cwd=path_db,
-                           check=True)
-
-        subprocess.run(['git', 'checkout', 'origin/main'],
-                       cwd=path_db, check=True)
-        print("File transfer successful")
-    except subprocess.CalledProcessError as e:
-        print(f"Error: {e}")
+    report = gitfetch.fetch_repos([{'name': db_name, 'url': repo_url, 'directories': directory_list,
+                                    'private': private}], path_target, max_concurrent=1)[db_name]
+    if report['status'] != 'ok':
+        print(f"Error: {report['error']}")
 
 
 def update_glyphazzn_list():
@@ -180,10 +130,16 @@ def extract_urls(path_textfile, filename, path_target):
     print(f"{filename} successfully extracted.")
 
 
-def download_files_from_txts():
+def download_files_from_txts(workers=10, shard=None, store=None):
     """ Cycle through all txt files in a directory and queue the
         files for parallel download.
 
+    Args:
+        workers (int, optional): Parallel downloads. Defaults to 10.
+        shard (str, optional): Only download the URLs of a shard 'i/N'
+            (see fontdb_handler.select_shard). Defaults to None: all URLs.
+        store (BlobStore, optional): Blob store, the caller saves its index. Defaults to None:
+            the default store, saved after every list.
     """
 
     path_source = g.PATH_URL_LISTS
@@ -196,7 +152,8 @@ def download_files_from_txts():
                 destination_dir = os.path.join(path_target, file[:-4])
 
                 urls = extract_list_from_txt(os.path.join(path_source, file))
-                download_fonts_in_parallel(urls, destination_dir)
+                urls = fontdb_handler.select_shard([url for url in urls if url], shard)
+                download_fonts_in_parallel(urls, destination_dir, workers, store)
 
 
 def extract_list_from_txt(path_sourcefile):
@@ -216,48 +173,65 @@ def extract_list_from_txt(path_sourcefile):
     return urls
 
 
-def download_fonts_in_parallel(urls, path_target):
+def download_fonts_in_parallel(urls, path_target, workers=10, store=None):
     """ Set up a thread pool to download files in parallel.
 
     Args:
         urls (list): URLs to download
         path_target (String): Path to download directory
+        workers (int, optional): Parallel downloads. Defaults to 10.
+        store (BlobStore, optional): Blob store, the caller saves its index. Defaults to None:
+            the default store, saved after the downloads.
     """
     if not os.path.exists(path_target):
         os.makedirs(path_target)
 
     print(f"Checking {len(urls)} URLs...")
-    with ThreadPoolExecutor(max_workers=10) as executor:
+    save_store = store is None
+    if store is None:
+        store = blobstore.BlobStore()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
         for url in urls:
-            executor.submit(download_from_list, url, path_target)
+            executor.submit(download_from_list, url, path_target, store)
+    if save_store:
+        store.save()
     # print(f"Downloaded {total_downloaded} files.")
 
 
-def download_from_list(url_list, path_target):
+def download_from_list(url_list, path_target, store=None):
     """ Download files from a list of URLs.
 
+    The files are stored in the content-addressed blob store and hardlinked into
+    the target directory. A different file with the same name gets the short
+    content ID appended instead of being overwritten.
+
     Args:
         url (list): List of URLs
         path_target (String): Path to the target directory
+        store (BlobStore, optional): Blob store, the caller saves its index. Defaults to None:
+            the default store, saved after the download.
     """
 
     files_downloaded = 0
+    save_store = store is None
+    if store is None:
+        store = blobstore.BlobStore()
 
     # if url_list is a list
     if isinstance(url_list, list):
         files_downloaded = 0
         for url in url_list:
             try:
-                response = requests.get(url, timeout=1)
+                with metrics.timer('download', url=url):
+                    response = requests.get(url, timeout=1)
                 if response.status_code == 200:
-                    font_file_name = os.path.basename(url)
-                    font_file_name_path = os.path.join(
-                        path_target, font_file_name)
-                    with open(font_file_name_path, 'wb') as f:
-                        f.write(response.content)
-                        files_downloaded += 1
+                    content_id = store.put_bytes(response.content, url)
+                    store.checkout(content_id, path_target, os.path.basename(url))
+                    files_downloaded += 1
+                    metrics.count('download_bytes', len(response.content))
 
                 else:
+                    metrics.count('download_errors')
                     pass  # print(f"URL not reachable: {url}")
             except FileNotFoundError:  # Exception as e:
                 pass  # print(f"Error processing {url}: {e}")
@@ -266,14 +240,15 @@ def download_from_list(url_list, path_target):
     # if url_list is a string (single url)
     elif isinstance(url_list, str):
         try:
-            response = requests.get(url_list, stream=True, timeout=2)
-            response.raise_for_status()
-            filename = os.path.basename(url_list)
-            filepath = os.path.join(path_target, filename)
-
-            with open(filepath, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+            with metrics.timer('download', url=url_list):
+                response = requests.get(url_list, stream=True, timeout=2)
+                response.raise_for_status()
+                content = b''.join(chunk for chunk in response.iter_content(chunk_size=8192) if chunk)
+                metrics.count('download_bytes', len(content))
+                content_id = store.put_bytes(content, url_list)
+                store.checkout(content_id, path_target, os.path.basename(url_list))
         except FileNotFoundError:
             pass
+
+    if save_store:
+        store.save()
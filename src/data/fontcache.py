@@ -0,0 +1,223 @@
+""" Shared cache for parsed font files and sized FreeType handles.
+
+The data modules open the same font files over and over again (filtering,
+rendering, plotting, CLIP classification). This module keeps a size-bounded
+LRU cache of parsed fontTools ``TTFont`` objects and PIL ``FreeTypeFont``
+handles so that a font is only parsed once per process.
+
+Cache entries are keyed by the normalized path and the modification time of
+the file, so a font that is replaced on disk is parsed again.
+
+Named instances and other locations of variable fonts are addressed by
+instance paths 'font.ttf#wght=700,wdth=75' (see instance_path). FreeType
+handles of instance paths have the variation set, fontTools objects are
+the default instance of the file.
+"""
+
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from fontTools import ttLib
+from PIL import ImageFont
+from . import metrics
+
+MAX_TTFONTS = 256
+MAX_FREETYPE_FONTS = 1024
+INSTANCE_SEPARATOR = '#'
+_AXIS_VALUE = r'[A-Za-z0-9 ]{1,4}=[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+_INSTANCE_PATTERN = re.compile(rf'(.*){INSTANCE_SEPARATOR}({_AXIS_VALUE}(?:,{_AXIS_VALUE})*)', re.DOTALL)
+
+
+class LRUCache:
+    """ Thread-safe, size-bounded least-recently-used cache with hit/miss counters. """
+
+    def __init__(self, maxsize, on_evict=None):
+        """
+        Args:
+            maxsize (int): Maximum number of entries kept in the cache.
+            on_evict (callable, optional): Called with every evicted value. Defaults to None.
+        """
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        # Futures of the keys whose factory is running
+        self._pending = {}
+        self._lock = threading.RLock()
+
+    def get(self, key, factory):
+        """ Returns the cached value for key or creates it with factory().
+
+        The factory runs outside the lock, so different keys are created in
+        parallel. Concurrent calls for the same key wait for the first one.
+        Exceptions raised by the factory are not cached.
+        """
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            future = self._pending.get(key)
+            is_owner = future is None
+            if is_owner:
+                self.misses += 1
+                future = self._pending[key] = Future()
+            else:
+                self.hits += 1
+        if not is_owner:
+            return future.result()
+
+        try:
+            value = factory()
+        except BaseException as e:
+            with self._lock:
+                del self._pending[key]
+            future.set_exception(e)
+            raise
+        evicted = []
+        with self._lock:
+            del self._pending[key]
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                evicted.append(self._data.popitem(last=False)[1])
+        future.set_result(value)
+        if self.on_evict is not None:
+            for value_evicted in evicted:
+                self.on_evict(value_evicted)
+        return value
+
+    def clear(self):
+        """ Removes all entries and resets the counters. """
+        with self._lock:
+            while self._data:
+                _, evicted = self._data.popitem(last=False)
+                if self.on_evict is not None:
+                    self.on_evict(evicted)
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """ Returns a dictionary with size and hit/miss counters. """
+        with self._lock:
+            return {'size': len(self._data),
+                    'maxsize': self.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+    def __len__(self):
+        return len(self._data)
+
+
+# The files of parsed fonts are closed right after parsing (see get_ttfont),
+# evicted fonts need no cleanup.
+_ttfonts = LRUCache(MAX_TTFONTS)
+_freetype_fonts = LRUCache(MAX_FREETYPE_FONTS)
+
+
+def instance_path(font_file_path, location):
+    """ Returns the path that addresses a location of a variable font.
+
+    Args:
+        font_file_path (str): Path to the variable font file
+        location (Dictionary): Axis tag as key and axis value as value, e.g. {'wght': 700}
+
+    Returns:
+        str: Instance path, e.g. 'font.ttf#wght=700'
+    """
+    return font_file_path + INSTANCE_SEPARATOR + ','.join(
+        f"{tag}={value:g}" for tag, value in sorted(location.items()))
+
+
+def split_instance_path(font_path):
+    """ Splits an instance path into the path of the font file and the location.
+
+    Returns:
+        tuple: Path of the font file and the location (None for plain font files)
+    """
+    # '#' may also occur in file and directory names, only a suffix 'tag=value,...' is a location
+    match = _INSTANCE_PATTERN.fullmatch(font_path)
+    if match is None:
+        return font_path, None
+    font_file_path, location = match.groups()
+    return font_file_path, {tag: float(value) for tag, value in
+                            (item.split('=') for item in location.split(','))}
+
+
+def _file_key(font_path):
+    font_file_path = split_instance_path(os.path.normpath(font_path))[0]
+    return os.path.normpath(font_path), os.stat(font_file_path).st_mtime_ns
+
+
+def get_ttfont(font_file_path):
+    """ Returns a parsed fontTools TTFont for a font file.
+
+    The returned object is shared between threads, callers must not modify it.
+    All tables are read and fully decompiled (glyph outlines, lookups) when
+    the font is parsed and the file is closed: no thread seeks the file or
+    expands a shared glyph later. For instance paths the font file is
+    returned (default instance).
+
+    Args:
+        font_file_path (str): Path to font file (ttf, otf)
+
+    Returns:
+        ttLib.TTFont: The parsed font
+    """
+    font_file_path = split_instance_path(font_file_path)[0]
+    key = _file_key(font_file_path)
+
+    def parse():
+        with metrics.timer('parse', font=key[0]):
+            font = ttLib.TTFont(key[0], lazy=True)
+            try:
+                font.ensureDecompiled(recurse=True)
+            finally:
+                font.reader.close()
+            return font
+    return _ttfonts.get(key, parse)
+
+
+def get_freetype_font(font_file_path, font_size: int):
+    """ Returns a PIL FreeTypeFont handle for a font file and size.
+
+    For instance paths the variation of the location is set on the handle.
+
+    Args:
+        font_file_path (str): Path to font file (ttf, otf) or instance path
+        font_size (int): Font size in pixels
+
+    Returns:
+        ImageFont.FreeTypeFont: The sized font handle
+    """
+    key = _file_key(font_file_path) + (font_size,)
+
+    def load():
+        file_path, location = split_instance_path(key[0])
+        with metrics.timer('parse_freetype', font=key[0]):
+            font = ImageFont.truetype(file_path, font_size)
+            if location is not None:
+                # FreeType expects the values in the order of the axes in fvar
+                axes = get_ttfont(file_path)['fvar'].axes
+                font.set_variation_by_axes([location.get(axis.axisTag, axis.defaultValue)
+                                            for axis in axes])
+            return font
+    return _freetype_fonts.get(key, load)
+
+
+def cache_stats():
+    """ Returns hit/miss counters of both caches.
+
+    Returns:
+        Dictionary: Statistics for 'ttfont' and 'freetype'
+    """
+    return {'ttfont': _ttfonts.stats(),
+            'freetype': _freetype_fonts.stats()}
+
+
+def clear_cache():
+    """ Empties both caches and resets the counters. The font files are closed once unused. """
+    _ttfonts.clear()
+    _freetype_fonts.clear()
@@ -1,7 +1,37 @@
 """ Module for handling the json font database. """
+import hashlib
 import json
 import os
 from . import global_consts as g
+from . import fontcache, metrics
+
+
+def load_font_db():
+    """ Loads the json font database.
+
+    Returns:
+        Dictionary: Path of the font as key and font information as value
+    """
+
+    with open(g.PATH_TO_JSON_FONT_DB, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def add_fonts(font_entries):
+    """ Adds fonts to the json font database. Existing entries are replaced.
+
+    Args:
+        font_entries (Dictionary): Path of the font as key and font information as value
+    """
+
+    if not font_entries:
+        return
+    font_db = load_font_db()
+    font_db.update(font_entries)
+
+    with metrics.timer('db_write', num_fonts=len(font_db)):
+        with open(g.PATH_TO_JSON_FONT_DB, 'w', encoding='utf-8') as file:
+            json.dump(font_db, file, indent=4)
 
 
 def font_file_list():
@@ -37,8 +67,177 @@ def write_filter_results(filter_dictionary):
                 font_db[font_path].update(value)
                 break
 
-    with open(g.PATH_TO_JSON_FONT_DB, 'w', encoding='utf-8') as file:
-        json.dump(font_db, file, indent=4)
+    with metrics.timer('db_write', num_fonts=len(font_db)):
+        with open(g.PATH_TO_JSON_FONT_DB, 'w', encoding='utf-8') as file:
+            json.dump(font_db, file, indent=4)
+
+
+SPLIT_FRACTIONS = {'train': 0.8, 'val': 0.1, 'test': 0.1}
+
+
+def file_sha256(font_file_path):
+    """ Returns the sha256 hex digest of the content of a file. """
+    digest = hashlib.sha256()
+    with open(font_file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def split_for_key(key: str, fractions=SPLIT_FRACTIONS):
+    """ Maps a key deterministically to a split.
+
+    The key is hashed to a number in [0, 1), which selects the split by the
+    cumulative fractions. The same key always gets the same split, independent
+    of the other fonts in the database.
+
+    Args:
+        key (str): Key of the font, e.g. its content hash or family
+        fractions (Dictionary, optional): Fraction per split. Defaults to 80% train, 10% val, 10% test.
+
+    Returns:
+        str: Name of the split
+    """
+    position = int.from_bytes(hashlib.sha256(key.encode('utf-8')).digest()[:8], 'big') / 2**64
+    total = sum(fractions.values())
+    cumulative = 0.
+    for split, fraction in fractions.items():
+        cumulative += fraction / total
+        if position < cumulative:
+            return split
+    return split
+
+
+def content_key(font_path, entry):
+    """ Returns 'content:<sha256 of the font file>' and stores the hash as 'sha256' in the entry.
+        None if the font file can't be read.
+    """
+    if 'sha256' not in entry:
+        try:
+            entry['sha256'] = file_sha256(fontcache.split_instance_path(font_path)[0])
+        except OSError:
+            return None
+    return 'content:' + entry['sha256']
+
+
+def font_family(font_path, entry):
+    """ Returns the family of a font: the family from METADATA.pb if available,
+        otherwise the name of the directory of the font if a METADATA.pb lies next
+        to it (one directory per family in Google Fonts).
+
+        Other directories (e.g. one per URL list) hold unrelated fonts, so their
+        fonts get their content key (see content_key) or, if the file can't be
+        read, their path as family.
+    """
+    family = entry.get('metadata', {}).get('family')
+    if family:
+        return family
+    directory = os.path.dirname(fontcache.split_instance_path(font_path)[0])
+    if os.path.exists(os.path.join(directory, 'METADATA.pb')):
+        return os.path.basename(directory)
+    return content_key(font_path, entry) or font_path
+
+
+def assign_splits(by='family', fractions=SPLIT_FRACTIONS, overwrite=False):
+    """ Assigns every font in the json font database to a split and stores it as 'split'.
+
+    Fonts that already have a split keep it (unless overwrite), so adding fonts
+    to the database does not move fonts between the splits.
+
+    Args:
+        by (str, optional): 'family' keeps all styles of a family in the same split,
+            'content' hashes the font file, so copies of a font share the split.
+            Defaults to 'family'.
+        fractions (Dictionary, optional): Fraction per split. Defaults to 80% train, 10% val, 10% test.
+        overwrite (bool, optional): Reassign fonts that already have a split. Defaults to False.
+
+    Returns:
+        Dictionary: Number of fonts per split
+    """
+    if by not in ('family', 'content'):
+        raise ValueError(f"Unknown split key: {by}")
+
+    font_db = load_font_db()
+    changed = False
+    for font_path, entry in font_db.items():
+        if 'split' in entry and not overwrite:
+            continue
+        if by == 'family':
+            key = 'family:' + font_family(font_path, entry)
+        else:
+            key = content_key(font_path, entry)
+            if key is None:
+                continue
+        entry['split'] = split_for_key(key, fractions)
+        changed = True
+
+    if changed:
+        with metrics.timer('db_write', num_fonts=len(font_db)):
+            with open(g.PATH_TO_JSON_FONT_DB, 'w', encoding='utf-8') as file:
+                json.dump(font_db, file, indent=4)
+
+    counts = {split: 0 for split in fractions}
+    for entry in font_db.values():
+        if 'split' in entry:
+            counts[entry['split']] = counts.get(entry['split'], 0) + 1
+    return counts
+
+
+def iter_split(split: str, usable_only: bool=True):
+    """ Yields the paths of the fonts in a split (see assign_splits), in database order.
+
+    Args:
+        split (str): Name of the split, e.g. 'train', 'val' or 'test'
+        usable_only (bool, optional): Only yield fonts that passed the filters. Defaults to True.
+
+    Yields:
+        str: Path of the font
+    """
+    for font_path, entry in load_font_db().items():
+        if entry.get('split') == split and (entry.get('usable', True) or not usable_only):
+            yield os.path.normpath(font_path)
+
+
+def parse_shard(shard: str):
+    """ Parses a shard given as 'i/N' (0 <= i < N).
+
+    Returns:
+        tuple: Index of the shard and number of shards
+    """
+    try:
+        index, num_shards = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise ValueError(f"Shard must be given as i/N, got {shard!r}") from None
+    if not 0 <= index < num_shards:
+        raise ValueError(f"Shard index must be in [0, {num_shards}), got {index}")
+    return index, num_shards
+
+
+def shard_of(font_path, num_shards: int):
+    """ Maps a font deterministically to a shard.
+
+    The path relative to the raw directory is hashed, so a font gets the same
+    shard on every node, independent of the order and number of fonts. URLs are
+    hashed as they are.
+    """
+    key = font_path
+    if '://' not in font_path:
+        key = os.path.relpath(os.path.normpath(font_path), os.path.normpath(g.PATH_RAW)).replace(os.sep, '/')
+    digest = hashlib.sha256(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % num_shards
+
+
+def select_shard(font_paths, shard):
+    """ Returns the fonts of a shard, in the given order.
+
+    Args:
+        font_paths (list): Paths of the fonts (or URLs)
+        shard (str or tuple): Shard as 'i/N' or (i, N). None selects all fonts.
+    """
+    if shard is None:
+        return list(font_paths)
+    index, num_shards = parse_shard(shard) if isinstance(shard, str) else shard
+    return [font_path for font_path in font_paths if shard_of(font_path, num_shards) == index]
 
 
 def is_glyph_usable(path_fonts: list, char: str) -> dict:
@@ -65,3 +264,22 @@ def is_glyph_usable(path_fonts: list, char: str) -> dict:
             font_files_with_char[font_path] = False
 
     return font_files_with_char
+
+
+def update_clip_filter(results, path=None):
+    """ Merges classification results into the CLIP filter file read by is_glyph_usable.
+
+    Args:
+        results (Dictionary): Path of the font as key and {char: bool} as value
+        path (str, optional): The json file. Defaults to None: global_consts.PATH_TO_CLIP_FILTER.
+    """
+    path = path or g.PATH_TO_CLIP_FILTER
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            clip_filter = json.load(file)
+    except FileNotFoundError:
+        clip_filter = {}
+    for font_path, chars in results.items():
+        clip_filter.setdefault(os.path.normpath(font_path), {}).update(chars)
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(clip_filter, file, indent=4)
@@ -0,0 +1,157 @@
+""" Helpers to add glyphs to fontTools fonts (glyf and CFF outlines).
+
+Used by the composite construction of umlauts (composer.py) and by the
+vectorization of generated glyphs (src/model/glyphwriter.py).
+"""
+
+import os
+import tempfile
+from fontTools.agl import UV2AGL
+from fontTools.pens.boundsPen import BoundsPen
+from fontTools.pens.recordingPen import DecomposingRecordingPen, RecordingPen
+from fontTools.pens.t2CharStringPen import T2CharStringPen
+from fontTools.pens.ttGlyphPen import TTGlyphPen
+
+
+def check_outlines(font):
+    """ Raises a ValueError if glyphs can not be added to the font.
+
+    Args:
+        font (ttLib.TTFont): The font
+
+    Returns:
+        bool: True for CFF outlines, False for glyf outlines
+    """
+    if 'CFF ' in font:
+        if hasattr(font['CFF '].cff.topDictIndex[0], 'ROS'):
+            raise ValueError("CID-keyed CFF fonts are not supported")
+        return True
+    if 'glyf' not in font:
+        raise ValueError("Font has neither glyf nor CFF outlines (CFF2 is not supported)")
+    return False
+
+
+def glyph_name_for(font, char):
+    """ Returns an unused glyph name for a char, following the Adobe Glyph List.
+
+    Args:
+        font (ttLib.TTFont): The font
+        char (str): The char
+
+    Returns:
+        str: Glyph name, e.g. 'Adieresis'
+    """
+    name = UV2AGL.get(ord(char), f"uni{ord(char):04X}")
+    glyph_order = set(font.getGlyphOrder())
+    suffix = 1
+    unique_name = name
+    while unique_name in glyph_order:
+        unique_name = f"{name}.{suffix}"
+        suffix += 1
+    return unique_name
+
+
+def _add_cff_glyph(font, glyph_name, recording, advance):
+    top_dict = font['CFF '].cff.topDictIndex[0]
+    char_strings = top_dict.CharStrings
+    if char_strings.charStringsAreIndexed:
+        char_strings.charStrings = {name: char_strings.charStringsIndex[idx]
+                                    for name, idx in char_strings.charStrings.items()}
+        char_strings.charStringsIndex = None
+        char_strings.charStringsAreIndexed = False
+
+    pen = T2CharStringPen(advance, None)
+    recording.replay(pen)
+    char_string = pen.getCharString(private=top_dict.Private, globalSubrs=top_dict.GlobalSubrs)
+
+    if glyph_name not in char_strings.charStrings:
+        # The charset is the glyph order of CFF fonts
+        glyph_order = list(font.getGlyphOrder()) + [glyph_name]
+        top_dict.charset = glyph_order
+        font.setGlyphOrder(glyph_order)
+    char_strings.charStrings[glyph_name] = char_string
+
+
+def _add_glyf_glyph(font, glyph_name, recording):
+    glyf = font['glyf']
+    pen = TTGlyphPen(glyf)
+    recording.replay(pen)
+    glyph = pen.glyph()
+    if glyph_name not in glyf.glyphs:
+        glyf.glyphOrder.append(glyph_name)
+        font.setGlyphOrder(glyf.glyphOrder)
+        if 'gvar' in font:
+            font['gvar'].variations[glyph_name] = []
+    glyf.glyphs[glyph_name] = glyph
+    glyph.recalcBounds(glyf)
+    # The left side bearing of glyf fonts has to match xMin of the control points
+    return getattr(glyph, 'xMin', 0)
+
+
+def add_glyph(font, char, draw, advance=None):
+    """ Adds a glyph to the font and maps char to it in all unicode cmaps.
+
+    If the char is already mapped, the existing glyph is replaced. Components
+    (pen.addComponent) are kept for glyf outlines and decomposed for CFF.
+
+    Args:
+        font (ttLib.TTFont): The font, loaded without lazy=True
+        char (str): The char of the glyph
+        draw (callable): Called with a pen to draw the outlines, e.g. in the
+            orientation of glyf outlines (clockwise)
+        advance (int, optional): Advance width. Defaults to the right edge of the
+            outlines plus the left side bearing.
+
+    Returns:
+        str: The glyph name
+    """
+    is_cff = check_outlines(font)
+    glyph_set = font.getGlyphSet()
+
+    recording = RecordingPen()
+    draw(recording)
+    if is_cff:
+        # CFF has no components
+        decomposed = DecomposingRecordingPen(glyph_set)
+        recording.replay(decomposed)
+        recording = decomposed
+
+    bounds_pen = BoundsPen(glyph_set)
+    recording.replay(bounds_pen)
+    x_min, _, x_max, _ = bounds_pen.bounds or (0, 0, 0, 0)
+    x_min, x_max = int(round(x_min)), int(round(x_max))
+    if advance is None:
+        advance = x_max + max(x_min, 0)
+
+    cmap = font.getBestCmap() or {}
+    glyph_name = cmap.get(ord(char)) or glyph_name_for(font, char)
+    if is_cff:
+        _add_cff_glyph(font, glyph_name, recording, advance)
+    else:
+        x_min = _add_glyf_glyph(font, glyph_name, recording)
+    font['hmtx'][glyph_name] = (advance, x_min)
+
+    for table in font['cmap'].tables:
+        # Format 14 holds variation sequences, not a char mapping
+        if table.isUnicode() and table.format != 14:
+            table.cmap[ord(char)] = glyph_name
+    return glyph_name
+
+
+def save_font(font, output_path):
+    """ Saves the font to a temporary file next to output_path and renames it,
+        so readers of output_path never see a partial font.
+
+    Args:
+        font (ttLib.TTFont): The font
+        output_path (str): Path of the font file
+    """
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(output_path)),
+                                     suffix=os.path.splitext(output_path)[1], delete=False) as file:
+        temporary_path = file.name
+    try:
+        font.save(temporary_path)
+        os.replace(temporary_path, output_path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
@@ -0,0 +1,160 @@
+""" Concurrent fetching of font repositories with git.
+
+Every repository of the database config (source.json) is fetched in its own
+asyncio subprocesses, so several repositories transfer at the same time
+instead of waiting for each other's git round trips. The fetch is shallow
+(--depth 1) and partial (--filter=blob:none): only the commit and trees of
+the branch head are transferred up front, and the checkout downloads just
+the blobs of the sparse-checkout directories.
+
+Works with any URL git understands, including local bare repositories
+(paths or file:// URLs), which makes the stage testable offline. A local
+server has to allow filters (git config uploadpack.allowFilter true),
+otherwise git falls back to fetching all blobs of the head commit.
+
+Usage:
+    reports = fetch_repos([{'name': 'GoogleFontsDB', 'url': ..., 'directories': ['ofl/'], 'private': False}],
+                          path_target, max_concurrent=4)
+"""
+
+import asyncio
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from . import metrics
+
+BRANCH = 'main'
+
+
+async def _git(*args, cwd=None, env=None):
+    # Runs git and returns its stdout, raises CalledProcessError like subprocess.run(check=True)
+    process = await asyncio.create_subprocess_exec('git', *args, cwd=cwd, env=env,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, ['git', *args], stdout, stderr)
+    return stdout.decode()
+
+
+def _directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return size
+
+
+async def fetch_repo(path_target, db_name, repo_url, directory_list=None, private=False,
+                     branch=BRANCH, depth=1, partial=True):
+    """ Fetches the head of a branch and checks out the selected directories.
+
+    Locally deleted or modified files are restored from the fetched commit.
+
+    Args:
+        path_target (str): Directory the repository is checked out in (as <path_target>/<db_name>)
+        db_name (str): Name of the database
+        repo_url (str): URL or path of the remote repository
+        directory_list (list, optional): Sparse-checkout directories. Defaults to None: everything.
+        private (bool, optional): Use the SSH key <path_target>/<db_name>_key. Defaults to False.
+        branch (str, optional): Defaults to 'main'.
+        depth (int, optional): Commits to fetch, None for the full history. Defaults to 1.
+        partial (bool, optional): Fetch blobs only for the checked out files. Defaults to True.
+
+    Returns:
+        Dictionary: 'commit' checked out, 'bytes' added to the object store and 'seconds'
+
+    Raises:
+        subprocess.CalledProcessError: If a git command failed
+    """
+    start = time.perf_counter()
+    path_db = os.path.join(path_target, db_name)
+    os.makedirs(path_db, exist_ok=True)
+
+    env = None
+    if private:
+        env = os.environ.copy()
+        env["GIT_SSH_COMMAND"] = f"ssh -i {os.path.join(path_target, db_name + '_key')}"
+
+    if not os.path.isdir(os.path.join(path_db, '.git')):
+        await _git('init', '--quiet', cwd=path_db)
+    await _git('config', 'core.sparseCheckout', 'true', cwd=path_db)
+
+    remotes = (await _git('remote', cwd=path_db)).split()
+    if 'origin' in remotes:
+        await _git('remote', 'set-url', 'origin', repo_url, cwd=path_db)
+    else:
+        await _git('remote', 'add', 'origin', repo_url, cwd=path_db)
+    if partial:
+        # Lets the checkout fetch the missing blobs from origin
+        await _git('config', 'remote.origin.promisor', 'true', cwd=path_db)
+        await _git('config', 'remote.origin.partialclonefilter', 'blob:none', cwd=path_db)
+
+    with open(os.path.join(path_db, '.git', 'info', 'sparse-checkout'), 'w', encoding='utf-8') as file:
+        for directory in directory_list or ['/*']:
+            file.write(directory + '\n')
+
+    objects_path = os.path.join(path_db, '.git', 'objects')
+    size_before = _directory_size(objects_path)
+    fetch_args = ['fetch', '--quiet', '--no-tags']
+    if depth is not None:
+        fetch_args.append(f'--depth={depth}')
+    if partial:
+        fetch_args.append('--filter=blob:none')
+    await _git(*fetch_args, 'origin', f'+refs/heads/{branch}:refs/remotes/origin/{branch}', cwd=path_db, env=env)
+    await _git('checkout', '--quiet', '--force', '--detach', f'origin/{branch}', cwd=path_db, env=env)
+    commit = (await _git('rev-parse', 'HEAD', cwd=path_db)).strip()
+
+    return {'commit': commit,
+            'bytes': _directory_size(objects_path) - size_before,
+            'seconds': time.perf_counter() - start}
+
+
+async def fetch_repos_async(repos, path_target, max_concurrent=4, **kwargs):
+    """ Awaitable version of fetch_repos, e.g. for code that runs in an event loop. """
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def fetch(repo):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                report = await fetch_repo(path_target, repo['name'], repo['url'], repo.get('directories'),
+                                          repo.get('private', False), **kwargs)
+                report['status'] = 'ok'
+            except (subprocess.CalledProcessError, OSError) as e:
+                stderr = getattr(e, 'stderr', None)
+                report = {'status': 'error', 'seconds': time.perf_counter() - start, 'bytes': 0,
+                          'error': stderr.decode(errors='replace').strip() if stderr else str(e)}
+            metrics.record('git_fetch', report['seconds'], repo=repo['name'], bytes=report['bytes'],
+                           status=report['status'])
+            return repo['name'], report
+
+    return dict(await asyncio.gather(*(fetch(repo) for repo in repos)))
+
+
+def fetch_repos(repos, path_target, max_concurrent=4, **kwargs):
+    """ Fetches repositories concurrently. A failing repository doesn't stop the others.
+
+    Args:
+        repos (list): Dictionaries with 'name', 'url' and optionally 'directories' and 'private'
+        path_target (str): Directory the repositories are checked out in
+        max_concurrent (int, optional): Repositories fetched at the same time. Defaults to 4.
+        **kwargs: Further arguments of fetch_repo (branch, depth, partial)
+
+    Returns:
+        Dictionary: Name of the repository as key and the report of fetch_repo with
+            'status' ('ok' or 'error', then with 'error') as value
+    """
+    coroutine = fetch_repos_async(repos, path_target, max_concurrent, **kwargs)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    # Called from a running event loop (e.g. a Jupyter kernel): asyncio.run would raise,
+    # so the fetch runs in a thread with its own loop
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
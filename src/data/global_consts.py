@@ -1,16 +1,124 @@
-""" Stores global constants for the project. """
+""" Stores global constants for the project.
+
+The constants can be overridden without editing this file, in increasing priority:
+    - a TOML file with the names of the constants as keys (e.g. PATH_RAW = "/data/raw/"),
+      given by the environment variable FONTGEN_CONFIG or fontgen.toml in the working directory
+    - environment variables FONTGEN_<NAME>, e.g. FONTGEN_PATH_RAW=/data/raw/
+    - configure(), e.g. from the --config and --set flags of the CLI (python -m src)
+
+Paths derived from PATH_RAW (font database, URL lists, CLIP results, blob store)
+and PATH_PROCESSED (shard outputs) follow it unless they are overridden themselves.
+"""
 
 import os
 
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+CONFIG_ENV = 'FONTGEN_CONFIG'
+ENV_PREFIX = 'FONTGEN_'
+DEFAULT_CONFIG_FILE = 'fontgen.toml'
+
 PATH_DB_CONFIGS = '../data/'
 PATH_RAW = '../data/raw/'
 
 PATH_URL_LISTS = '../data/raw/url_lists/'
 PATH_PROCESSED = '../data/processed/'
 
-PATH_TO_QUERIES_JSON = '../../AI_Font_Generator/src/data/queries.json'
+PATH_TO_QUERIES_JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'queries.json')
 JSON_FONT_DB = '00dataset.json'
+JSON_FAILURE_REGISTRY = '00failures.json'
+JSON_CLIP_FILTER = 'clip.json'
 DBCONFIG = 'source.json'
+JSON_BLOB_INDEX = '00blobs.json'
 
 
 PATH_TO_JSON_FONT_DB = os.path.join(PATH_RAW, JSON_FONT_DB)
+PATH_TO_CLIP_FILTER = os.path.join(PATH_RAW, JSON_CLIP_FILTER)
+PATH_BLOBS = os.path.join(PATH_RAW, 'blobs/')
+PATH_SHARDS = os.path.join(PATH_PROCESSED, 'shards/')
+
+_BASE = {name: value for name, value in globals().items() if name.isupper()
+         and name not in ('CONFIG_ENV', 'ENV_PREFIX', 'DEFAULT_CONFIG_FILE')}
+_DERIVED = {
+    'PATH_URL_LISTS': lambda c: os.path.join(c['PATH_RAW'], 'url_lists/'),
+    'PATH_TO_JSON_FONT_DB': lambda c: os.path.join(c['PATH_RAW'], c['JSON_FONT_DB']),
+    'PATH_TO_CLIP_FILTER': lambda c: os.path.join(c['PATH_RAW'], c['JSON_CLIP_FILTER']),
+    'PATH_BLOBS': lambda c: os.path.join(c['PATH_RAW'], 'blobs/'),
+    'PATH_SHARDS': lambda c: os.path.join(c['PATH_PROCESSED'], 'shards/'),
+}
+_overrides = {}
+_config_path = None
+
+
+def load_config_file(path):
+    """ Reads the constants from a TOML file.
+
+    Returns:
+        Dictionary: Name of the constant as key and its value
+    """
+    if tomllib is None:
+        raise ImportError("Reading TOML config files needs Python 3.11 or the package tomli")
+    with open(path, 'rb') as file:
+        config = tomllib.load(file)
+    unknown = set(config) - set(_BASE)
+    if unknown:
+        raise ValueError(f"Unknown constants in {path}: {', '.join(sorted(unknown))}")
+    return config
+
+
+def configure(config_path=None, **overrides):
+    """ Sets the constants from the config file, the environment and the overrides.
+
+    The config file and the overrides of earlier calls are kept (see reset).
+    Modules read the constants at call time (g.PATH_RAW), so the new values
+    apply to everything that runs afterwards.
+
+    Args:
+        config_path (str, optional): TOML file. Defaults to None: the file of an earlier
+            call, $FONTGEN_CONFIG or fontgen.toml in the working directory, if it exists.
+        **overrides: Constants to set, e.g. PATH_RAW='/data/raw/'
+    """
+    global _config_path
+    unknown = set(overrides) - set(_BASE)
+    if unknown:
+        raise ValueError(f"Unknown constants: {', '.join(sorted(unknown))}")
+    _overrides.update(overrides)
+    if config_path is not None:
+        _config_path = config_path
+
+    config_path = _config_path or os.environ.get(CONFIG_ENV)
+    if config_path is None and os.path.exists(DEFAULT_CONFIG_FILE):
+        config_path = DEFAULT_CONFIG_FILE
+    explicit = load_config_file(config_path) if config_path else {}
+    explicit.update({name: os.environ[ENV_PREFIX + name] for name in _BASE if ENV_PREFIX + name in os.environ})
+    explicit.update(_overrides)
+
+    values = {**_BASE, **explicit}
+    for name, derive in _DERIVED.items():
+        if name not in explicit:
+            values[name] = derive(values)
+    globals().update(values)
+
+
+def reset():
+    """ Drops the config file and the overrides of configure, e.g. after a test. """
+    global _config_path
+    _config_path = None
+    _overrides.clear()
+    configure()
+
+
+def current_config():
+    """ Returns the config file and the overrides of configure, to configure a child
+        process (e.g. an isolation worker) the same way: configure(path, **overrides).
+    """
+    return _config_path, dict(_overrides)
+
+
+configure()
@@ -0,0 +1,189 @@
+""" Isolated execution of per-font work in worker processes.
+
+A malformed or gigantic font can hang fontTools parsing or FreeType rendering,
+exhaust the memory or crash the interpreter. run_isolated processes every font
+in a worker process with a wall-clock timeout and a memory limit. Workers that
+time out or crash are replaced and the font gets a verdict instead of stalling
+the whole batch.
+
+Verdicts:
+    'ok'            the function returned
+    'error'         the function raised an exception
+    'timeout'       the wall-clock limit was exceeded, the worker was killed
+    'memory_limit'  the memory limit was exceeded
+    'crashed'       the worker died (e.g. segfault)
+"""
+
+import multiprocessing
+import os
+import resource
+import time
+from multiprocessing.connection import wait
+from tqdm import tqdm
+from . import global_consts as g
+
+TIMEOUT = 60
+MEMORY_LIMIT_MB = 4096
+
+
+def _worker_main(conn, memory_limit_mb, config):
+    # Spawned workers import global_consts anew, without the --config and --set of the parent
+    config_path, overrides = config
+    g.configure(config_path, **overrides)
+    if memory_limit_mb is not None:
+        limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        idx, func, font_file_path, args, kwargs = task
+        start = time.perf_counter()
+        result, error = None, None
+        try:
+            result = func(font_file_path, *args, **kwargs)
+            status = 'ok'
+        except MemoryError:
+            status, error = 'memory_limit', 'MemoryError'
+        except Exception as e:
+            status, error = 'error', f"{type(e).__name__}: {e}"
+        seconds = time.perf_counter() - start
+        try:
+            conn.send((idx, status, result, error, seconds))
+        except Exception as e:
+            conn.send((idx, 'error', None, f"Result not transferable: {e}", seconds))
+
+
+class _Worker:
+
+    def __init__(self, context, memory_limit_mb):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main,
+                                       args=(child_conn, memory_limit_mb, g.current_config()),
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task = None
+        self.deadline = None
+        self.start = None
+
+    def submit(self, task, timeout):
+        self.task = task
+        self.start = time.perf_counter()
+        self.deadline = self.start + timeout
+        self.conn.send(task)
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+def run_isolated(func, font_file_paths, args=(), kwargs=None, timeout=TIMEOUT,
+                 memory_limit_mb=MEMORY_LIMIT_MB, workers=None, progress=True):
+    """ Calls func(font_file_path, *args, **kwargs) for every font in worker processes.
+
+    func and its arguments have to be picklable, i.e. defined at module level.
+
+    Args:
+        func (callable): Function to call per font
+        font_file_paths (list): Paths to the font files
+        args (tuple, optional): Further positional arguments of func. Defaults to ().
+        kwargs (dict, optional): Keyword arguments of func. Defaults to None.
+        timeout (float, optional): Wall-clock limit per font in seconds. Defaults to 60.
+        memory_limit_mb (int, optional): Address space limit per worker. None disables
+            the limit. Defaults to 4096.
+        workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+        progress (bool, optional): Show a progress bar. Defaults to True.
+
+    Returns:
+        list: One dictionary per font with 'status' (see module docstring), 'result',
+            'error' and 'seconds', in the order of font_file_paths
+    """
+    kwargs = kwargs or {}
+    workers = min(workers or os.cpu_count() or 1, max(len(font_file_paths), 1))
+    # spawn: forking a process with threads (tqdm, TensorFlow) is not safe
+    context = multiprocessing.get_context('spawn')
+
+    results = [None] * len(font_file_paths)
+    pending = list(reversed(range(len(font_file_paths))))
+    pool = [_Worker(context, memory_limit_mb) for _ in range(workers)]
+    progress_bar = tqdm(total=len(font_file_paths), disable=not progress)
+
+    def finish(worker, status, result=None, error=None):
+        idx = worker.task[0]
+        results[idx] = {'status': status, 'result': result, 'error': error,
+                        'seconds': time.perf_counter() - worker.start}
+        worker.task = None
+        progress_bar.update(1)
+
+    try:
+        while pending or any(worker.task is not None for worker in pool):
+            for worker in pool:
+                if worker.task is None and pending:
+                    idx = pending.pop()
+                    worker.submit((idx, func, font_file_paths[idx], args, kwargs), timeout)
+
+            busy = [worker for worker in pool if worker.task is not None]
+            wait_seconds = max(min(worker.deadline for worker in busy) - time.perf_counter(), 0)
+            ready = wait([worker.conn for worker in busy] + [worker.process.sentinel for worker in busy],
+                         timeout=wait_seconds)
+
+            for slot, worker in enumerate(pool):
+                if worker.task is None:
+                    continue
+                if worker.conn in ready:
+                    try:
+                        _, status, result, error, _ = worker.conn.recv()
+                        finish(worker, status, result, error)
+                        continue
+                    except (EOFError, OSError):
+                        pass
+                if worker.process.sentinel in ready or not worker.process.is_alive():
+                    worker.kill()
+                    finish(worker, 'crashed', error=f"Worker exited with code {worker.process.exitcode}")
+                    pool[slot] = _Worker(context, memory_limit_mb)
+                elif time.perf_counter() >= worker.deadline:
+                    finish(worker, 'timeout', error=f"No result after {timeout} seconds")
+                    worker.kill()
+                    pool[slot] = _Worker(context, memory_limit_mb)
+    finally:
+        for worker in pool:
+            if worker.task is None:
+                worker.stop()
+            else:
+                worker.kill()
+        progress_bar.close()
+    return results
+
+
+def verdict_entry(result):
+    """ Returns the font database entry for a font that did not finish in its worker.
+
+    The status becomes the filter verdict, so the font is excluded like a font
+    that failed a filter function.
+
+    Args:
+        result (Dictionary): Result of run_isolated for the font
+
+    Returns:
+        Dictionary: Entry with 'usable', 'filters' and 'isolation_error'
+    """
+    return {'usable': False,
+            'filters': [result['status']],
+            'isolation_error': result['error']}
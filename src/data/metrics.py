@@ -0,0 +1,221 @@
+""" Instrumentation for pipeline runs: timers, counters and structured JSON-lines metrics.
+
+Timers and counters are always aggregated in memory (count, total and max
+seconds per stage, plus the slowest fonts per stage). If a metrics file is
+configured, every timed event is additionally written as one JSON line, so
+pathological fonts (e.g. huge CJK cmaps) can be found after a run.
+
+Usage:
+    from . import metrics
+    metrics.configure('../data/raw/metrics.jsonl')
+    with metrics.timer('render', font=font_file_path):
+        ...
+    metrics.write_summary()
+"""
+
+import cProfile
+import heapq
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+SLOWEST_N = 20
+
+_lock = threading.Lock()
+_sink = None
+_emit_events = True
+_slowest_n = SLOWEST_N
+_timers = {}
+_counters = Counter()
+_slowest = {}
+
+
+def configure(path=None, emit_events=True, slowest_n=SLOWEST_N):
+    """ Sets where and what metrics are written.
+
+    Args:
+        path (str, optional): JSON-lines file the metrics are appended to. Defaults to None:
+            metrics are only aggregated in memory.
+        emit_events (bool, optional): Write one line per timed event, not only the
+            summary. Defaults to True.
+        slowest_n (int, optional): Number of slowest fonts kept per stage. Defaults to 20.
+    """
+    global _sink, _emit_events, _slowest_n
+    with _lock:
+        if _sink is not None:
+            _sink.close()
+        _sink = open(path, 'a', encoding='utf-8') if path is not None else None
+        _emit_events = emit_events
+        _slowest_n = slowest_n
+
+
+def reset():
+    """ Clears all timers, counters and slowest fonts. """
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _slowest.clear()
+
+
+def _write(record):
+    # Caller holds _lock
+    if _sink is not None:
+        _sink.write(json.dumps(record, default=str) + '\n')
+        _sink.flush()
+
+
+def emit(event, **fields):
+    """ Writes a single JSON line to the metrics file (if configured).
+
+    Args:
+        event (str): Name of the event
+        **fields: Further fields of the record
+    """
+    with _lock:
+        _write({'time': time.time(), 'event': event, **fields})
+
+
+def count(name, value=1):
+    """ Increments a counter.
+
+    Args:
+        name (str): Name of the counter
+        value (int, optional): Increment. Defaults to 1.
+    """
+    with _lock:
+        _counters[name] += value
+
+
+def record(stage, seconds, font=None, **fields):
+    """ Records the duration of a stage, e.g. measured elsewhere.
+
+    Args:
+        stage (str): Name of the stage, e.g. 'render' or 'filter.has_empty_glyphs'
+        seconds (float): Duration
+        font (str, optional): Font file the stage worked on. Defaults to None.
+        **fields: Further fields written with the event
+    """
+    with _lock:
+        stats = _timers.setdefault(stage, {'count': 0, 'total_seconds': 0., 'max_seconds': 0.})
+        stats['count'] += 1
+        stats['total_seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+        if font is not None:
+            slowest = _slowest.setdefault(stage, [])
+            entry = (seconds, str(font))
+            if len(slowest) < _slowest_n:
+                heapq.heappush(slowest, entry)
+            elif entry > slowest[0]:
+                heapq.heapreplace(slowest, entry)
+
+        if _emit_events:
+            _write({'time': time.time(), 'event': 'timer', 'stage': stage,
+                    'seconds': seconds, 'font': font, **fields})
+
+
+@contextmanager
+def timer(stage, font=None, **fields):
+    """ Context manager that times the enclosed block as a stage.
+
+    Exceptions are recorded with the event and re-raised.
+
+    Args:
+        stage (str): Name of the stage
+        font (str, optional): Font file the stage works on. Defaults to None.
+        **fields: Further fields written with the event
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        fields['error'] = type(e).__name__
+        raise
+    finally:
+        record(stage, time.perf_counter() - start, font, **fields)
+
+
+def summary():
+    """ Returns the aggregated metrics.
+
+    Returns:
+        Dictionary: 'timers' (count, total, mean and max seconds per stage),
+            'counters' and 'slowest' (slowest fonts per stage, slowest first)
+    """
+    with _lock:
+        timers = {stage: {**stats, 'mean_seconds': stats['total_seconds'] / stats['count']}
+                  for stage, stats in _timers.items()}
+        slowest = {stage: [{'font': font, 'seconds': seconds}
+                           for seconds, font in sorted(entries, reverse=True)]
+                   for stage, entries in _slowest.items()}
+        return {'timers': timers, 'counters': dict(_counters), 'slowest': slowest}
+
+
+def write_summary(**fields):
+    """ Writes the aggregated metrics as one JSON line and returns them.
+
+    Args:
+        **fields: Further fields of the record, e.g. the name of the run
+    """
+    result = summary()
+    emit('summary', **fields, **result)
+    return result
+
+
+@contextmanager
+def profile(path):
+    """ Profiles the enclosed block with cProfile and dumps the stats to path
+        (readable with pstats or snakeviz).
+
+    Args:
+        path (str): Output file of the profile
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+
+@contextmanager
+def sample_stacks(path, interval=0.005):
+    """ Samples the stacks of all threads while the enclosed block runs.
+
+    The samples are written as collapsed stacks ('frame;frame;frame count'),
+    which flamegraph tools can read. Sampling is cheap enough for long runs
+    where cProfile would slow the pipeline down too much.
+
+    Args:
+        path (str): Output file of the collapsed stacks
+        interval (float, optional): Seconds between two samples. Defaults to 0.005.
+    """
+    samples = Counter()
+    stop = threading.Event()
+
+    def sample():
+        sampler_id = threading.get_ident()
+        while not stop.wait(interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_filename}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                samples[';'.join(reversed(stack))] += 1
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield samples
+    finally:
+        stop.set()
+        sampler.join()
+        with open(path, 'w', encoding='utf-8') as file:
+            for stack, num_samples in samples.most_common():
+                file.write(f"{stack} {num_samples}\n")
@@ -0,0 +1,205 @@
+""" Failure registry for fonts that repeatedly fail to parse or render.
+
+The registry is a json file next to the font database. It records per font
+and configuration (e.g. 'parse' or 'render:64' for rendering at size 64) the
+last error, how often the font failed and the modification time of the font
+file. Fonts that failed QUARANTINE_AFTER times are skipped by render_fonts,
+so later runs don't retry them. An entry is ignored as soon as the font file
+changes on disk. Shards append their failures to a file of their own
+(defer_failures), which the reduce step merges (merge_deferred).
+
+Structure:
+    {font_path: {config: {'error': str, 'count': int, 'mtime_ns': int, 'last_failure': str}}}
+"""
+
+import contextlib
+import datetime
+import fcntl
+import json
+import os
+import tempfile
+import warnings
+from . import global_consts as g
+from . import fontcache, metrics
+
+QUARANTINE_AFTER = 2
+
+# Json-lines file the failures are appended to instead of the registry (see defer_failures)
+_deferred_path = None
+
+
+def registry_path():
+    """ Returns the path of the registry, in the directory of the json font database. """
+    return os.path.join(os.path.dirname(g.PATH_TO_JSON_FONT_DB), g.JSON_FAILURE_REGISTRY)
+
+
+def render_config(size: int):
+    """ Returns the configuration key for rendering at a size. """
+    return f"render:{size}"
+
+
+def _mtime_ns(font_file_path):
+    try:
+        return os.stat(fontcache.split_instance_path(font_file_path)[0]).st_mtime_ns
+    except OSError:
+        return None
+
+
+def load_registry():
+    """ Loads the failure registry.
+
+    Returns:
+        Dictionary: Path of the font as key and the failures per configuration as value.
+            Empty if there is no registry yet.
+    """
+    try:
+        with open(registry_path(), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except json.JSONDecodeError as e:
+        warnings.warn(f"Failure registry {registry_path()} is corrupt and ignored: {e}")
+        return {}
+
+
+def _save_registry(registry):
+    # Written to a temporary file first, so readers never see a partial registry
+    path = registry_path()
+    with metrics.timer('db_write', num_fonts=len(registry), db='failure_registry'):
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(path) or '.',
+                                         delete=False) as file:
+            json.dump(registry, file, indent=4)
+        os.replace(file.name, path)
+
+
+@contextlib.contextmanager
+def _locked():
+    # Serializes read-modify-write of the registry between processes (e.g. parallel runs)
+    with open(registry_path() + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def registry_available():
+    """ Returns True if the directory of the font database exists, i.e. failures can be recorded. """
+    return os.path.isdir(os.path.dirname(g.PATH_TO_JSON_FONT_DB) or '.')
+
+
+def record_failures(failures, config):
+    """ Records failures of fonts for a configuration.
+
+    Args:
+        failures (Dictionary): Path of the font as key and the error message as value
+        config (str): Configuration, 'parse' or the result of render_config
+    """
+    if not failures:
+        return
+    if _deferred_path is not None:
+        with open(_deferred_path, 'a', encoding='utf-8') as file:
+            for font_file_path, error in failures.items():
+                file.write(json.dumps({'font': font_file_path, 'config': config, 'error': str(error)}) + '\n')
+        return
+    now = datetime.datetime.now().isoformat(timespec='seconds')
+    with _locked():
+        registry = load_registry()
+        for font_file_path, error in failures.items():
+            font_file_path = os.path.normpath(font_file_path)
+            mtime_ns = _mtime_ns(font_file_path)
+            entry = registry.setdefault(font_file_path, {}).get(config)
+            if entry is None or entry.get('mtime_ns') != mtime_ns:
+                entry = {'count': 0}
+            entry.update({'error': str(error),
+                          'count': entry['count'] + 1,
+                          'mtime_ns': mtime_ns,
+                          'last_failure': now})
+            registry[font_file_path][config] = entry
+        _save_registry(registry)
+
+
+def defer_failures(path):
+    """ Appends failures to a json-lines file instead of the registry, e.g. in a shard,
+        so parallel shards don't write the shared registry (see shards.py).
+
+    Args:
+        path (str): File for the failures, merged with merge_deferred. None records
+            to the registry again.
+    """
+    global _deferred_path
+    _deferred_path = path
+
+
+def merge_deferred(paths):
+    """ Records the failures of files written with defer_failures in the registry.
+
+    Returns:
+        int: Number of failures
+    """
+    # Every call of record_failures counts once per font, so repeated failures
+    # of a font start a new round
+    rounds = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                failure = json.loads(line)
+                for config, failures in rounds:
+                    if config == failure['config'] and failure['font'] not in failures:
+                        failures[failure['font']] = failure['error']
+                        break
+                else:
+                    rounds.append((failure['config'], {failure['font']: failure['error']}))
+    for config, failures in rounds:
+        record_failures(failures, config)
+    return sum(len(failures) for _, failures in rounds)
+
+
+def known_bad(font_file_paths, config, registry=None):
+    """ Returns the fonts that are quarantined for a configuration.
+
+    A font is quarantined if it failed to parse or failed QUARANTINE_AFTER times
+    with the configuration, and the font file did not change since.
+
+    Args:
+        font_file_paths (list): Paths of the fonts to check
+        config (str): Configuration, 'parse' or the result of render_config
+        registry (Dictionary, optional): Loaded registry. Defaults to None: loaded from disk.
+
+    Returns:
+        set: Paths (as given) of the quarantined fonts
+    """
+    if registry is None:
+        registry = load_registry()
+    if not registry:
+        return set()
+
+    bad = set()
+    for font_file_path in font_file_paths:
+        failures = registry.get(os.path.normpath(font_file_path))
+        if not failures:
+            continue
+        mtime_ns = _mtime_ns(font_file_path)
+        for failure_config in ('parse', config):
+            entry = failures.get(failure_config)
+            if (entry is not None and entry['mtime_ns'] == mtime_ns and
+                    entry['count'] >= (1 if failure_config == 'parse' else QUARANTINE_AFTER)):
+                bad.add(font_file_path)
+                break
+    return bad
+
+
+def release(font_file_paths=None):
+    """ Removes fonts from the registry, so they are tried again.
+
+    Args:
+        font_file_paths (list, optional): Fonts to remove. Defaults to None: all fonts.
+    """
+    with _locked():
+        if font_file_paths is None:
+            registry = {}
+        else:
+            registry = load_registry()
+            for font_file_path in font_file_paths:
+                registry.pop(os.path.normpath(font_file_path), None)
+        _save_registry(registry)
@@ -0,0 +1,200 @@
+""" Shared rendering of overlapping glyph requests.
+
+Filtering renders the required chars at size 2, CLIP renders single chars at
+size 64, the training export renders its charset at size 64, and models ask
+for their own charsets (e.g. AaOoUu8Bj + ÄäÖöÜüß). Rendering every request on
+its own draws the same glyphs over and over again.
+
+A RenderPlan collects the requests (chars, size, normalize, invert, dtype)
+and merges them into one pass per size: the union of their chars is drawn
+once per font, and every request gets its columns with its own flags. The
+results equal datarenderer.render_font / render_fonts for each request.
+
+Usage:
+    plan = RenderPlan()
+    empty_check = plan.add(required_chars, size=2, normalize=True)
+    clip = plan.add('ß', size=64)
+    export = plan.add(required_chars, size=64, dtype=np.uint8)
+    glyphs, indices = plan.render(font_file_paths, compact=True)
+
+    datafilter.filter_fonts(font_file_paths=..., glyphs=plan.by_font(glyphs[empty_check], indices, font_file_paths))
+    classifier.evaluate_image(font_file_paths, 'ß', glyphs=(glyphs[clip], indices))
+    datarenderer.export_dataset(font_file_paths, output_path, glyphs=(glyphs[export], indices))
+"""
+
+import numpy as np
+from . import datarenderer, isolation, metrics, quarantine
+
+
+def render_passes(font_file_path, passes):
+    """ Renders the passes of a plan for one font (module level, so it runs isolated).
+
+    Args:
+        font_file_path (str): Path to font file (ttf, otf)
+        passes (tuple): Tuples (size, chars)
+
+    Returns:
+        list: uint8 array of shape (size, size, len(chars)) per pass
+    """
+    return [datarenderer.render_font(font_file_path, size, chars, dtype=np.uint8) for size, chars in passes]
+
+
+class RenderPlan:
+    """ Glyph requests merged into one rendering pass per size. """
+
+    def __init__(self):
+        self.requests = []
+
+    def add(self, chars: str, size: int=64, normalize: bool=False, invert: bool=False, dtype=np.float16):
+        """ Adds a request, the arguments are those of datarenderer.render_font.
+
+        Returns:
+            int: Index of the request in the results of render
+        """
+        self.requests.append({'chars': chars, 'size': size, 'normalize': normalize,
+                              'invert': invert, 'dtype': dtype})
+        return len(self.requests) - 1
+
+    def passes(self):
+        """ Returns the passes as tuples (size, chars), the chars of a size without duplicates. """
+        chars_by_size = {}
+        for request in self.requests:
+            chars = chars_by_size.setdefault(request['size'], [])
+            chars.extend(char for char in request['chars'] if char not in chars)
+        return tuple((size, ''.join(chars)) for size, chars in chars_by_size.items())
+
+    def _columns(self, passes):
+        # Pass index and columns in the pass of every request
+        pass_chars = {size: (idx, {char: column for column, char in enumerate(chars)})
+                      for idx, (size, chars) in enumerate(passes)}
+        columns = []
+        for request in self.requests:
+            idx, column_of = pass_chars[request['size']]
+            columns.append((idx, np.array([column_of[char] for char in request['chars']], dtype=np.intp)))
+        return columns
+
+    def fan_out(self, pass_glyphs, passes=None):
+        """ Returns the glyphs of every request from the rendered passes.
+
+        Args:
+            pass_glyphs (list): uint8 arrays of shape (..., size, size, len(chars)) per pass
+            passes (tuple, optional): Result of passes(). Defaults to None: computed.
+
+        Returns:
+            list: One array of shape (..., size, size, len(chars)) per request
+        """
+        results = []
+        for request, (idx, columns) in zip(self.requests, self._columns(passes or self.passes())):
+            glyphs = pass_glyphs[idx][..., columns].astype(np.float64)
+            # Same conversions as render_font
+            if request['normalize']:
+                glyphs = glyphs / 255.
+            if request['invert']:
+                glyphs = (1. - glyphs) if request['normalize'] else (255 - glyphs)
+            results.append(glyphs.astype(request['dtype']))
+        return results
+
+    def render_font(self, font_file_path):
+        """ Renders all requests for one font.
+
+        Returns:
+            list: One array of shape (size, size, len(chars)) per request
+        """
+        passes = self.passes()
+        return self.fan_out(render_passes(font_file_path, passes), passes)
+
+    def render(self, font_file_paths: list,
+               isolated: bool=False,
+               timeout: float=isolation.TIMEOUT,
+               memory_limit_mb: int=isolation.MEMORY_LIMIT_MB,
+               workers: int=None,
+               use_registry: bool=True,
+               compact: bool=False):
+        """ Renders all requests for multiple fonts with one pass per font and size.
+
+        Fonts that are quarantined for one of the sizes are skipped, failures are
+        recorded for the size of the failing pass (see render_fonts).
+
+        Args:
+            font_file_paths (list): List of font file paths
+            isolated (bool, optional): Render every font in a worker process (see isolation.py). Defaults to False.
+            timeout (float, optional): Wall-clock limit per font in seconds if isolated. Defaults to 60.
+            memory_limit_mb (int, optional): Memory limit per worker if isolated. Defaults to 4096.
+            workers (int, optional): Number of worker processes if isolated. Defaults to the number of CPUs.
+            use_registry (bool, optional): Skip quarantined fonts and record failures. Defaults to True.
+            compact (bool, optional): Drop the rows of fonts that were not rendered. Defaults to False.
+
+        Returns:
+            tuple: One array of shape (len(font_file_paths), size, size, len(chars)) per request
+                (background for fonts that were not rendered) and the mask of the rendered fonts,
+                or with compact the arrays of the rendered fonts and their indices in font_file_paths
+        """
+        passes = self.passes()
+        pass_glyphs = [np.full((len(font_file_paths), size, size, len(chars)), 255, dtype=np.uint8)
+                       for size, chars in passes]
+        valid = np.zeros(len(font_file_paths), dtype=bool)
+        errors = {size: {} for size, _ in passes}
+
+        use_registry = use_registry and quarantine.registry_available()
+        skipped = set()
+        if use_registry:
+            for size, _ in passes:
+                skipped |= quarantine.known_bad(font_file_paths, quarantine.render_config(size))
+        if skipped:
+            metrics.count('render_quarantined', len(skipped))
+            print(f"Skipping {len(skipped)} quarantined fonts")
+        todo = [idx for idx, font_file_path in enumerate(font_file_paths) if font_file_path not in skipped]
+
+        if isolated:
+            results = isolation.run_isolated(render_passes, [font_file_paths[idx] for idx in todo],
+                                             args=(passes,),
+                                             timeout=timeout,
+                                             memory_limit_mb=memory_limit_mb,
+                                             workers=workers,
+                                             progress=False)
+            for idx, result in zip(todo, results):
+                if result['status'] == 'ok':
+                    for glyphs, rendered in zip(pass_glyphs, result['result']):
+                        glyphs[idx] = rendered
+                    valid[idx] = True
+                else:
+                    # The failing pass is unknown, the failure counts for the first size
+                    metrics.count(f"render_{result['status']}")
+                    errors[passes[0][0]][font_file_paths[idx]] = f"{result['status']} ({result['error']})"
+        else:
+            for idx in todo:
+                for glyphs, (size, chars) in zip(pass_glyphs, passes):
+                    try:
+                        glyphs[idx] = datarenderer.render_font(font_file_paths[idx], size, chars, dtype=np.uint8)
+                    except Exception as e:
+                        errors[size][font_file_paths[idx]] = f"{type(e).__name__}: {e}"
+                        break
+                else:
+                    valid[idx] = True
+
+        for size, size_errors in errors.items():
+            for font_file_path, error in size_errors.items():
+                metrics.count('render_errors')
+                print(f"Error while rendering font {font_file_path}: {error}")
+            if use_registry:
+                quarantine.record_failures(size_errors, quarantine.render_config(size))
+
+        # Glyphs every request would have drawn on its own minus the glyphs drawn
+        num_requested = sum(len(request['chars']) for request in self.requests)
+        metrics.count('glyphs_shared', int(valid.sum()) * (num_requested - sum(len(chars) for _, chars in passes)))
+
+        if compact:
+            indices = np.flatnonzero(valid)
+            return self.fan_out([glyphs[indices] for glyphs in pass_glyphs], passes), indices
+        return self.fan_out(pass_glyphs, passes), valid
+
+    @staticmethod
+    def by_font(glyphs, indices, font_file_paths):
+        """ Maps the paths of the rendered fonts to their glyphs, e.g. for datafilter.filter_fonts.
+
+        Args:
+            glyphs (np.array): Glyphs of a request from render(compact=True)
+            indices (np.array): Indices of the rendered fonts from render(compact=True)
+            font_file_paths (list): Paths given to render
+        """
+        return {font_file_paths[idx]: glyphs[row] for row, idx in enumerate(indices)}
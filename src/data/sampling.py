@@ -0,0 +1,202 @@
+""" Family-, category- and weight-aware sampling of fonts for training.
+
+A few large families dominate the font database, so iterating over
+font_file_list() shows them in every batch. SamplingIndex keeps only the
+paths and integer group codes of the fonts and provides
+
+    weighted_sampler:    endless stream, fonts weighted by 1 / group_size**alpha
+    stratified_sampler:  epochs with up to n fonts of every group, interleaved
+
+Usage:
+    index = SamplingIndex.from_font_db(split='train')
+    paths = index.stratified_sampler('family', per_group=2, seed=0)
+    dataset = as_dataset(paths)
+"""
+
+import itertools
+import os
+import numpy as np
+from . import fontdb_handler
+
+GROUP_KEYS = ('family', 'category', 'weight')
+
+
+def _group_values(font_path, entry):
+    metadata = entry.get('metadata', {})
+    return {'family': fontdb_handler.font_family(font_path, entry),
+            'category': metadata.get('category', 'UNKNOWN'),
+            'weight': str(metadata.get('weight', 'UNKNOWN'))}
+
+
+class SamplingIndex:
+    """ Paths of fonts and their family, category and weight as integer codes. """
+
+    def __init__(self, paths, codes, names):
+        """
+        Args:
+            paths (list): Paths of the fonts
+            codes (Dictionary): Group key as key and array of codes (one per font) as value
+            names (Dictionary): Group key as key and list of group names (indexed by code) as value
+        """
+        self.paths = np.asarray(paths)
+        self.codes = codes
+        self.names = names
+
+    @classmethod
+    def from_font_db(cls, split=None, usable_only=True):
+        """ Builds the index from the json font database.
+
+        The family of fonts without METADATA.pb is their content hash (see
+        fontdb_handler.font_family). Newly computed hashes are written back to
+        the database, so later builds don't read the font files again.
+
+        Args:
+            split (str, optional): Only fonts of this split (see fontdb_handler.assign_splits).
+                Defaults to None: all fonts.
+            usable_only (bool, optional): Only fonts that passed the filters. Defaults to True.
+        """
+        paths = []
+        lookups = {key: {} for key in GROUP_KEYS}
+        codes = {key: [] for key in GROUP_KEYS}
+        hashed = {}
+        for font_path, entry in fontdb_handler.load_font_db().items():
+            if usable_only and not entry.get('usable', True):
+                continue
+            if split is not None and entry.get('split') != split:
+                continue
+            paths.append(font_path)
+            had_hash = 'sha256' in entry
+            for key, value in _group_values(font_path, entry).items():
+                codes[key].append(lookups[key].setdefault(value, len(lookups[key])))
+            if not had_hash and 'sha256' in entry:
+                hashed[font_path] = entry
+        fontdb_handler.add_fonts(hashed)
+        return cls(paths,
+                   {key: np.asarray(values, dtype=np.int32) for key, values in codes.items()},
+                   {key: list(lookup) for key, lookup in lookups.items()})
+
+    def save(self, path):
+        """ Writes the index as npz file. """
+        np.savez(path, paths=self.paths,
+                 **{f"codes_{key}": codes for key, codes in self.codes.items()},
+                 **{f"names_{key}": np.asarray(names) for key, names in self.names.items()})
+
+    @classmethod
+    def load(cls, path):
+        """ Reads an index written by save. """
+        with np.load(path) as data:
+            return cls(data['paths'],
+                       {key: data[f"codes_{key}"] for key in GROUP_KEYS},
+                       {key: data[f"names_{key}"].tolist() for key in GROUP_KEYS})
+
+    def select(self, paths):
+        """ Returns the index restricted to the fonts in paths (compared as normalized paths),
+            e.g. the fonts of a split without the quarantined ones.
+        """
+        wanted = {os.path.normpath(path) for path in paths}
+        keep = np.asarray([os.path.normpath(path) in wanted for path in self.paths.tolist()], dtype=bool)
+        return SamplingIndex(self.paths[keep], {key: codes[keep] for key, codes in self.codes.items()},
+                             self.names)
+
+    def epoch_size(self, sampling, group_by='family', per_group=1):
+        """ Returns the number of fonts of one epoch: all fonts for 'weighted' and
+            up to per_group fonts of every group for 'stratified'.
+        """
+        if sampling == 'weighted':
+            return len(self.paths)
+        if sampling == 'stratified':
+            return int(np.minimum(np.bincount(self.group_codes(group_by)), per_group).sum()) if len(self.paths) else 0
+        raise ValueError(f"Unknown sampling {sampling!r}, expected 'weighted' or 'stratified'")
+
+    def __len__(self):
+        return len(self.paths)
+
+    def group_codes(self, group_by):
+        """ Returns one code per font for a group key or a tuple of group keys,
+            e.g. ('category', 'weight').
+        """
+        if isinstance(group_by, str):
+            return self.codes[group_by]
+        combined = np.stack([self.codes[key] for key in group_by], axis=1)
+        return np.unique(combined, axis=0, return_inverse=True)[1].reshape(-1)
+
+    def group_sizes(self, group_by):
+        """ Returns the number of fonts per group as dictionary name -> count (single keys only). """
+        counts = np.bincount(self.codes[group_by], minlength=len(self.names[group_by]))
+        return dict(zip(self.names[group_by], counts.tolist()))
+
+    def weights(self, group_by='family', alpha=1.):
+        """ Returns sampling probabilities per font proportional to 1 / group_size**alpha.
+
+        alpha=0 samples uniformly over fonts, alpha=1 uniformly over groups.
+        """
+        codes = self.group_codes(group_by)
+        sizes = np.bincount(codes)
+        weights = sizes[codes].astype(np.float64) ** -alpha
+        return weights / weights.sum()
+
+    def weighted_sampler(self, group_by='family', alpha=1., seed=None, chunk_size=4096):
+        """ Yields font paths endlessly, sampled with replacement by weights().
+
+        Args:
+            group_by (str or tuple, optional): Group key(s). Defaults to 'family'.
+            alpha (float, optional): Strength of the balancing. Defaults to 1.
+            seed (int, optional): Seed of the random generator. Defaults to None.
+            chunk_size (int, optional): Number of paths drawn at once. Defaults to 4096.
+        """
+        rng = np.random.default_rng(seed)
+        probabilities = self.weights(group_by, alpha)
+        while True:
+            for idx in rng.choice(len(self.paths), size=chunk_size, p=probabilities):
+                yield str(self.paths[idx])
+
+    def stratified_epoch(self, group_by='family', per_group=1, rng=None):
+        """ Returns the font paths of one epoch: up to per_group random fonts of every group.
+
+        The groups are interleaved in random order, so every stretch of the epoch
+        covers many groups.
+
+        Args:
+            group_by (str or tuple, optional): Group key(s). Defaults to 'family'.
+            per_group (int, optional): Maximum number of fonts per group. Defaults to 1.
+            rng (np.random.Generator, optional): Random generator. Defaults to None.
+
+        Returns:
+            list: Paths of the fonts
+        """
+        rng = rng or np.random.default_rng()
+        codes = self.group_codes(group_by)
+        # Random order within every group: sort by group and a random key
+        order = np.lexsort((rng.random(len(codes)), codes))
+        sorted_codes = codes[order]
+        group_starts = np.searchsorted(sorted_codes, sorted_codes, side='left')
+        rank = np.arange(len(order)) - group_starts
+        keep = rank < per_group
+        # Interleave: first pick of every group, then second picks, ...
+        group_order = rng.permutation(codes.max() + 1 if len(codes) else 0)
+        position = np.argsort(group_order)[sorted_codes]
+        selected = order[keep]
+        selected = selected[np.lexsort((position[keep], rank[keep]))]
+        return [str(path) for path in self.paths[selected]]
+
+    def stratified_sampler(self, group_by='family', per_group=1, seed=None, epochs=None):
+        """ Yields the font paths of stratified_epoch, epoch after epoch with new random picks.
+
+        Args:
+            group_by (str or tuple, optional): Group key(s). Defaults to 'family'.
+            per_group (int, optional): Maximum number of fonts per group and epoch. Defaults to 1.
+            seed (int, optional): Seed of the random generator. Defaults to None.
+            epochs (int, optional): Number of epochs. Defaults to None: endless.
+        """
+        rng = np.random.default_rng(seed)
+        for _ in (range(epochs) if epochs is not None else itertools.count()):
+            yield from self.stratified_epoch(group_by, per_group, rng)
+
+
+def as_dataset(sampler):
+    """ Wraps a sampler (or any iterable of paths) as tf.data.Dataset of path strings,
+        e.g. to map a rendering function over it.
+    """
+    import tensorflow as tf
+    return tf.data.Dataset.from_generator(lambda: sampler,
+                                          output_signature=tf.TensorSpec(shape=(), dtype=tf.string))
@@ -0,0 +1,242 @@
+""" Shard-parallel execution of the pipeline stages.
+
+A stage run with --shard i/N (see python -m src) processes only the fonts of
+its shard (fontdb_handler.select_shard) and writes its results to a shard
+output in global_consts.PATH_SHARDS instead of the shared files:
+
+    download       blob index of the shard               download.shard-001-of-004.json
+    filter         filter results and counts             filter.shard-001-of-004.json
+    classify       CLIP results                          classify.shard-001-of-004.json
+    render-export  glyphs and paths of the rendered      <name>.shard-001-of-004.npy/.json
+                   fonts, <name> is the output name
+
+Render failures are appended to failures-<stage>.shard-001-of-004.jsonl
+instead of the shared failure registry (see quarantine.defer_failures).
+
+The reduce step merges the outputs of all shards into the blob index, the
+font database and failure registry, the CLIP filter file or one rendered
+dataset. The shards can run on different nodes sharing the data directory;
+run_local runs them as local processes and reduces, e.g. for testing.
+
+Usage:
+    python -m src run-sharded filter --num-shards 4 [--parallel 2] [-- <stage args>]
+    python -m src reduce filter --num-shards 4
+"""
+
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+from . import global_consts as g
+from . import blobstore, fontdb_handler, quarantine
+
+STAGES = ('download', 'filter', 'classify', 'render-export')
+
+
+def output_path(name, shard, extension='.json'):
+    """ Returns the path of the output of a shard.
+
+    Args:
+        name (str): Name of the output, the stage or the name of the rendered dataset
+        shard (tuple): Index of the shard and number of shards
+        extension (str, optional): Defaults to '.json'.
+    """
+    index, num_shards = shard
+    return os.path.join(g.PATH_SHARDS, f"{name}.shard-{index:03d}-of-{num_shards:03d}{extension}")
+
+
+def shard_outputs(name, num_shards, extension='.json'):
+    """ Returns the outputs of all shards in shard order.
+
+    Raises:
+        FileNotFoundError: If the output of a shard is missing
+    """
+    paths = [output_path(name, (index, num_shards), extension) for index in range(num_shards)]
+    missing = [index for index, path in enumerate(paths) if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"Output {name} missing for shards {missing} of {num_shards}")
+    return paths
+
+
+def _load(path):
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def _remove(paths):
+    for path in paths:
+        for output in glob.glob(os.path.splitext(glob.escape(path))[0] + '.*'):
+            os.remove(output)
+
+
+def reduce_download(num_shards, cleanup=True):
+    """ Merges the blob indexes of the shards into the index of the store. """
+    paths = shard_outputs('download', num_shards)
+    store = blobstore.BlobStore()
+    for path in paths:
+        store.merge_index(_load(path))
+    store.save()
+    if cleanup:
+        _remove(paths)
+    print(f"Blob store: {len(store)} blobs")
+
+
+def reduce_filter(num_shards, cleanup=True):
+    """ Writes the filter results of the shards to the font database and the failure registry.
+
+    Returns:
+        Dictionary: Counts of the filters, summed over the shards
+    """
+    from . import datafilter
+    paths = shard_outputs('filter', num_shards)
+    filter_dictionary, counts = {}, {}
+    for path in paths:
+        output = _load(path)
+        filter_dictionary.update(output['filter_results'])
+        for name, value in output['counts'].items():
+            counts[name] = counts.get(name, 0) + value
+    datafilter.store_filter_results(filter_dictionary)
+    if cleanup:
+        _remove(paths)
+    print(f"Processed {counts.get('num_font_files_processed', 0)} fonts. "
+          f"Found {counts.get('num_usable_fonts', 0)} usable fonts.")
+    return counts
+
+
+def reduce_classify(num_shards, cleanup=True):
+    """ Merges the CLIP results of the shards into the CLIP filter file. """
+    paths = shard_outputs('classify', num_shards)
+    results = {}
+    for path in paths:
+        for font_path, chars in _load(path).items():
+            results.setdefault(font_path, {}).update(chars)
+    fontdb_handler.update_clip_filter(results)
+    if cleanup:
+        _remove(paths)
+    print(f"Classified {len(results)} fonts")
+
+
+def reduce_render(output, num_shards, cleanup=True):
+    """ Concatenates the rendered glyphs of the shards into <output>.npy and <output>.json
+        (see datarenderer.export_dataset). The rows are in shard order.
+
+    Returns:
+        int: Number of rendered fonts
+    """
+    name = os.path.basename(output)
+    paths = shard_outputs(name, num_shards)
+    infos = [_load(path) for path in paths]
+    arrays = [np.load(os.path.splitext(path)[0] + '.npy', mmap_mode='r') for path in paths]
+    num_fonts = sum(len(array) for array in arrays)
+
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    # Written through a memory map, so the dataset doesn't have to fit into memory twice
+    merged = np.lib.format.open_memmap(output + '.npy', mode='w+', dtype=arrays[0].dtype,
+                                       shape=(num_fonts, *arrays[0].shape[1:]))
+    start = 0
+    for array in arrays:
+        merged[start:start + len(array)] = array
+        start += len(array)
+    merged.flush()
+    del merged, arrays
+
+    with open(output + '.json', 'w', encoding='utf-8') as file:
+        json.dump({**{key: value for key, value in infos[0].items() if key != 'font_file_paths'},
+                   'font_file_paths': [path for info in infos for path in info['font_file_paths']]},
+                  file, indent=1, ensure_ascii=False)
+    if cleanup:
+        _remove(paths)
+    print(f"Rendered {num_fonts} fonts to {output}.npy")
+    return num_fonts
+
+
+def reduce(stage, num_shards, output=None, cleanup=True):
+    """ Runs the reduce step of a stage and merges the render failures of the shards.
+        output is the output path of render-export.
+
+    The outputs of all shards are checked before anything is merged, and the
+    failure files are only removed once the stage is reduced, so a failed
+    reduce can be retried.
+
+    Raises:
+        FileNotFoundError: If the output of a shard is missing
+    """
+    if stage not in STAGES:
+        raise ValueError(f"Stage {stage} can't be sharded, choose from {', '.join(STAGES)}")
+    if stage == 'render-export' and output is None:
+        raise ValueError("The reduce step of render-export needs the output path")
+    shard_outputs(os.path.basename(output) if stage == 'render-export' else stage, num_shards)
+
+    if stage == 'download':
+        result = reduce_download(num_shards, cleanup)
+    elif stage == 'filter':
+        result = reduce_filter(num_shards, cleanup)
+    elif stage == 'classify':
+        result = reduce_classify(num_shards, cleanup)
+    else:
+        result = reduce_render(output, num_shards, cleanup)
+    reduce_failures(stage, num_shards, cleanup)
+    return result
+
+
+def failures_path(stage, shard):
+    """ Returns the file the render failures of a shard are deferred to (see quarantine.defer_failures). """
+    return output_path(f"failures-{stage}", shard, extension='.jsonl')
+
+
+def reduce_failures(stage, num_shards, cleanup=True):
+    """ Records the deferred render failures of the shards in the failure registry.
+        Shards without failures have no file.
+
+    Returns:
+        int: Number of failures
+    """
+    paths = [failures_path(stage, (index, num_shards)) for index in range(num_shards)]
+    paths = [path for path in paths if os.path.exists(path)]
+    num_failures = quarantine.merge_deferred(paths)
+    if cleanup:
+        _remove(paths)
+    return num_failures
+
+
+def run_local(stage, num_shards, stage_args=(), global_args=(), parallel=None, poll_interval=0.2):
+    """ Runs all shards of a stage as local processes (python -m src) and waits for them.
+
+    Args:
+        stage (str): One of STAGES
+        num_shards (int): Number of shards
+        stage_args (list, optional): Further arguments of the stage. Defaults to ().
+        global_args (list, optional): Arguments before the stage, e.g. ['--config', 'x.toml']. Defaults to ().
+        parallel (int, optional): Shards running at the same time. Defaults to None: all.
+
+    Returns:
+        Dictionary: Index of the shard as key and exit code as value
+
+    Raises:
+        RuntimeError: If a shard failed, the reduce step must not run
+    """
+    if stage not in STAGES:
+        raise ValueError(f"Stage {stage} can't be sharded, choose from {', '.join(STAGES)}")
+    parallel = parallel or num_shards
+    pending = list(range(num_shards))
+    running, exit_codes = {}, {}
+    while pending or running:
+        while pending and len(running) < parallel:
+            index = pending.pop(0)
+            command = [sys.executable, '-m', 'src', *global_args, stage, *stage_args,
+                       '--shard', f"{index}/{num_shards}"]
+            running[index] = subprocess.Popen(command)
+        for index, process in list(running.items()):
+            if process.poll() is not None:
+                exit_codes[index] = process.returncode
+                del running[index]
+        time.sleep(poll_interval)
+
+    failed = sorted(index for index, exit_code in exit_codes.items() if exit_code != 0)
+    if failed:
+        raise RuntimeError(f"Shards {failed} of {stage} failed, not reducing")
+    return exit_codes
@@ -0,0 +1,320 @@
+""" Incremental sync of the data directories between workstations.
+
+Every synced tree (raw and processed) gets a manifest with size, modification
+time and sha256 of each file, relative to the root of the tree. Hashes are
+only recomputed for files whose size or modification time changed, so
+building the manifest of an unchanged tree only needs a stat per file.
+Files that are missing or have a different hash at the destination are
+copied in parallel, verified against the hash of the source and moved into
+place atomically. Every content is transferred once, further files with the
+same content (e.g. hardlinks to the blob store) become hardlinks. Relative paths are kept, so fonts with the same basename
+don't overwrite each other.
+
+The destination is a directory, e.g. the data directory of another
+workstation mounted via network share or an external disk. Afterwards the
+paths in the font database and the failure registry are rewritten for the
+layout of the destination.
+
+Usage:
+    python -m src.data.sync <source_data_dir> <destination_data_dir> [--workers 8] [--delete] [--dry-run]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from . import global_consts as g
+from . import fontdb_handler, metrics
+
+MANIFEST = '00manifest.json'
+SYNC_TREES = ('raw', 'processed')
+WORKERS = 8
+_PARTIAL = '.part'
+
+
+def _scan(root):
+    # Relative posix path -> os.stat_result of all files below root, except the manifest
+    files = {}
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            relative_path = os.path.relpath(path, root).replace(os.sep, '/')
+            if relative_path == MANIFEST or filename.endswith(_PARTIAL):
+                continue
+            files[relative_path] = os.stat(path)
+    return files
+
+
+def load_manifest(root):
+    """ Loads the manifest stored in root, empty if there is none. """
+    try:
+        with open(os.path.join(root, MANIFEST), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(root, manifest):
+    with open(os.path.join(root, MANIFEST), 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+
+
+def build_manifest(root, previous=None, workers=WORKERS, save=True):
+    """ Builds the content manifest of a directory tree.
+
+    Args:
+        root (str): Root of the tree
+        previous (Dictionary, optional): Earlier manifest of the tree, its hashes are reused for
+            files with the same size and modification time. Defaults to None: the manifest stored in root.
+        workers (int, optional): Threads hashing the changed files. Defaults to 8.
+        save (bool, optional): Store the manifest in root. Defaults to True.
+
+    Returns:
+        Dictionary: Relative path (with '/') as key and {'size', 'mtime_ns', 'sha256'} as value
+    """
+    if previous is None:
+        previous = load_manifest(root)
+    manifest, changed = {}, []
+    with metrics.timer('sync_scan', root=root):
+        files = _scan(root)
+    for relative_path, stat in files.items():
+        entry = previous.get(relative_path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            manifest[relative_path] = entry
+        else:
+            manifest[relative_path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            changed.append(relative_path)
+
+    with metrics.timer('sync_hash', root=root, num_files=len(changed)):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            paths = [os.path.join(root, relative_path) for relative_path in changed]
+            for relative_path, digest in zip(changed, executor.map(fontdb_handler.file_sha256, paths)):
+                manifest[relative_path]['sha256'] = digest
+    metrics.count('sync_hashed_files', len(changed))
+
+    if save:
+        save_manifest(root, manifest)
+    return manifest
+
+
+def plan_sync(source_manifest, destination_manifest):
+    """ Compares two manifests.
+
+    Returns:
+        tuple: Relative paths to copy (missing or different at the destination) and
+            relative paths only present at the destination
+    """
+    to_copy = sorted(relative_path for relative_path, entry in source_manifest.items()
+                     if destination_manifest.get(relative_path, {}).get('sha256') != entry['sha256'])
+    extra = sorted(set(destination_manifest) - set(source_manifest))
+    return to_copy, extra
+
+
+def _copy_file(source_path, destination_path, sha256, verify=True):
+    # Copies to a partial file, checks the hash and moves it into place
+    os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+    partial_path = destination_path + _PARTIAL
+    digest = hashlib.sha256()
+    with open(source_path, 'rb') as source, open(partial_path, 'wb') as destination:
+        for chunk in iter(lambda: source.read(1 << 20), b''):
+            digest.update(chunk)
+            destination.write(chunk)
+    shutil.copystat(source_path, partial_path)
+
+    if digest.hexdigest() != sha256 or (verify and fontdb_handler.file_sha256(partial_path) != sha256):
+        os.remove(partial_path)
+        raise IOError(f"Hash mismatch copying {source_path}")
+    os.replace(partial_path, destination_path)
+    return os.path.getsize(destination_path)
+
+
+def _link_file(existing_path, destination_path):
+    # Hardlinks a file with the same content instead of transferring it again
+    os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+    partial_path = destination_path + _PARTIAL
+    try:
+        os.link(existing_path, partial_path)
+    except OSError:
+        shutil.copy2(existing_path, partial_path)
+    os.replace(partial_path, destination_path)
+
+
+def sync_tree(source_root, destination_root, workers=WORKERS, verify=True, delete=False, dry_run=False):
+    """ Makes destination_root a copy of source_root, transferring only missing or changed files.
+
+    Every content is transferred once: files with the same hash (e.g. the blobs of the
+    blob store and their hardlinks in the working tree) are hardlinked at the destination
+    to a copy of the content or to a file that already has it.
+
+    Args:
+        source_root (str): Root of the source tree
+        destination_root (str): Root of the destination tree, created if missing
+        workers (int, optional): Parallel copies and hashes. Defaults to 8.
+        verify (bool, optional): Re-read every copied file and compare its hash. Defaults to True.
+        delete (bool, optional): Delete files only present at the destination. Defaults to False.
+        dry_run (bool, optional): Only return what would be done. Defaults to False.
+
+    Returns:
+        Dictionary: 'copied' (transferred or linked), 'linked', 'deleted' and 'failed' relative
+            paths and the number of 'bytes' transferred
+    """
+    os.makedirs(destination_root, exist_ok=True)
+    source_manifest = build_manifest(source_root, workers=workers)
+    destination_manifest = build_manifest(destination_root, workers=workers, save=not dry_run)
+    to_copy, extra = plan_sync(source_manifest, destination_manifest)
+
+    # Content already at the destination in files that stay, and one transfer per new content
+    pending = set(to_copy) | (set(extra) if delete else set())
+    existing = {entry['sha256']: relative_path for relative_path, entry in destination_manifest.items()
+                if relative_path not in pending}
+    to_transfer, to_link = [], []
+    for relative_path in to_copy:
+        sha256 = source_manifest[relative_path]['sha256']
+        if sha256 in existing:
+            to_link.append(relative_path)
+        else:
+            existing[sha256] = relative_path
+            to_transfer.append(relative_path)
+
+    result = {'copied': to_copy, 'linked': to_link, 'deleted': extra if delete else [], 'failed': {},
+              'bytes': sum(source_manifest[relative_path]['size'] for relative_path in to_transfer)}
+    if dry_run:
+        return result
+
+    def copy(relative_path):
+        return _copy_file(os.path.join(source_root, relative_path),
+                          os.path.join(destination_root, relative_path),
+                          source_manifest[relative_path]['sha256'], verify)
+
+    with metrics.timer('sync_copy', root=destination_root, num_files=len(to_transfer)):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {relative_path: executor.submit(copy, relative_path) for relative_path in to_transfer}
+            for relative_path, future in tqdm(futures.items(), total=len(futures), disable=not futures):
+                try:
+                    metrics.count('sync_bytes', future.result())
+                except OSError as e:
+                    result['failed'][relative_path] = str(e)
+
+    for relative_path in to_link:
+        link_source = existing[source_manifest[relative_path]['sha256']]
+        if link_source in result['failed']:
+            result['failed'][relative_path] = f"Copy of the same content failed: {link_source}"
+            continue
+        try:
+            _link_file(os.path.join(destination_root, link_source), os.path.join(destination_root, relative_path))
+            metrics.count('sync_linked_files')
+        except OSError as e:
+            result['failed'][relative_path] = str(e)
+    result['copied'] = [relative_path for relative_path in to_copy if relative_path not in result['failed']]
+    result['linked'] = [relative_path for relative_path in to_link if relative_path not in result['failed']]
+
+    for relative_path in result['deleted']:
+        os.remove(os.path.join(destination_root, relative_path))
+        destination_manifest.pop(relative_path, None)
+    # Copied files keep the modification time of the source, so only these entries need a stat
+    for relative_path in result['copied']:
+        stat = os.stat(os.path.join(destination_root, relative_path))
+        destination_manifest[relative_path] = {**source_manifest[relative_path],
+                                               'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    save_manifest(destination_root, destination_manifest)
+    return result
+
+
+def _normalize(path):
+    # Database keys may have been written on Windows
+    return os.path.normpath(path.replace('\\', '/'))
+
+
+def rewrite_paths(json_path, source_prefix, destination_prefix):
+    """ Rewrites the keys of a json file keyed by font paths (font database, failure registry)
+        from the layout of the source to the layout of the destination.
+
+    Args:
+        json_path (str): The json file, changed in place
+        source_prefix (str): Path of the raw directory as used in the keys at the source
+        destination_prefix (str): Path of the raw directory at the destination
+
+    Returns:
+        int: Number of rewritten keys
+    """
+    with open(json_path, 'r', encoding='utf-8') as file:
+        data = json.load(file)
+    source_prefix, destination_prefix = _normalize(source_prefix), os.path.normpath(destination_prefix)
+
+    rewritten, result = 0, {}
+    for path, value in data.items():
+        normalized = _normalize(path)
+        if normalized == source_prefix or normalized.startswith(source_prefix + os.sep):
+            normalized = os.path.join(destination_prefix, os.path.relpath(normalized, source_prefix))
+        if normalized != path:
+            rewritten += 1
+        result[normalized] = value
+
+    if rewritten:
+        with open(json_path, 'w', encoding='utf-8') as file:
+            json.dump(result, file, indent=4)
+    return rewritten
+
+
+def sync_data(source_dir, destination_dir, trees=SYNC_TREES, workers=WORKERS, verify=True,
+              delete=False, dry_run=False, source_prefix=None, destination_prefix=None):
+    """ Syncs the raw and processed trees of a data directory and rewrites the database paths.
+
+    Args:
+        source_dir (str): Data directory with the trees at the source
+        destination_dir (str): Data directory at the destination
+        trees (tuple, optional): Subdirectories to sync. Defaults to ('raw', 'processed').
+        source_prefix (str, optional): Raw directory as used in the database keys of the
+            source. Defaults to None: global_consts.PATH_RAW at the time of the call.
+        destination_prefix (str, optional): Raw directory as the destination will use it.
+            Defaults to None: global_consts.PATH_RAW at the time of the call.
+
+    Returns:
+        Dictionary: Result of sync_tree per tree
+    """
+    # Resolved here and not as default arguments, so g.configure after the import applies
+    source_prefix = g.PATH_RAW if source_prefix is None else source_prefix
+    destination_prefix = g.PATH_RAW if destination_prefix is None else destination_prefix
+    results = {}
+    for tree in trees:
+        if not os.path.isdir(os.path.join(source_dir, tree)):
+            continue
+        results[tree] = sync_tree(os.path.join(source_dir, tree), os.path.join(destination_dir, tree),
+                                  workers=workers, verify=verify, delete=delete, dry_run=dry_run)
+        print(f"{tree}: {len(results[tree]['copied'])} files ({results[tree]['bytes'] / 2**20:.1f} MiB, "
+              f"{len(results[tree]['linked'])} linked) {'to copy' if dry_run else 'copied'}, "
+              f"{len(results[tree]['failed'])} failed, "
+              f"{len(results[tree]['deleted'])} deleted")
+
+    if not dry_run and 'raw' in results:
+        destination_raw = os.path.join(destination_dir, 'raw')
+        for json_file in (g.JSON_FONT_DB, g.JSON_FAILURE_REGISTRY):
+            if json_file in results['raw']['copied'] and os.path.exists(os.path.join(destination_raw, json_file)):
+                rewritten = rewrite_paths(os.path.join(destination_raw, json_file),
+                                          source_prefix, destination_prefix)
+                print(f"{json_file}: rewrote {rewritten} paths")
+        # Rewriting changed the databases, the manifest has to know their new hashes
+        save_manifest(destination_raw, build_manifest(destination_raw, workers=workers, save=False))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('source_dir', help='Data directory with raw/ and processed/')
+    parser.add_argument('destination_dir')
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--delete', action='store_true', help='Delete files missing at the source')
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--no-verify', action='store_true', help="Don't re-read copied files")
+    parser.add_argument('--source-prefix', default=None,
+                        help='Raw directory as used in the database keys at the source (default: PATH_RAW)')
+    parser.add_argument('--destination-prefix', default=None,
+                        help='Raw directory as used in the database keys at the destination (default: PATH_RAW)')
+    args = parser.parse_args()
+
+    sync_data(args.source_dir, args.destination_dir, workers=args.workers, verify=not args.no_verify,
+              delete=args.delete, dry_run=args.dry_run, source_prefix=args.source_prefix,
+              destination_prefix=args.destination_prefix)
@@ -0,0 +1,281 @@
+""" Glyph quality metrics over a whole test split.
+
+The fonts are rendered once, predicted in batches and compared with the
+target glyphs per char in NumPy:
+
+    iou       intersection over union of the ink (pixels < threshold)
+    ssim      structural similarity (gaussian window 11, sigma 1.5)
+    chamfer   mean distance in pixels between the edges of prediction and target
+              (symmetric, exact euclidean distance transform)
+
+Glyphs are white (1) on black ink (0), like the normalized training data.
+
+Usage:
+    report = evaluate(model, fontdb_handler.iter_split('test'))
+    reports = compare_models({'scratch': model_a, 'efficientnet': model_b}, font_file_paths)
+
+    python -m src.model.evaluation <model.keras|model.tflite> [...] [--report report.json]
+"""
+
+import argparse
+import json
+import os
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from ..data import datarenderer, fontdb_handler
+
+METRICS = ('iou', 'ssim', 'chamfer')
+
+
+def ink(glyphs, threshold=0.5):
+    """ Returns the ink mask of glyphs (True where the glyph is drawn). """
+    return glyphs < threshold
+
+
+def iou(predictions, targets, threshold=0.5):
+    """ Intersection over union of the ink per glyph.
+
+    Args:
+        predictions (np.array): Array of shape (num_fonts, size, size, num_chars)
+        targets (np.array): Array of the same shape
+        threshold (float, optional): Values below are ink. Defaults to 0.5.
+
+    Returns:
+        np.array: Array of shape (num_fonts, num_chars). 1 if both glyphs are empty.
+    """
+    ink_predictions, ink_targets = ink(predictions, threshold), ink(targets, threshold)
+    intersection = np.sum(ink_predictions & ink_targets, axis=(1, 2))
+    union = np.sum(ink_predictions | ink_targets, axis=(1, 2))
+    return np.where(union > 0, intersection / np.maximum(union, 1), 1.)
+
+
+def _gaussian_kernel(size=11, sigma=1.5):
+    x = np.arange(size) - (size - 1) / 2
+    kernel = np.exp(-x**2 / (2 * sigma**2))
+    return kernel / kernel.sum()
+
+
+def _filter(images, kernel):
+    # Separable 'valid' convolution over the two spatial axes of (num_fonts, size, size, num_chars)
+    filtered = sliding_window_view(images, len(kernel), axis=1) @ kernel
+    return sliding_window_view(filtered, len(kernel), axis=2) @ kernel
+
+
+def ssim(predictions, targets, data_range=1., window_size=11, sigma=1.5):
+    """ Mean structural similarity per glyph.
+
+    Args:
+        predictions (np.array): Array of shape (num_fonts, size, size, num_chars)
+        targets (np.array): Array of the same shape
+        data_range (float, optional): Range of the pixel values. Defaults to 1.
+        window_size (int, optional): Size of the gaussian window. Defaults to 11.
+        sigma (float, optional): Standard deviation of the gaussian window. Defaults to 1.5.
+
+    Returns:
+        np.array: Array of shape (num_fonts, num_chars)
+    """
+    x = np.asarray(predictions, dtype=np.float64)
+    y = np.asarray(targets, dtype=np.float64)
+    kernel = _gaussian_kernel(window_size, sigma)
+    c1, c2 = (0.01 * data_range)**2, (0.03 * data_range)**2
+
+    mu_x, mu_y = _filter(x, kernel), _filter(y, kernel)
+    sigma_xx = _filter(x * x, kernel) - mu_x**2
+    sigma_yy = _filter(y * y, kernel) - mu_y**2
+    sigma_xy = _filter(x * y, kernel) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * sigma_xy + c2) /
+                ((mu_x**2 + mu_y**2 + c1) * (sigma_xx + sigma_yy + c2)))
+    return ssim_map.mean(axis=(1, 2))
+
+
+def edges(ink_mask):
+    """ Returns the ink pixels with at least one 4-neighbour that is not ink.
+
+    Args:
+        ink_mask (np.array): Boolean array of shape (num_images, height, width)
+    """
+    padded = np.pad(ink_mask, ((0, 0), (1, 1), (1, 1)), constant_values=False)
+    eroded = (padded[:, :-2, 1:-1] & padded[:, 2:, 1:-1] &
+              padded[:, 1:-1, :-2] & padded[:, 1:-1, 2:])
+    return ink_mask & ~eroded
+
+
+def distance_transform(mask):
+    """ Exact euclidean distance of every pixel to the nearest True pixel of mask.
+
+    Computed separably (columns, then rows) with brute force minima, which is
+    fast for glyph sized images. Images without True pixels get inf.
+
+    Args:
+        mask (np.array): Boolean array of shape (num_images, height, width)
+
+    Returns:
+        np.array: Distances, array of shape (num_images, height, width)
+    """
+    _, height, width = mask.shape
+    rows, cols = np.arange(height), np.arange(width)
+    # Squared distance to the nearest True pixel in the same column
+    offsets = (rows[:, np.newaxis] - rows[np.newaxis, :]).astype(np.float64)**2
+    column = np.where(mask[:, np.newaxis, :, :], offsets[np.newaxis, :, :, np.newaxis], np.inf).min(axis=2)
+    # Combine the columns: min over x' of column(y, x') + (x - x')**2
+    offsets = (cols[:, np.newaxis] - cols[np.newaxis, :]).astype(np.float64)**2
+    return np.sqrt((column[:, :, np.newaxis, :] + offsets[np.newaxis, np.newaxis]).min(axis=3))
+
+
+def chamfer(predictions, targets, threshold=0.5, chunk_size=64):
+    """ Symmetric chamfer distance between the edges of the glyphs in pixels.
+
+    Args:
+        predictions (np.array): Array of shape (num_fonts, size, size, num_chars)
+        targets (np.array): Array of the same shape
+        threshold (float, optional): Values below are ink. Defaults to 0.5.
+        chunk_size (int, optional): Images per distance transform, bounds the memory. Defaults to 64.
+
+    Returns:
+        np.array: Array of shape (num_fonts, num_chars). 0 if both glyphs are empty,
+            nan if only one of them is empty.
+    """
+    num_fonts, height, width, num_chars = predictions.shape
+    # Chars become images: (num_fonts * num_chars, size, size)
+    edges_predictions = edges(ink(predictions, threshold).transpose(0, 3, 1, 2).reshape(-1, height, width))
+    edges_targets = edges(ink(targets, threshold).transpose(0, 3, 1, 2).reshape(-1, height, width))
+
+    distances = np.empty(len(edges_predictions))
+    for start in range(0, len(distances), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        a, b = edges_predictions[chunk], edges_targets[chunk]
+        distance_to_b, distance_to_a = distance_transform(b), distance_transform(a)
+        num_a, num_b = a.sum(axis=(1, 2)), b.sum(axis=(1, 2))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            a_to_b = np.where(a, distance_to_b, 0.).sum(axis=(1, 2)) / num_a
+            b_to_a = np.where(b, distance_to_a, 0.).sum(axis=(1, 2)) / num_b
+        distances[chunk] = np.where((num_a == 0) & (num_b == 0), 0.,
+                                    np.where((num_a == 0) | (num_b == 0), np.nan, (a_to_b + b_to_a) / 2))
+    return distances.reshape(num_fonts, num_chars)
+
+
+def glyph_metrics(predictions, targets, threshold=0.5):
+    """ Computes all METRICS per glyph.
+
+    Returns:
+        Dictionary: Metric name as key and array of shape (num_fonts, num_chars) as value
+    """
+    predictions = np.clip(np.asarray(predictions, dtype=np.float32), 0., 1.)
+    targets = np.asarray(targets, dtype=np.float32)
+    return {'iou': iou(predictions, targets, threshold),
+            'ssim': ssim(predictions, targets),
+            'chamfer': chamfer(predictions, targets, threshold)}
+
+
+def summarize(metrics, charset_out):
+    """ Reduces per-glyph metrics to a compact report with the mean overall and per char.
+
+    Glyphs with undefined values (e.g. chamfer with an empty prediction) are left out
+    of the means and counted as 'undefined'.
+    """
+    report = {}
+    for name, values in metrics.items():
+        report[name] = {'mean': float(np.nanmean(values)),
+                        'median': float(np.nanmedian(values)),
+                        'undefined': int(np.isnan(values).sum()),
+                        'per_char': {char: float(np.nanmean(values[:, idx]))
+                                     for idx, char in enumerate(charset_out)}}
+    report['num_fonts'] = int(next(iter(metrics.values())).shape[0])
+    return report
+
+
+def render_test_set(font_file_paths, charset_in="AaOoUu8Bj", charset_out="ÄäÖöÜüß", size=64):
+    """ Renders the input and target glyphs of the fonts. Fonts that can't be rendered are left out.
+
+    Returns:
+        tuple: Inputs, targets (float32 in [0, 1]) and the paths of the rendered fonts
+    """
+    font_file_paths = list(font_file_paths)
+    glyphs, rendered = datarenderer.render_fonts(font_file_paths, size=size, chars=charset_in + charset_out,
+                                                 normalize=True, dtype=np.float32, compact=True)
+    return (glyphs[..., :len(charset_in)], glyphs[..., len(charset_in):],
+            [font_file_paths[idx] for idx in rendered])
+
+
+def evaluate(model, font_file_paths=None, charset_in="AaOoUu8Bj", charset_out="ÄäÖöÜüß", size=64,
+             batch_size=256, test_set=None, report_path=None, threshold=0.5):
+    """ Predicts the glyphs of all fonts in batches and computes the metrics per char.
+
+    Args:
+        model (tf.keras.Model): Model with a predict method (Keras or export.TFLiteModel)
+        font_file_paths (iterable, optional): Fonts of the test set, e.g. fontdb_handler.iter_split('test')
+        charset_in (str, optional): Input chars of the model. Defaults to "AaOoUu8Bj".
+        charset_out (str, optional): Output chars of the model. Defaults to "ÄäÖöÜüß".
+        size (int, optional): Render size. Defaults to 64.
+        batch_size (int, optional): Batch size of the predictions. Defaults to 256.
+        test_set (tuple, optional): Result of render_test_set, to reuse the rendered glyphs.
+        report_path (str, optional): Writes the report as json. Defaults to None.
+        threshold (float, optional): Values below are ink. Defaults to 0.5.
+
+    Returns:
+        Dictionary: Report of summarize
+
+    Raises:
+        ValueError: If no font of the test set could be rendered
+    """
+    if test_set is None:
+        test_set = render_test_set(font_file_paths, charset_in, charset_out, size)
+    inputs, targets, _ = test_set
+    if len(inputs) == 0:
+        raise ValueError("The test set is empty: no font could be rendered (is the split assigned? "
+                         "see fontdb_handler.assign_splits)")
+    predictions = np.concatenate([np.asarray(model.predict(inputs[start:start + batch_size], verbose=0))
+                                  for start in range(0, len(inputs), batch_size)])
+    report = summarize(glyph_metrics(predictions, targets, threshold), charset_out)
+
+    if report_path is not None:
+        with open(report_path, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=4, ensure_ascii=False)
+    return report
+
+
+def compare_models(models, font_file_paths, charset_in="AaOoUu8Bj", charset_out="ÄäÖöÜüß", size=64,
+                   batch_size=256, report_path=None):
+    """ Evaluates several models on the same rendered test set and prints a table per char.
+
+    Args:
+        models (Dictionary): Name as key and model as value
+        font_file_paths (iterable): Fonts of the test set
+
+    Returns:
+        Dictionary: Name of the model as key and report as value
+    """
+    test_set = render_test_set(font_file_paths, charset_in, charset_out, size)
+    reports = {name: evaluate(model, charset_in=charset_in, charset_out=charset_out,
+                              batch_size=batch_size, test_set=test_set)
+               for name, model in models.items()}
+
+    for metric in METRICS:
+        print(f"{metric:8s} " + " ".join(f"{char:>7s}" for char in charset_out) + "     all")
+        for name, report in reports.items():
+            print(f"{name[:8]:8s} " + " ".join(f"{report[metric]['per_char'][char]:7.3f}" for char in charset_out)
+                  + f" {report[metric]['mean']:7.3f}")
+    if report_path is not None:
+        with open(report_path, 'w', encoding='utf-8') as file:
+            json.dump(reports, file, indent=4, ensure_ascii=False)
+    return reports
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('model_paths', nargs='+', help='Trained .keras or .tflite models')
+    parser.add_argument('--split', default='test')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--report', default=None, help='Path of the json report')
+    args = parser.parse_args()
+
+    def load(model_path):
+        if model_path.endswith('.tflite'):
+            from .export import TFLiteModel
+            return TFLiteModel(model_path)
+        from .train import load_model
+        return load_model(model_path)
+
+    models = {os.path.splitext(os.path.basename(path))[0]: load(path) for path in args.model_paths}
+    compare_models(models, list(fontdb_handler.iter_split(args.split)), batch_size=args.batch_size,
+                   report_path=args.report)
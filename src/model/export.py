@@ -0,0 +1,257 @@
+""" Export of trained glyph models to TFLite, with quantized variants for CPU inference.
+
+Variants:
+    'float'    plain TFLite conversion (fp32)
+    'dynamic'  dynamic-range quantization: int8 weights, float activations
+    'int8'     full integer quantization, activations calibrated on rendered
+               glyphs of fonts from the font DB. Input and output stay float.
+
+For every variant the report contains the file size, the latency of a
+single prediction and the pixel error against the original Keras model per
+output char.
+
+Usage:
+    python -m src.model.export <model.keras> <output_dir> [--variants dynamic int8]
+"""
+
+import argparse
+import json
+import os
+import time
+import warnings
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+from ..data import datarenderer, fontdb_handler
+from .train import load_model
+
+VARIANTS = ('float', 'dynamic', 'int8')
+
+
+class TFLiteModel:
+    """ Runs a TFLite model with the predict interface of a Keras model (used by GlyphGenerator). """
+
+    def __init__(self, model, num_threads=None):
+        """
+        Args:
+            model (bytes or str): Converted model or path to a .tflite file
+            num_threads (int, optional): Threads of the interpreter. Defaults to None: TFLite default.
+        """
+        if isinstance(model, str):
+            self.interpreter = tf.lite.Interpreter(model_path=model, num_threads=num_threads)
+        else:
+            self.interpreter = tf.lite.Interpreter(model_content=model, num_threads=num_threads)
+        input_details = self.interpreter.get_input_details()[0]
+        self.input_index = input_details['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self._batch_size = None
+        # Models of convert have a fixed batch size (-1 in the signature is dynamic)
+        batch_size = int(input_details['shape_signature'][0])
+        self.fixed_batch_size = batch_size if batch_size > 0 else None
+
+    def predict(self, inputs, verbose=0):
+        """ Predicts a batch. The interpreter is resized when the batch size changes,
+            models with a fixed batch size predict the inputs in chunks of it. """
+        inputs = np.asarray(inputs, dtype=np.float32)
+        if self.fixed_batch_size is not None:
+            return self._predict_chunks(inputs)
+        if inputs.shape[0] != self._batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, inputs.shape)
+            self.interpreter.allocate_tensors()
+            self._batch_size = inputs.shape[0]
+        self.interpreter.set_tensor(self.input_index, inputs)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index)
+
+    def _predict_chunks(self, inputs):
+        if self._batch_size is None:
+            self.interpreter.allocate_tensors()
+            self._batch_size = self.fixed_batch_size
+        outputs = []
+        for start in range(0, len(inputs), self.fixed_batch_size):
+            chunk = inputs[start:start + self.fixed_batch_size]
+            # The last chunk is padded to the batch size
+            padded = np.zeros((self.fixed_batch_size, *inputs.shape[1:]), dtype=np.float32)
+            padded[:len(chunk)] = chunk
+            self.interpreter.set_tensor(self.input_index, padded)
+            self.interpreter.invoke()
+            outputs.append(self.interpreter.get_tensor(self.output_index)[:len(chunk)])
+        if not outputs:
+            output_shape = self.interpreter.get_output_details()[0]['shape'][1:]
+            return np.zeros((0, *output_shape), dtype=np.float32)
+        return np.concatenate(outputs)
+
+
+def calibration_glyphs(font_file_paths, charset_in, size=64, num_fonts=200, seed=0):
+    """ Renders the input glyphs of randomly chosen fonts for calibration and evaluation.
+
+    Args:
+        font_file_paths (list): Paths of the fonts to choose from
+        charset_in (str): Characters the model gets as input
+        size (int, optional): Render size. Defaults to 64.
+        num_fonts (int, optional): Number of fonts. Defaults to 200.
+        seed (int, optional): Seed of the choice. Defaults to 0.
+
+    Returns:
+        np.array: Array of shape (num_rendered, size, size, len(charset_in)), float32 in [0, 1]
+    """
+    rng = np.random.default_rng(seed)
+    chosen = rng.permutation(len(font_file_paths))[:num_fonts]
+    glyphs, _ = datarenderer.render_fonts([font_file_paths[idx] for idx in chosen], size=size,
+                                          chars=charset_in, normalize=True, dtype=np.float32,
+                                          compact=True)
+    return glyphs
+
+
+def convert(model, variant='dynamic', calibration=None, input_shape=None):
+    """ Converts a Keras model to TFLite.
+
+    The model is traced with a batch of one and its variables are frozen: with
+    a dynamic batch size the convolutions of subclassed models (train.AutoEncoder)
+    don't convert to TFLite builtins, and the int8 calibration can't read
+    unfrozen variables. TFLiteModel predicts larger batches one sample at a time.
+
+    Args:
+        model (tf.keras.Model): The trained model
+        variant (str, optional): One of VARIANTS. Defaults to 'dynamic'.
+        calibration (np.array, optional): Input glyphs for the calibration, required for 'int8'.
+        input_shape (tuple, optional): Shape of one sample (size, size, num_chars_in).
+            Defaults to None: the shape of the calibration glyphs.
+
+    Returns:
+        bytes: The converted model
+    """
+    if input_shape is None:
+        if calibration is None:
+            raise ValueError("The input shape is needed without calibration glyphs")
+        input_shape = calibration.shape[1:]
+    function = tf.function(lambda inputs: model(inputs, training=False))
+    concrete_function = function.get_concrete_function(tf.TensorSpec([1, *input_shape], tf.float32))
+    converter = tf.lite.TFLiteConverter.from_concrete_functions(
+        [convert_variables_to_constants_v2(concrete_function)])
+    if variant == 'dynamic':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif variant == 'int8':
+        if calibration is None or len(calibration) == 0:
+            raise ValueError("Full integer quantization needs calibration glyphs")
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([sample[np.newaxis]] for sample in calibration)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif variant != 'float':
+        raise ValueError(f"Unknown variant: {variant}")
+    return converter.convert()
+
+
+def measure_latency(model, glyphs_in, repeats=50, warmup=5):
+    """ Returns the median and 95th percentile latency of single predictions in milliseconds.
+
+    Keras models are called directly: predict has a setup overhead per call that is much
+    larger than the forward pass of a single sample. The first warmup calls (tracing,
+    tensor allocation) are not measured.
+    """
+    if isinstance(model, TFLiteModel):
+        predict = model.predict
+    else:
+        predict = lambda sample: model(sample, training=False)
+    latencies = []
+    for idx in range(warmup + repeats):
+        sample = glyphs_in[idx % len(glyphs_in)][np.newaxis]
+        start = time.perf_counter()
+        np.asarray(predict(sample))
+        if idx >= warmup:
+            latencies.append((time.perf_counter() - start) * 1000.)
+    return {'latency_ms_median': float(np.median(latencies)),
+            'latency_ms_p95': float(np.percentile(latencies, 95))}
+
+
+def pixel_errors(reference, predictions, charset_out):
+    """ Compares predictions with the reference predictions of the original model.
+
+    Returns:
+        Dictionary: Mean absolute error overall and per char, and the share of pixels
+            that flip when thresholded at 0.5
+    """
+    reference = np.clip(reference, 0., 1.)
+    predictions = np.clip(predictions, 0., 1.)
+    abs_error = np.abs(reference - predictions)
+    flipped = (reference > 0.5) != (predictions > 0.5)
+    return {'mean_abs_error': float(abs_error.mean()),
+            'flipped_pixels': float(flipped.mean()),
+            'mean_abs_error_per_char': {char: float(value) for char, value in
+                                        zip(charset_out, abs_error.mean(axis=(0, 1, 2)))}}
+
+
+def export_model(model_path, output_dir, variants=('dynamic', 'int8'), font_file_paths=None,
+                 charset_in="AaOoUu8Bj", charset_out="ÄäÖöÜüß", size=64, num_calibration=200,
+                 num_evaluation=100, custom_objects=None):
+    """ Converts a trained model into TFLite variants and writes them with a report.
+
+    Calibration and evaluation use different fonts of the font DB.
+
+    Args:
+        model_path (str): Path to the .keras model
+        output_dir (str): Directory for the .tflite files and export_report.json
+        variants (tuple, optional): Variants to export. Defaults to ('dynamic', 'int8').
+        font_file_paths (list, optional): Fonts for calibration and evaluation. Defaults to
+            None: the usable fonts of the font DB.
+        charset_in (str, optional): Input chars of the model. Defaults to "AaOoUu8Bj".
+        charset_out (str, optional): Output chars of the model. Defaults to "ÄäÖöÜüß".
+        size (int, optional): Render size. Defaults to 64.
+        num_calibration (int, optional): Fonts used for the int8 calibration. Defaults to 200.
+        num_evaluation (int, optional): Fonts used to compare the variants. Defaults to 100.
+        custom_objects (dict, optional): Custom layers/models needed to load the model. Defaults to None.
+
+    Returns:
+        Dictionary: The report, one entry per variant and one for the original model
+
+    Raises:
+        ValueError: If no fonts are left for the evaluation after the calibration
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    model = load_model(model_path, custom_objects)
+    if font_file_paths is None:
+        font_file_paths = fontdb_handler.font_file_list()
+
+    glyphs = calibration_glyphs(font_file_paths, charset_in, size, num_calibration + num_evaluation)
+    calibration, evaluation = glyphs[:num_calibration], glyphs[num_calibration:]
+    if len(evaluation) == 0:
+        raise ValueError(f"Only {len(glyphs)} fonts could be rendered, none left for the evaluation "
+                         f"after {num_calibration} calibration fonts. Lower num_calibration.")
+    if len(evaluation) < num_evaluation:
+        warnings.warn(f"Only {len(evaluation)} of {num_evaluation} evaluation fonts could be rendered")
+    reference = np.asarray(model.predict(evaluation, verbose=0))
+
+    report = {'original': {'path': model_path,
+                           'size_bytes': os.path.getsize(model_path),
+                           **measure_latency(model, evaluation)}}
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    for variant in variants:
+        tflite_model = convert(model, variant, calibration, input_shape=(size, size, len(charset_in)))
+        path = os.path.join(output_dir, f"{name}_{variant}.tflite")
+        with open(path, 'wb') as file:
+            file.write(tflite_model)
+        interpreter = TFLiteModel(tflite_model)
+        report[variant] = {'path': path,
+                           'size_bytes': len(tflite_model),
+                           **measure_latency(interpreter, evaluation),
+                           **pixel_errors(reference, interpreter.predict(evaluation), charset_out)}
+        print(f"{variant}: {len(tflite_model) / 1024:.0f} KiB, "
+              f"{report[variant]['latency_ms_median']:.2f} ms, "
+              f"mean abs error {report[variant]['mean_abs_error']:.4f}")
+
+    with open(os.path.join(output_dir, 'export_report.json'), 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=4, ensure_ascii=False)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('model_path', help='Path to the trained .keras model')
+    parser.add_argument('output_dir')
+    parser.add_argument('--variants', nargs='+', default=['dynamic', 'int8'], choices=VARIANTS)
+    parser.add_argument('--num-calibration', type=int, default=200)
+    parser.add_argument('--num-evaluation', type=int, default=100)
+    args = parser.parse_args()
+
+    export_model(args.model_path, args.output_dir, variants=args.variants,
+                 num_calibration=args.num_calibration, num_evaluation=args.num_evaluation)
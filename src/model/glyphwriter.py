@@ -0,0 +1,292 @@
+""" Turns generated glyph bitmaps into outlines and writes them into font files.
+
+The model outputs glyphs as (size, size) arrays. This module traces the ink of
+such a bitmap into closed contours, simplifies them and fits quadratic curves,
+and inserts the result into a copy of the source font under the cmap entries
+of the generated chars (Ä, ä, Ö, ö, Ü, ü, ß).
+
+The bitmap coordinates are mapped to font units with the same layout that
+datarenderer.render_font uses for rendering, so generated glyphs share the
+baseline and scale of the existing glyphs.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from fontTools import ttLib
+from fontTools.pens.reverseContourPen import ReverseContourPen
+from ..data import fontcache, fontwriter
+
+# Existing glyphs whose advance width is used for the generated glyphs
+BASE_CHARS = {'Ä': 'A', 'ä': 'a', 'Ö': 'O', 'ö': 'o', 'Ü': 'U', 'ü': 'u'}
+
+
+def trace_contours(bitmap, threshold=0.5):
+    """ Traces the outlines of the ink in a bitmap along the pixel edges.
+
+    Ink is dark (value < threshold), as in the normalized, not inverted renderings.
+    Contours are oriented so that the ink lies on the left in image coordinates
+    (y pointing down), which is clockwise for outer contours once y points up.
+
+    Args:
+        bitmap (np.array): Array of shape (height, width)
+        threshold (float, optional): Values below are ink. Defaults to 0.5.
+
+    Returns:
+        list: Closed contours as arrays of shape (num_points, 2) with (x, y) pixel corners
+    """
+    ink = np.pad(np.asarray(bitmap) < threshold, 1)
+    inner = ink[1:-1, 1:-1]
+
+    # Edges of ink pixels that border a background pixel, as (x0, y0, x1, y1)
+    edges = []
+    rows, cols = np.nonzero(inner & ~ink[:-2, 1:-1])   # top
+    edges.append(np.stack([cols + 1, rows, cols, rows], axis=1))
+    rows, cols = np.nonzero(inner & ~ink[2:, 1:-1])    # bottom
+    edges.append(np.stack([cols, rows + 1, cols + 1, rows + 1], axis=1))
+    rows, cols = np.nonzero(inner & ~ink[1:-1, :-2])   # left
+    edges.append(np.stack([cols, rows, cols, rows + 1], axis=1))
+    rows, cols = np.nonzero(inner & ~ink[1:-1, 2:])    # right
+    edges.append(np.stack([cols + 1, rows + 1, cols + 1, rows], axis=1))
+    edges = np.concatenate(edges)
+
+    successors = {}
+    for x0, y0, x1, y1 in edges.tolist():
+        successors.setdefault((x0, y0), []).append((x1, y1))
+
+    contours = []
+    while successors:
+        start = next(iter(successors))
+        contour = [start]
+        point = start
+        while True:
+            targets = successors[point]
+            next_point = targets.pop()
+            if not targets:
+                del successors[point]
+            if next_point == start:
+                break
+            contour.append(next_point)
+            point = next_point
+        contours.append(np.array(contour, dtype=np.float64))
+    return contours
+
+
+def _remove_collinear(contour):
+    previous = np.roll(contour, 1, axis=0)
+    following = np.roll(contour, -1, axis=0)
+    cross = ((contour[:, 0] - previous[:, 0]) * (following[:, 1] - contour[:, 1])
+             - (contour[:, 1] - previous[:, 1]) * (following[:, 0] - contour[:, 0]))
+    return contour[cross != 0]
+
+
+def _douglas_peucker(points, tolerance):
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first], points[last]
+        segment = end - start
+        length = np.hypot(*segment)
+        between = points[first + 1:last] - start
+        if length == 0:
+            distances = np.hypot(between[:, 0], between[:, 1])
+        else:
+            distances = np.abs(segment[0] * between[:, 1] - segment[1] * between[:, 0]) / length
+        idx = int(np.argmax(distances))
+        if distances[idx] > tolerance:
+            split = first + 1 + idx
+            keep[split] = True
+            stack.extend([(first, split), (split, last)])
+    return points[keep]
+
+
+def simplify_contour(contour, tolerance=0.8):
+    """ Removes the pixel staircase of a traced contour (Douglas-Peucker).
+
+    Args:
+        contour (np.array): Closed contour of shape (num_points, 2)
+        tolerance (float, optional): Maximum deviation in pixels. Defaults to 0.8.
+
+    Returns:
+        np.array: Simplified closed contour
+    """
+    contour = _remove_collinear(contour)
+    if len(contour) <= 4:
+        return contour
+    # Split the closed contour at the point farthest from the first one
+    far = int(np.argmax(np.hypot(*(contour - contour[0]).T)))
+    first_half = _douglas_peucker(contour[:far + 1], tolerance)
+    second_half = _douglas_peucker(np.concatenate([contour[far:], contour[:1]]), tolerance)
+    return np.concatenate([first_half[:-1], second_half[:-1]])
+
+
+def fit_curves(contour, corner_angle=80.):
+    """ Marks the points of a simplified contour as on- or off-curve.
+
+    Points where the contour turns by more than corner_angle stay sharp corners.
+    All other points become off-curve control points of quadratic curves, whose
+    on-curve points are implied halfway between two control points.
+
+    Args:
+        contour (np.array): Closed contour of shape (num_points, 2)
+        corner_angle (float, optional): Minimum turn in degrees for a corner. Defaults to 80.
+
+    Returns:
+        np.array: Boolean array, True for on-curve points
+    """
+    incoming = contour - np.roll(contour, 1, axis=0)
+    outgoing = np.roll(contour, -1, axis=0) - contour
+    angle_in = np.arctan2(incoming[:, 1], incoming[:, 0])
+    angle_out = np.arctan2(outgoing[:, 1], outgoing[:, 0])
+    turn = np.degrees(np.abs((angle_out - angle_in + np.pi) % (2 * np.pi) - np.pi))
+    return turn >= corner_angle
+
+
+def draw_contour(pen, points, on_curve):
+    """ Draws one closed contour with quadratic curves to a fontTools pen. """
+    points = [tuple(point) for point in points]
+    if not np.any(on_curve):
+        pen.qCurveTo(*points, None)
+        pen.closePath()
+        return
+    first = int(np.argmax(on_curve))
+    points = points[first:] + points[:first]
+    on_curve = np.roll(on_curve, -first)
+
+    pen.moveTo(points[0])
+    off_curve = []
+    for point, is_on_curve in zip(points[1:], on_curve[1:]):
+        if not is_on_curve:
+            off_curve.append(point)
+        elif off_curve:
+            pen.qCurveTo(*off_curve, point)
+            off_curve = []
+        else:
+            pen.lineTo(point)
+    if off_curve:
+        pen.qCurveTo(*off_curve, points[0])
+    pen.closePath()
+
+
+def vectorize_glyph(bitmap, scale, origin, threshold=0.5, tolerance=0.8, corner_angle=80.):
+    """ Converts a glyph bitmap to outlines in font units.
+
+    Args:
+        bitmap (np.array): Array of shape (height, width), ink is dark
+        scale (float): Font units per pixel
+        origin (tuple): (x, y) pixel position of the glyph origin on the baseline
+        threshold (float, optional): Values below are ink. Defaults to 0.5.
+        tolerance (float, optional): Simplification tolerance in pixels. Defaults to 0.8.
+        corner_angle (float, optional): Minimum turn in degrees for a corner. Defaults to 80.
+
+    Returns:
+        list: Tuples (points, on_curve) per contour, points in font units with y pointing up
+    """
+    outlines = []
+    for contour in trace_contours(bitmap, threshold):
+        contour = simplify_contour(contour, tolerance)
+        if len(contour) < 3:
+            continue
+        points = np.empty_like(contour)
+        points[:, 0] = (contour[:, 0] - origin[0]) * scale
+        points[:, 1] = (origin[1] - contour[:, 1]) * scale
+        outlines.append((np.round(points).astype(int), fit_curves(contour, corner_angle)))
+    return outlines
+
+
+def insert_glyphs(font_file_path, glyphs, chars="ÄäÖöÜüß", output_path=None, size=None,
+                  overwrite=False, threshold=0.5):
+    """ Writes generated glyphs into a copy of a font file.
+
+    Args:
+        font_file_path (str): Path to the source font file (ttf, otf)
+        glyphs (np.array): Generated glyphs of shape (size, size, len(chars)), normalized, ink is dark
+        chars (str, optional): The generated chars. Defaults to "ÄäÖöÜüß".
+        output_path (str, optional): Path of the new font file. Defaults to '<name>_umlauts.<ext>'
+            next to the source font.
+        size (int, optional): Render size the glyphs were generated with. Defaults to glyphs.shape[0].
+        overwrite (bool, optional): Replace chars the font already has. Defaults to False.
+        threshold (float, optional): Values below are ink. Defaults to 0.5.
+
+    Returns:
+        Dictionary: 'output_path' and the list of 'inserted' chars
+    """
+    if size is None:
+        size = glyphs.shape[0]
+    if output_path is None:
+        root, ext = os.path.splitext(font_file_path)
+        output_path = f"{root}_umlauts{ext}"
+
+    font = ttLib.TTFont(font_file_path)
+    is_cff = fontwriter.check_outlines(font)
+
+    # Same layout as datarenderer.render_font: text starts at 0.15*size from the top left
+    font_size = int(0.7*size)
+    ascent, _ = fontcache.get_freetype_font(font_file_path, font_size).getmetrics()
+    origin = (int(0.15*size), int(0.15*size) + ascent)
+    scale = font['head'].unitsPerEm / font_size
+
+    cmap = font.getBestCmap() or {}
+    inserted = []
+    for idx, char in enumerate(chars):
+        if ord(char) in cmap and not overwrite:
+            continue
+        outlines = vectorize_glyph(glyphs[:, :, idx], scale, origin, threshold)
+
+        def draw(pen):
+            # The traced contours are clockwise, CFF outlines are counter-clockwise
+            if is_cff:
+                pen = ReverseContourPen(pen)
+            for points, on_curve in outlines:
+                draw_contour(pen, points, on_curve)
+
+        base_char = BASE_CHARS.get(char)
+        advance = None
+        if base_char is not None and ord(base_char) in cmap:
+            advance = font['hmtx'][cmap[ord(base_char)]][0]
+        fontwriter.add_glyph(font, char, draw, advance)
+        inserted.append(char)
+
+    try:
+        fontwriter.save_font(font, output_path)
+    finally:
+        font.close()
+    return {'output_path': output_path, 'inserted': inserted}
+
+
+def _insert_glyphs_job(job):
+    font_file_path, glyphs, output_path, kwargs = job
+    try:
+        return insert_glyphs(font_file_path, glyphs, output_path=output_path, **kwargs)
+    except Exception as e:
+        return {'output_path': None, 'inserted': [], 'error': str(e)}
+
+
+def insert_glyphs_batch(font_file_paths, glyphs, output_dir, max_workers=None, **kwargs):
+    """ Writes generated glyphs into many fonts in parallel worker processes.
+
+    Args:
+        font_file_paths (list): Paths to the source fonts
+        glyphs (np.array): Generated glyphs of shape (len(font_file_paths), size, size, num_chars)
+        output_dir (str): Directory for the new font files
+        max_workers (int, optional): Number of processes. Defaults to the number of CPUs.
+        **kwargs: Further arguments for insert_glyphs (chars, size, overwrite, threshold)
+
+    Returns:
+        list: Result of insert_glyphs per source font, in the order of font_file_paths
+            (the same font may appear several times)
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = []
+    for idx, font_file_path in enumerate(font_file_paths):
+        root, ext = os.path.splitext(os.path.basename(font_file_path))
+        output_path = os.path.join(output_dir, f"{idx:06d}_{root}_umlauts{ext}")
+        jobs.append((font_file_path, glyphs[idx], output_path, kwargs))
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_insert_glyphs_job, jobs, chunksize=8))
+    return results
@@ -3,6 +3,7 @@ import numpy as np
 import datetime
 import os
 from contextlib import redirect_stdout
+from ..data import datarenderer
 
 def render_charset(charset, show_plot=True, figsize=None):
     """
@@ -22,8 +23,87 @@ def render_charset(charset, show_plot=True, figsize=None):
     else:
         return fig, axs
 
+def high_contrast(prediction, temp=0.05):
+    """
+    Increases the contrast of a prediction with a fermi-dirac function.
+
+    Args:
+        prediction (np.array): Prediction with values between 0 and 1
+        temp (float, optional): Temperature of the fermi-dirac function. Defaults to 0.05.
+
+    Returns:
+        np.array: Prediction in high contrast
+    """
+    #prediction = np.where(prediction > 0.4, 1, 0)
+    return 1 / (1 + np.exp(-(prediction - 0.5)/temp))
+
+def predict_examples(model, dataset_test, num_examples=4, model_type="3dTensor-3dTensor"):
+    """
+    Takes one batch of the test dataset and predicts it with a single call of model.predict.
+
+    Args:
+        model (tf.keras.Model): Model to predict with
+        dataset_test (tf.data.Dataset): Batched test dataset
+        num_examples (int, optional): Number of examples to keep. Defaults to 4.
+
+    Returns:
+        tuple: (inputs, targets, predictions) as numpy arrays. For the model type
+            "2dGrid-OneHot-SingleGlyph" inputs is the tuple (images_in, one_hot_in).
+
+    Raises:
+        ValueError: If the dataset is empty
+    """
+    if model_type == "3dTensor-3dTensor":
+        batch = next(iter(dataset_test), None)
+    elif model_type == "2dGrid-OneHot-SingleGlyph":
+        batch = next(iter(dataset_test.shuffle(1024).take(1)), None)
+    else:
+        raise ValueError(f"Unknown model_type {model_type}")
+    if batch is None:
+        raise ValueError("The test dataset is empty, there are no examples to predict")
+
+    input, target = batch
+    if model_type == "3dTensor-3dTensor":
+        inputs = np.asarray(input)[:num_examples]
+    else:
+        inputs = (np.asarray(input[0])[:num_examples], np.asarray(input[1])[:num_examples])
+    targets = np.asarray(target)[:num_examples]
+    predictions = model.predict(inputs, verbose=0)
+    return inputs, targets, predictions
+
+def prediction_mosaic(examples, black_white=False, model_type="3dTensor-3dTensor"):
+    """
+    Composes predicted examples into a single image. Each row holds one example with
+    the input glyphs, the target glyphs and the predicted glyphs.
+
+    Args:
+        examples (tuple): (inputs, targets, predictions) from predict_examples
+        black_white (bool, optional): Render the predictions in high contrast. Defaults to False.
+
+    Returns:
+        np.array: 2D mosaic with values between 0 and 1
+    """
+    inputs, targets, predictions = examples
+    if black_white:
+        predictions = high_contrast(predictions)
+
+    tiles = []
+    if model_type == "3dTensor-3dTensor":
+        num_cols = inputs.shape[3] + targets.shape[3] + predictions.shape[3]
+        for idx in range(inputs.shape[0]):
+            for array in (inputs, targets, predictions):
+                tiles.extend(np.moveaxis(array[idx], -1, 0))
+    elif model_type == "2dGrid-OneHot-SingleGlyph":
+        num_cols = 3
+        for idx in range(targets.shape[0]):
+            tiles.extend([inputs[0][idx], targets[idx], predictions[idx]])
+    else:
+        raise ValueError(f"Unknown model_type {model_type}")
+    return datarenderer.glyph_mosaic(tiles, num_cols, padding=2, pad_value=1.)
+
 def render_predictions(model, dataset_test, num_examples=4, figsize=(10, 10), 
-                       black_white=False, show_plot=True, model_type="3dTensor-3dTensor"):
+                       black_white=False, show_plot=True, model_type="3dTensor-3dTensor",
+                       examples=None):
     """
     Renders the predictions of a model on the test dataset.
 
@@ -34,6 +114,8 @@ def render_predictions(model, dataset_test, num_examples=4, figsize=(10, 10),
         figsize (tuple, optional): Size of the figure. Defaults to (10, 10).
         black_white (bool, optional): Render the predictions in high contrast. Defaults to False.
         show_plot (bool, optional): Show the plot. Defaults to True.
+        examples (tuple, optional): Result of predict_examples to reuse. Defaults to None:
+            the examples are predicted from dataset_test.
 
     Returns:
         None if show_plot is True, else (fig, axs)
@@ -41,25 +123,25 @@ def render_predictions(model, dataset_test, num_examples=4, figsize=(10, 10),
     """
     if num_examples < 2:
         raise ValueError("num_examples must be at least 2")
-    
+
+    if examples is None:
+        examples = predict_examples(model, dataset_test, num_examples, model_type)
+    inputs, targets, predictions = examples
+
     if model_type == "3dTensor-3dTensor":
-        x_val, y_val = next(iter(dataset_test))
-        
-        num_glyphs_x = x_val.shape[3]
-        num_glyphs_y = y_val.shape[3]
+        num_examples = min(num_examples, inputs.shape[0])
+        num_glyphs_x = inputs.shape[3]
+        num_glyphs_y = targets.shape[3]
+        if black_white:
+            predictions = high_contrast(predictions)
 
         fig, axs = plt.subplots(num_examples, 
                                 num_glyphs_x + num_glyphs_y*2, 
                                 figsize=figsize)
         for idx in range(num_examples):
-            input_img = x_val[idx, :, :, :]
-            target_img = y_val[idx, :, :, :]
-            prediction = model.predict(input_img[np.newaxis, :, :, :], verbose=0)
-            if black_white:
-                #prediction = np.where(prediction > 0.4, 1, 0)
-                # increasing the contrast of the prediction with a fermi-dirac function
-                temp = 0.05
-                prediction = 1 / (1 + np.exp(-(prediction - 0.5)/temp))
+            input_img = inputs[idx, :, :, :]
+            target_img = targets[idx, :, :, :]
+            prediction = predictions[idx, :, :, :]
             for idx2 in range(num_glyphs_x):
                 axs[idx, idx2].imshow(input_img[:, :, idx2], cmap="gray")
                 axs[idx, idx2].set_xticks([])
@@ -71,37 +153,34 @@ def render_predictions(model, dataset_test, num_examples=4, figsize=(10, 10),
                 axs[idx, num_glyphs_x + idx2].set_yticks([])
                 axs[idx, num_glyphs_x + idx2].set_title("Target")
             for idx2 in range(num_glyphs_y):
-                axs[idx, num_glyphs_x + num_glyphs_y + idx2].imshow(prediction[0, :, :, idx2], cmap="gray")
+                axs[idx, num_glyphs_x + num_glyphs_y + idx2].imshow(prediction[:, :, idx2], cmap="gray")
                 axs[idx, num_glyphs_x + num_glyphs_y + idx2].set_xticks([])
                 axs[idx, num_glyphs_x + num_glyphs_y + idx2].set_yticks([])
                 axs[idx, num_glyphs_x + num_glyphs_y + idx2].set_title("Prediction")
     elif model_type == "2dGrid-OneHot-SingleGlyph":
-        for input, target in dataset_test.shuffle(1024).take(1):
-            batch_size = input[1].shape[0]
-            images_in = input[0]
-            one_hot_in = input[1]
-            num_predictions_to_plot = num_examples if batch_size > num_examples else batch_size
-            prediction = model.predict(input)
-            temp = 0.05
-            prediction_bw = 1 / (1 + np.exp(-(prediction - 0.5)/temp))
-            fig, axs = plt.subplots(num_predictions_to_plot, 4, figsize=(10, 2.5*num_predictions_to_plot))
-            for i in range(num_predictions_to_plot):
-                axs[i, 0].imshow(images_in[i, :, :], cmap='gray')
-                axs[i, 0].set_title("Input")
-                axs[i, 0].set_xticks([])
-                axs[i, 0].set_yticks([])
-                axs[i, 1].imshow(target[i, :, :], cmap='gray')
-                axs[i, 1].set_title(f"Target with One Hot:\n{one_hot_in[i]}")
-                axs[i, 1].set_xticks([])
-                axs[i, 1].set_yticks([])
-                axs[i, 2].imshow(prediction[i, :, :], cmap='gray')
-                axs[i, 2].set_title("Prediction")
-                axs[i, 2].set_xticks([])
-                axs[i, 2].set_yticks([])
-                axs[i, 3].imshow(prediction_bw[i, :, :], cmap='gray')
-                axs[i, 3].set_title("Prediction High Contrast")
-                axs[i, 3].set_xticks([])
-                axs[i, 3].set_yticks([])
+        images_in, one_hot_in = inputs
+        target = targets
+        prediction = predictions
+        num_predictions_to_plot = min(num_examples, target.shape[0])
+        prediction_bw = high_contrast(prediction)
+        fig, axs = plt.subplots(num_predictions_to_plot, 4, figsize=(10, 2.5*num_predictions_to_plot))
+        for i in range(num_predictions_to_plot):
+            axs[i, 0].imshow(images_in[i, :, :], cmap='gray')
+            axs[i, 0].set_title("Input")
+            axs[i, 0].set_xticks([])
+            axs[i, 0].set_yticks([])
+            axs[i, 1].imshow(target[i, :, :], cmap='gray')
+            axs[i, 1].set_title(f"Target with One Hot:\n{one_hot_in[i]}")
+            axs[i, 1].set_xticks([])
+            axs[i, 1].set_yticks([])
+            axs[i, 2].imshow(prediction[i, :, :], cmap='gray')
+            axs[i, 2].set_title("Prediction")
+            axs[i, 2].set_xticks([])
+            axs[i, 2].set_yticks([])
+            axs[i, 3].imshow(prediction_bw[i, :, :], cmap='gray')
+            axs[i, 3].set_title("Prediction High Contrast")
+            axs[i, 3].set_xticks([])
+            axs[i, 3].set_yticks([])
     if show_plot:
         plt.show()
     else:
@@ -194,7 +273,8 @@ def analyze_trainings(trainings_list):
 
 def save_summary_last_training(trainings_list, dataset_test, save_path_summary, 
                                save_path_model=None, add_prefix="", 
-                               model_type="3dTensor-3dTensor"):
+                               model_type="3dTensor-3dTensor", use_matplotlib=True,
+                               registry_path=None):
     """
     Saves a collection of possible important information about the last training.
     * the model summary
@@ -207,6 +287,10 @@ def save_summary_last_training(trainings_list, dataset_test, save_path_summary,
         save_path_summary (String): path where the summary files should be saved
         dataset_test (tf.data.Dataset): test dataset
         save_path_model (String, optional): path where the model should be saved. Default None: model is not saved.
+        use_matplotlib (bool, optional): Save the examples as titled matplotlib figures. False saves
+            plain mosaic images, which is much faster. Defaults to True.
+        registry_path (String, optional): Experiment registry the run is added to (see registry.py).
+            Default None: the run is not registered.
     """
     if "val_loss" in trainings_list[-1]["history"].history:
         val_loss_available = True
@@ -246,15 +330,34 @@ def save_summary_last_training(trainings_list, dataset_test, save_path_summary,
     fig.savefig(os.path.join(save_path_summary, f"{prefix}_loss.png"), dpi=300)
 
     # Saving the plot of 10 validation examples with input, target and prediction
-    fig, axs = render_predictions(trainings_list[-1]["history"].model, dataset_test, num_examples=10, figsize=(20, 20), show_plot=False, model_type=model_type)
-    fig.savefig(os.path.join(save_path_summary, f"{prefix}_predictions.png"), dpi=300)
-    fig, axs = render_predictions(trainings_list[-1]["history"].model, dataset_test, num_examples=10, figsize=(20, 20), black_white=True, show_plot=False, model_type=model_type)
-    fig.savefig(os.path.join(save_path_summary, f"{prefix}_predictions_black_white.png"), dpi=300)
+    # The examples are predicted once and reused for both contrast variants
+    model = trainings_list[-1]["history"].model
+    examples = predict_examples(model, dataset_test, num_examples=10, model_type=model_type)
+    for black_white, suffix in [(False, "predictions"), (True, "predictions_black_white")]:
+        path_png = os.path.join(save_path_summary, f"{prefix}_{suffix}.png")
+        if use_matplotlib:
+            fig, axs = render_predictions(model, dataset_test, num_examples=10, figsize=(20, 20), black_white=black_white,
+                                          show_plot=False, model_type=model_type, examples=examples)
+            fig.savefig(path_png, dpi=300)
+            plt.close(fig)
+        else:
+            datarenderer.save_mosaic(prediction_mosaic(examples, black_white, model_type), path_png, value_range=(0., 1.))
     #elif model_type == "2dGrid-OneHot-SingleGlyph":
 
 
+    artifacts = {"summary": os.path.join(save_path_summary, f"{prefix}_summary.txt"),
+                 "loss": os.path.join(save_path_summary, f"{prefix}_loss.png"),
+                 "predictions": os.path.join(save_path_summary, f"{prefix}_predictions.png"),
+                 "predictions_black_white": os.path.join(save_path_summary, f"{prefix}_predictions_black_white.png")}
     if save_path_model is not None:
         if not os.path.exists(save_path_model):
             os.makedirs(save_path_model)
-        trainings_list[-1]["history"].model.save(os.path.join(save_path_model, f"{prefix}_model.keras"))
+        artifacts["model"] = os.path.join(save_path_model, f"{prefix}_model.keras")
+        trainings_list[-1]["history"].model.save(artifacts["model"])
+
+    if registry_path is not None:
+        from .registry import ExperimentRegistry
+        registry = ExperimentRegistry(registry_path)
+        registry.log_training(trainings_list[-1], prefix, artifacts=artifacts, model_type=model_type)
+        registry.close()
         
\ No newline at end of file
@@ -0,0 +1,373 @@
+""" Local inference server that generates missing glyphs (ä, ö, ü, ß, ...) for font files.
+
+The trained .keras model is loaded once. Concurrent requests are collected into
+micro-batches so that a single model.predict call serves many requests.
+Umlauts that can be composed from base letter and dieresis skip the model.
+Fonts are rendered through the shared font cache and every response contains
+the generated glyphs and the analysis report of datafilter.analyse_font_file.
+
+Usage:
+    python -m src.model.inference <path_to_model.keras or .tflite> [--port 8000]
+
+    POST /generate with the raw font file as body
+    GET  /stats for batching statistics
+"""
+
+import argparse
+import base64
+import hashlib
+import io
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from PIL import Image
+from ..data import composer, datarenderer, datafilter, fontcache
+
+CHARSET_IN = "AaOoUu8Bj"
+CHARSET_OUT = "ÄäÖöÜüß"
+RENDER_SIZE = 64
+MAX_COMPOSED = 256
+MAX_UPLOADS = 256
+
+
+class GlyphGenerator:
+    """ Keeps a model loaded and micro-batches concurrent generate requests. """
+
+    def __init__(self, model, charset_in=CHARSET_IN, charset_out=CHARSET_OUT,
+                 size=RENDER_SIZE, max_batch_size=32, max_wait_ms=5, custom_objects=None,
+                 use_composites=True, composed_dir=None, max_composed=MAX_COMPOSED):
+        """
+        Args:
+            model (tf.keras.Model or String): Loaded model or path to a .keras or .tflite file
+                (see export.py)
+            charset_in (str, optional): Characters the model gets as input. Defaults to "AaOoUu8Bj".
+            charset_out (str, optional): Characters the model generates. Defaults to "ÄäÖöÜüß".
+            size (int, optional): Render size of the glyphs. Defaults to 64.
+            max_batch_size (int, optional): Maximum number of requests per predict call. Defaults to 32.
+            max_wait_ms (int, optional): Time to wait for further requests after the first
+                request of a batch arrived. Defaults to 5.
+            custom_objects (dict, optional): Custom layers/models needed to load the model. Defaults to None.
+            use_composites (bool, optional): Compose umlauts from base letter and dieresis
+                instead of generating them. Defaults to True.
+            composed_dir (str, optional): Directory for the fonts with composed umlauts, which
+                are removed once rendered. Defaults to a temporary directory.
+            max_composed (int, optional): Fonts whose composed glyphs are kept in memory. Defaults to 256.
+        """
+        if isinstance(model, str) and model.endswith('.tflite'):
+            from .export import TFLiteModel
+            model = TFLiteModel(model)
+        elif isinstance(model, str):
+            from .train import load_model
+            model = load_model(model, custom_objects)
+        self.model = model
+        self.charset_in = charset_in
+        self.charset_out = charset_out
+        self.size = size
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.use_composites = use_composites
+        self.composed_dir = composed_dir or tempfile.mkdtemp(prefix='font_composed_')
+        os.makedirs(self.composed_dir, exist_ok=True)
+
+        # Composed glyphs per (path, mtime): every font is composed once, even by concurrent requests
+        self._composed = fontcache.LRUCache(max_composed)
+
+        self.stats = {'requests': 0, 'batches': 0, 'predict_seconds': 0.}
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._batch_loop, daemon=True)
+        self._worker.start()
+
+    def submit(self, font_file_path):
+        """ Renders the input glyphs and queues them for the next batch.
+
+        Args:
+            font_file_path (str): Path to font file (ttf, otf)
+
+        Returns:
+            Future: Resolves to the generated glyphs, array of shape (size, size, len(charset_out))
+        """
+        future = Future()
+        try:
+            glyphs_in = datarenderer.render_font(font_file_path, self.size, self.charset_in,
+                                                 normalize=True, dtype=np.float32)
+        except Exception as e:
+            future.set_exception(e)
+            return future
+        self._queue.put((glyphs_in, future))
+        return future
+
+    def compose(self, font_file_path):
+        """ Renders the chars of charset_out that the font has or that can be
+            composed from base letter and dieresis.
+
+        Args:
+            font_file_path (str): Path to font file (ttf, otf)
+
+        Returns:
+            tuple: (rendered glyphs of shape (size, size, len(charset_out)) or None,
+                list of available chars, list of composed chars). The glyphs are shared
+                with other requests for the font and read-only.
+        """
+        key = (os.path.abspath(font_file_path), os.stat(font_file_path).st_mtime_ns)
+        result = self._composed.get(key, lambda: self._compose_file(font_file_path, key))
+        return result['glyphs'], result['available'], result['composed']
+
+    def _compose_file(self, font_file_path, key):
+        # Composes and renders the font, the composed font file is only needed for rendering
+        font = fontcache.get_ttfont(font_file_path)
+        cmap = font.getBestCmap() or {}
+        path_hash = hashlib.sha256(f"{key[0]}:{key[1]}".encode('utf-8')).hexdigest()
+        result = composer.compose_glyphs(font_file_path, os.path.join(self.composed_dir, path_hash),
+                                         chars=self.charset_out)
+        try:
+            available = [char for char in self.charset_out
+                         if ord(char) in cmap or char in result['composed']]
+            glyphs = None
+            if available:
+                glyphs = datarenderer.render_font(result['output_path'] or font_file_path, self.size,
+                                                  self.charset_out, normalize=True, dtype=np.float32)
+                glyphs.setflags(write=False)
+        finally:
+            if result['output_path'] is not None:
+                _remove(result['output_path'])
+        return {'glyphs': glyphs, 'available': available, 'composed': result['composed']}
+
+    def generate(self, font_file_path):
+        """ Generates the glyphs of charset_out and analyses the font file.
+
+        Umlauts that can be composed from existing glyphs are not generated by the model.
+        The model is only called if at least one char can't be composed.
+
+        Args:
+            font_file_path (str): Path to font file (ttf, otf)
+
+        Returns:
+            Dictionary: 'analysis' (str), 'glyphs' (np.array or None if the font could not
+                be rendered) and the list of 'composed' chars
+        """
+        analysis = datafilter.analyse_font_file(font_file_path)
+        composed_glyphs, available, composed = None, [], []
+        if self.use_composites:
+            try:
+                composed_glyphs, available, composed = self.compose(font_file_path)
+            except Exception as e:
+                # The model generates all chars instead
+                analysis += f"\nUmlauts could not be composed: {type(e).__name__}: {e}"
+
+        if len(available) == len(self.charset_out):
+            return {'analysis': analysis, 'glyphs': composed_glyphs, 'composed': composed}
+
+        future = self.submit(font_file_path)
+        try:
+            glyphs = future.result()
+        except Exception as e:
+            analysis += f"\nGlyphs could not be generated: {e}"
+            return {'analysis': analysis, 'glyphs': None, 'composed': []}
+        for idx, char in enumerate(self.charset_out):
+            if char in composed:
+                glyphs[:, :, idx] = composed_glyphs[:, :, idx]
+        return {'analysis': analysis, 'glyphs': glyphs, 'composed': composed}
+
+    def _batch_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            glyphs_in = np.stack([glyphs for glyphs, _ in batch])
+            start = time.perf_counter()
+            try:
+                predictions = np.asarray(self.model.predict(glyphs_in, verbose=0))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.stats['predict_seconds'] += time.perf_counter() - start
+            self.stats['requests'] += len(batch)
+            self.stats['batches'] += 1
+
+            for idx, (_, future) in enumerate(batch):
+                future.set_result(predictions[idx])
+
+
+def glyphs_to_png(glyphs):
+    """ Encodes generated glyphs as base64 PNG strings, one per char.
+
+    Args:
+        glyphs (np.array): Array of shape (size, size, num_chars) with values between 0 and 1
+
+    Returns:
+        list: base64 encoded PNG images
+    """
+    images = []
+    for idx in range(glyphs.shape[2]):
+        image = np.clip(glyphs[:, :, idx] * 255., 0, 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(image, mode='L').save(buffer, format='PNG')
+        images.append(base64.b64encode(buffer.getvalue()).decode('ascii'))
+    return images
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        # Already removed by another thread, or still open (Windows)
+        pass
+
+
+def store_upload(font_bytes, upload_dir, max_uploads=MAX_UPLOADS):
+    """ Stores an uploaded font under its content hash, so identical uploads hit the font cache.
+
+    Only the max_uploads most recently uploaded fonts are kept (see prune_uploads).
+
+    Args:
+        font_bytes (bytes): Content of the font file
+        upload_dir (str): Directory for uploaded fonts
+        max_uploads (int, optional): Fonts kept in upload_dir, None for all. Defaults to 256.
+
+    Returns:
+        str: Path to the stored font file
+    """
+    font_file_path = os.path.join(upload_dir, hashlib.sha256(font_bytes).hexdigest())
+    try:
+        # Marks the upload as recently used in the access time. The modification time stays,
+        # it is part of the keys of the font cache.
+        os.utime(font_file_path, ns=(time.time_ns(), os.stat(font_file_path).st_mtime_ns))
+    except FileNotFoundError:
+        # Concurrent requests for the same content only ever see the complete file
+        with tempfile.NamedTemporaryFile(dir=upload_dir, prefix='upload_', delete=False) as file:
+            temporary_path = file.name
+            try:
+                file.write(font_bytes)
+            except BaseException:
+                file.close()
+                _remove(temporary_path)
+                raise
+        os.replace(temporary_path, font_file_path)
+        if max_uploads is not None:
+            prune_uploads(upload_dir, max_uploads)
+    return font_file_path
+
+
+def prune_uploads(upload_dir, max_uploads):
+    """ Removes the least recently used uploads of store_upload beyond max_uploads.
+
+    Returns:
+        int: Number of removed uploads
+    """
+    uploads = []
+    for entry in os.scandir(upload_dir):
+        # Uploads are named by their hash, temporary files of running uploads are skipped
+        if len(entry.name) == 64 and entry.is_file():
+            try:
+                uploads.append((entry.stat().st_atime_ns, entry.path))
+            except FileNotFoundError:
+                pass
+    uploads.sort()
+    removed = uploads[:max(0, len(uploads) - max_uploads)]
+    for _, path in removed:
+        _remove(path)
+    return len(removed)
+
+
+def make_handler(generator, upload_dir, max_uploads=MAX_UPLOADS):
+    """ Creates the request handler class for a GlyphGenerator. """
+
+    class GlyphRequestHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status, content):
+            body = json.dumps(content).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/stats':
+                self._send_json(404, {'error': 'not found'})
+                return
+            self._send_json(200, generator.stats)
+
+        def do_POST(self):
+            if self.path != '/generate':
+                self._send_json(404, {'error': 'not found'})
+                return
+            start = time.perf_counter()
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+            except ValueError:
+                length = -1
+            if length <= 0:
+                self._send_json(400, {'error': 'expected the font file as body with a Content-Length'})
+                return
+            try:
+                font_file_path = store_upload(self.rfile.read(length), upload_dir, max_uploads)
+                result = generator.generate(font_file_path)
+                glyphs = None if result['glyphs'] is None else glyphs_to_png(result['glyphs'])
+            except Exception as e:
+                self._send_json(500, {'error': f"{type(e).__name__}: {e}"})
+                return
+            self._send_json(200, {'analysis': result['analysis'],
+                                  'chars': generator.charset_out,
+                                  'glyphs': glyphs,
+                                  'composed': result['composed'],
+                                  'seconds': time.perf_counter() - start})
+
+        def log_message(self, format, *args):
+            pass
+
+    return GlyphRequestHandler
+
+
+def serve(generator, host='127.0.0.1', port=8000, upload_dir=None, max_uploads=MAX_UPLOADS):
+    """ Serves a GlyphGenerator over HTTP until interrupted.
+
+    Args:
+        generator (GlyphGenerator): The generator to serve
+        host (str, optional): Host to bind to. Defaults to '127.0.0.1'.
+        port (int, optional): Port to bind to. Defaults to 8000.
+        upload_dir (str, optional): Directory for uploaded fonts. Defaults to a temporary directory.
+        max_uploads (int, optional): Uploaded fonts kept in upload_dir. Defaults to 256.
+    """
+    if upload_dir is None:
+        upload_dir = tempfile.mkdtemp(prefix='font_uploads_')
+    os.makedirs(upload_dir, exist_ok=True)
+
+    server = ThreadingHTTPServer((host, port), make_handler(generator, upload_dir, max_uploads))
+    print(f"Serving glyph generation on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('model_path', help='Path to the trained .keras or exported .tflite model')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5)
+    args = parser.parse_args()
+
+    serve(GlyphGenerator(args.model_path,
+                         max_batch_size=args.max_batch_size,
+                         max_wait_ms=args.max_wait_ms),
+          host=args.host, port=args.port)
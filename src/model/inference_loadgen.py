@@ -0,0 +1,75 @@
+""" Load generator for the glyph inference server.
+
+Sends font files concurrently to a running server (see inference.py) and
+reports latency percentiles and throughput as JSON.
+
+Usage:
+    python -m src.model.inference_loadgen <font files...> [--url http://127.0.0.1:8000]
+        [--concurrency 16] [--requests 200]
+"""
+
+import argparse
+import json
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+def send_font(url, font_bytes):
+    """ Sends one font file to the server and returns the latency in seconds. """
+    request = urllib.request.Request(url + '/generate', data=font_bytes, method='POST',
+                                     headers={'Content-Type': 'application/octet-stream'})
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def run_load(url, font_file_paths, num_requests=200, concurrency=16):
+    """ Sends num_requests requests with the given concurrency.
+
+    Args:
+        url (str): Base url of the server
+        font_file_paths (list): Font files that are sent round robin
+        num_requests (int, optional): Total number of requests. Defaults to 200.
+        concurrency (int, optional): Number of parallel clients. Defaults to 16.
+
+    Returns:
+        Dictionary: Latency percentiles in ms, throughput and batching statistics of the server
+    """
+    fonts = []
+    for font_file_path in font_file_paths:
+        with open(font_file_path, 'rb') as file:
+            fonts.append(file.read())
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(lambda idx: send_font(url, fonts[idx % len(fonts)]),
+                                      range(num_requests)))
+    duration = time.perf_counter() - start
+
+    with urllib.request.urlopen(url + '/stats') as response:
+        server_stats = json.loads(response.read())
+
+    latencies_ms = np.array(latencies) * 1000.
+    return {'requests': num_requests,
+            'concurrency': concurrency,
+            'seconds': duration,
+            'requests_per_second': num_requests / duration,
+            'latency_ms_p50': float(np.percentile(latencies_ms, 50)),
+            'latency_ms_p90': float(np.percentile(latencies_ms, 90)),
+            'latency_ms_p99': float(np.percentile(latencies_ms, 99)),
+            'mean_batch_size': server_stats['requests'] / max(server_stats['batches'], 1),
+            'server': server_stats}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('font_files', nargs='+')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    print(json.dumps(run_load(args.url, args.font_files, args.requests, args.concurrency), indent=4))
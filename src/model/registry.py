@@ -0,0 +1,281 @@
+""" Local experiment registry for training runs (SQLite).
+
+Every run stores its params, per-epoch metrics, duration and artifact paths
+(summary, plots, saved model). Runs can be ranked and compared with SQL
+instead of parsing the file names and summary files in models/logs.
+
+Usage:
+    registry = ExperimentRegistry()
+    registry.import_logs('../models/logs/')
+    registry.best('val_loss', n=5)
+    registry.diff(run_a, run_b)
+"""
+
+import argparse
+import ast
+import datetime
+import glob
+import json
+import os
+import re
+import sqlite3
+
+DEFAULT_REGISTRY_PATH = '../models/experiments.sqlite'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    created TEXT,
+    model_type TEXT,
+    params TEXT,
+    seconds REAL,
+    artifacts TEXT
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    epoch INTEGER NOT NULL,
+    value REAL,
+    PRIMARY KEY (run_id, name, epoch)
+);
+CREATE INDEX IF NOT EXISTS metrics_by_name ON metrics (name, value);
+"""
+
+# Keys of the summary files that hold per-epoch metrics
+_SUMMARY_METRICS = {'training_loss': 'loss', 'validation_loss': 'val_loss'}
+# Suffixes of the metrics where higher is better, all others (losses, errors) are minimized
+_MAXIMIZED_SUFFIXES = ('accuracy', 'iou', 'ssim', 'auc', 'precision', 'recall', '_per_sec')
+
+
+def higher_is_better(metric):
+    """ Returns True for metrics where higher values are better, e.g. 'val_accuracy' or 'examples_per_sec'. """
+    return metric.lower().endswith(_MAXIMIZED_SUFFIXES)
+
+
+class ExperimentRegistry:
+    """ Stores and queries training runs. """
+
+    def __init__(self, path=DEFAULT_REGISTRY_PATH):
+        """
+        Args:
+            path (str, optional): SQLite file. Defaults to '../models/experiments.sqlite'.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def log_run(self, name, params, metrics, seconds=None, artifacts=None, model_type=None, created=None):
+        """ Adds a run. A run with the same name is replaced.
+
+        Args:
+            name (str): Unique name of the run, e.g. the prefix of its log files
+            params (Dictionary): Parameters of the run (json serializable, others are stored as str)
+            metrics (Dictionary): Metric name as key and list of values per epoch as value
+            seconds (float, optional): Duration of the training. Defaults to None.
+            artifacts (Dictionary, optional): Kind of artifact as key and path as value. Defaults to None.
+            model_type (str, optional): Model type, see helperfunctions. Defaults to None.
+            created (str, optional): ISO timestamp. Defaults to now.
+
+        Returns:
+            int: Id of the run
+        """
+        created = created or datetime.datetime.now().isoformat(timespec='seconds')
+        with self.connection:
+            self.connection.execute("DELETE FROM runs WHERE name = ?", (name,))
+            cursor = self.connection.execute(
+                "INSERT INTO runs (name, created, model_type, params, seconds, artifacts) VALUES (?, ?, ?, ?, ?, ?)",
+                (name, created, model_type, json.dumps(params, default=str, ensure_ascii=False),
+                 seconds, json.dumps(artifacts or {})))
+            run_id = cursor.lastrowid
+            self.connection.executemany(
+                "INSERT INTO metrics (run_id, name, epoch, value) VALUES (?, ?, ?, ?)",
+                [(run_id, metric, epoch, float(value))
+                 for metric, values in metrics.items() for epoch, value in enumerate(values)])
+        return run_id
+
+    def log_training(self, training, name, artifacts=None, model_type=None, seconds=None):
+        """ Adds a run from an entry of trainings_list (params and Keras history).
+            seconds defaults to the 'training_seconds' of the entry (see train.py).
+        """
+        params = {key: value for key, value in training.items() if key != 'history'}
+        if seconds is None:
+            seconds = training.get('training_seconds')
+        return self.log_run(name, params, training['history'].history, seconds=seconds,
+                            artifacts=artifacts, model_type=model_type)
+
+    def _run(self, row):
+        run = dict(row)
+        run['params'] = json.loads(run['params'] or '{}')
+        run['artifacts'] = json.loads(run['artifacts'] or '{}')
+        return run
+
+    def get(self, run):
+        """ Returns a run by id or name, without metrics. """
+        column = 'id' if isinstance(run, int) else 'name'
+        row = self.connection.execute(f"SELECT * FROM runs WHERE {column} = ?", (run,)).fetchone()
+        if row is None:
+            raise KeyError(f"Unknown run: {run}")
+        return self._run(row)
+
+    def metrics(self, run, name=None):
+        """ Returns the per-epoch metrics of a run as dictionary name -> list of values. """
+        run_id = self.get(run)['id']
+        query = "SELECT name, value FROM metrics WHERE run_id = ?"
+        args = [run_id]
+        if name is not None:
+            query += " AND name = ?"
+            args.append(name)
+        result = {}
+        for row in self.connection.execute(query + " ORDER BY name, epoch", args):
+            result.setdefault(row['name'], []).append(row['value'])
+        return result
+
+    def runs(self, where=None, args=()):
+        """ Returns all runs, optionally filtered with an SQL condition on the runs table,
+            e.g. where="json_extract(params, '$.batch_size') = ?", args=(32,).
+        """
+        query = "SELECT * FROM runs" + (f" WHERE {where}" if where else "") + " ORDER BY created"
+        return [self._run(row) for row in self.connection.execute(query, args)]
+
+    def best(self, metric='val_loss', n=10, maximize=None, where=None, args=()):
+        """ Ranks runs by the best epoch of a metric.
+
+        Args:
+            metric (str, optional): Name of the metric. Defaults to 'val_loss'.
+            n (int, optional): Number of runs. Defaults to 10.
+            maximize (bool, optional): Higher is better. Defaults to None: see higher_is_better.
+            where (str, optional): SQL condition on the runs table. Defaults to None.
+            args (tuple, optional): Arguments of the condition. Defaults to ().
+
+        Returns:
+            list: Runs with 'best' value and 'best_epoch' of the metric, best first
+        """
+        if maximize is None:
+            maximize = higher_is_better(metric)
+        aggregate = 'MAX' if maximize else 'MIN'
+        query = (f"SELECT runs.*, {aggregate}(metrics.value) AS best, metrics.epoch AS best_epoch "
+                 "FROM metrics JOIN runs ON runs.id = metrics.run_id WHERE metrics.name = ?"
+                 + (f" AND ({where})" if where else "") +
+                 f" GROUP BY runs.id ORDER BY best {'DESC' if maximize else 'ASC'} LIMIT ?")
+        return [self._run(row) for row in self.connection.execute(query, (metric, *args, n))]
+
+    def diff(self, run_a, run_b):
+        """ Compares two runs.
+
+        Returns:
+            Dictionary: 'params' with the differing params as (value a, value b) and
+                'metrics' with (best a, best b) per metric of both runs, the maximum for
+                metrics where higher is better (see higher_is_better), otherwise the minimum
+        """
+        a, b = self.get(run_a), self.get(run_b)
+        params = {key: (a['params'].get(key), b['params'].get(key))
+                  for key in sorted(set(a['params']) | set(b['params']))
+                  if a['params'].get(key) != b['params'].get(key)}
+        metrics_a, metrics_b = self.metrics(a['id']), self.metrics(b['id'])
+        metrics = {}
+        for name in sorted(set(metrics_a) & set(metrics_b)):
+            best = max if higher_is_better(name) else min
+            metrics[name] = (best(metrics_a[name]), best(metrics_b[name]))
+        return {'params': params, 'metrics': metrics}
+
+    def import_logs(self, log_dir, model_dir=None):
+        """ Imports the runs written by save_summary_last_training.
+
+        Args:
+            log_dir (str): Directory with the *_summary.txt files
+            model_dir (str, optional): Directory of the saved models. Defaults to the
+                parent directory of log_dir.
+
+        Returns:
+            list: Names of the imported runs
+        """
+        if model_dir is None:
+            model_dir = os.path.dirname(os.path.normpath(log_dir))
+        names = []
+        for summary_path in sorted(glob.glob(os.path.join(log_dir, '*_summary.txt'))):
+            name = os.path.basename(summary_path)[:-len('_summary.txt')]
+            params, metrics = parse_summary_file(summary_path)
+            artifacts = {path[len(os.path.join(log_dir, name)) + 1:-4]: path
+                         for path in glob.glob(os.path.join(log_dir, glob.escape(name) + '_*.png'))}
+            artifacts['summary'] = summary_path
+            model_path = os.path.join(model_dir, f"{name}_model.keras")
+            if os.path.exists(model_path):
+                artifacts['model'] = model_path
+            # Names are <YYYYmmdd>_<HHMMSS>_<model_type>_<prefix>..., model types contain no '_'
+            created, model_type = None, params.pop('model_type', None)
+            match = re.match(r'(\d{8})_(\d{6})(?:_([^_]+))?', name)
+            if match:
+                created = datetime.datetime.strptime(''.join(match.groups()[:2]), '%Y%m%d%H%M%S').isoformat()
+                model_type = model_type or match.group(3)
+            self.log_run(name, params, metrics, seconds=params.get('training_seconds'), artifacts=artifacts,
+                         model_type=model_type, created=created)
+            names.append(name)
+        return names
+
+
+def parse_summary_file(summary_path):
+    """ Parses a *_summary.txt file of save_summary_last_training.
+
+    Returns:
+        tuple: Params (with 'model_name' and 'total_params' from the model summary)
+            and metrics (name -> list of values per epoch)
+    """
+    params, metrics = {}, {}
+    with open(summary_path, 'r', encoding='utf-8') as file:
+        lines = file.read().split('\n')
+
+    for line in lines:
+        match = re.match(r'Model: "(.*)"', line)
+        if match:
+            params['model_name'] = match.group(1)
+        match = re.match(r'Total params: ([\d,]+)', line)
+        if match:
+            params['total_params'] = int(match.group(1).replace(',', ''))
+
+    # The key-value lines follow the last line of the model summary
+    separators = [idx for idx, line in enumerate(lines) if line.startswith('_____')]
+    for line in lines[separators[-1] + 1 if separators else 0:]:
+        if ': ' not in line:
+            continue
+        key, value = line.split(': ', 1)
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        if key in _SUMMARY_METRICS:
+            metrics[_SUMMARY_METRICS[key]] = value
+        else:
+            params[key] = value
+    return params, metrics
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--registry', default=DEFAULT_REGISTRY_PATH)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_import = subparsers.add_parser('import')
+    parser_import.add_argument('log_dir')
+    parser_best = subparsers.add_parser('best')
+    parser_best.add_argument('--metric', default='val_loss')
+    parser_best.add_argument('-n', type=int, default=10)
+    parser_diff = subparsers.add_parser('diff')
+    parser_diff.add_argument('run_a')
+    parser_diff.add_argument('run_b')
+    args = parser.parse_args()
+
+    registry = ExperimentRegistry(args.registry)
+    if args.command == 'import':
+        print(f"Imported {len(registry.import_logs(args.log_dir))} runs")
+    elif args.command == 'best':
+        for run in registry.best(args.metric, args.n):
+            print(f"{run['best']:.5f}  epoch {run['best_epoch']:4d}  {run['name']}")
+    else:
+        print(json.dumps(registry.diff(args.run_a, args.run_b), indent=4, ensure_ascii=False, default=str))
+    registry.close()
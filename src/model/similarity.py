@@ -0,0 +1,352 @@
+""" Similarity index over font embeddings for style-matched retrieval.
+
+Every usable font of the font DB is rendered and embedded, e.g. with the
+latent vector of the trained encoder, CLIP image features or downsampled
+pixels. The L2-normalized vectors are stored as a memory-mapped matrix. An
+inverted file (IVF, k-means cells) with product quantization (PQ) of the
+residuals gives approximate nearest neighbours. The best PQ candidates are
+reranked with the exact cosine similarity from the memory-mapped vectors.
+
+By default about sqrt(num_fonts) cells are built and a quarter of them is
+searched. Uniformly random vectors are the worst case for the cells (recall@10
+about 0.7 with 3000 vectors), clustered embeddings like the styles of fonts
+are found almost exactly. More num_probes trade speed for recall.
+
+Index directory:
+    vectors.npy   float32 (num_fonts, dim), normalized, memory mapped
+    codes.npy     uint8 (num_fonts, num_subspaces), PQ codes in IVF cell order, memory mapped
+    ivf.npz       cell centroids, cell offsets, ids in cell order, PQ codebooks
+    index.json    font paths, embedder and render settings
+
+Usage:
+    python -m src.model.similarity build <index_dir> [--model model.keras] [--embedder clip]
+    python -m src.model.similarity query <index_dir> <font_file> [-k 10]
+"""
+
+import argparse
+import json
+import os
+import time
+import numpy as np
+from ..data import datarenderer, fontdb_handler
+
+EMBEDDERS = ('encoder', 'clip', 'pixels')
+
+
+def normalize(vectors):
+    """ Scales vectors to unit length (zero vectors stay zero). """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _nearest(x, centroids, chunk_size=8192):
+    # Index of the nearest centroid per row, chunked to bound the distance matrix
+    centroid_norms = (centroids**2).sum(axis=1)
+    assignment = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), chunk_size):
+        chunk = x[start:start + chunk_size]
+        assignment[start:start + chunk_size] = np.argmin(centroid_norms - 2 * chunk @ centroids.T, axis=1)
+    return assignment
+
+
+def kmeans(x, k, iterations=20, seed=0):
+    """ Lloyd's k-means.
+
+    Args:
+        x (np.array): Points of shape (n, dim)
+        k (int): Number of clusters, at most n
+        iterations (int, optional): Defaults to 20.
+        seed (int, optional): Seed of the initial centroids. Defaults to 0.
+
+    Returns:
+        tuple: Centroids of shape (k, dim) and the cluster of every point
+    """
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        assignment = _nearest(x, centroids)
+        counts = np.bincount(assignment, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, x)
+        # Empty clusters keep their centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, np.newaxis]
+    return centroids, _nearest(x, centroids)
+
+
+class SimilarityIndex:
+    """ IVF-PQ index with exact reranking. """
+
+    def __init__(self, vectors, centroids, offsets, ids, codebooks, codes, info):
+        self.vectors = vectors
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+        self.codebooks = codebooks
+        self.codebook_norms = (codebooks**2).sum(axis=2)
+        self.codes = codes
+        self.info = info
+        self.paths = info['font_file_paths']
+
+    @classmethod
+    def build(cls, vectors, info, num_cells=None, num_subspaces=16, iterations=20, seed=0):
+        """ Builds the index.
+
+        Args:
+            vectors (np.array): Embeddings of shape (num_fonts, dim), normalized
+            info (Dictionary): Stored in index.json, needs 'font_file_paths'
+            num_cells (int, optional): Number of IVF cells. Defaults to None: about sqrt(num_fonts).
+            num_subspaces (int, optional): Number of PQ subspaces, must divide dim. Defaults to 16.
+            iterations (int, optional): k-means iterations. Defaults to 20.
+            seed (int, optional): Defaults to 0.
+        """
+        num_fonts, dim = vectors.shape
+        if dim % num_subspaces != 0:
+            raise ValueError(f"Dimension {dim} is not divisible by {num_subspaces} subspaces")
+        num_cells = min(num_fonts, num_cells or max(1, int(np.sqrt(num_fonts))))
+        data = np.asarray(vectors, dtype=np.float32)
+
+        centroids, cells = kmeans(data, num_cells, iterations, seed)
+        ids = np.argsort(cells, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength=num_cells))])
+
+        # PQ of the residuals, one codebook of up to 256 centroids per subspace
+        residuals = (data - centroids[cells])[ids].reshape(num_fonts, num_subspaces, dim // num_subspaces)
+        num_codes = min(256, num_fonts)
+        codebooks = np.empty((num_subspaces, num_codes, dim // num_subspaces), dtype=np.float32)
+        codes = np.empty((num_fonts, num_subspaces), dtype=np.uint8)
+        for subspace in range(num_subspaces):
+            codebooks[subspace], codes[:, subspace] = kmeans(residuals[:, subspace], num_codes, iterations, seed)
+        return cls(data, centroids, offsets, ids, codebooks, codes, info)
+
+    def save(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        np.save(os.path.join(index_dir, 'vectors.npy'), self.vectors)
+        np.save(os.path.join(index_dir, 'codes.npy'), self.codes)
+        np.savez(os.path.join(index_dir, 'ivf.npz'), centroids=self.centroids, offsets=self.offsets,
+                 ids=self.ids, codebooks=self.codebooks)
+        with open(os.path.join(index_dir, 'index.json'), 'w', encoding='utf-8') as file:
+            json.dump(self.info, file, indent=1, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, index_dir):
+        """ Loads an index, the vectors and codes are memory mapped. """
+        with open(os.path.join(index_dir, 'index.json'), 'r', encoding='utf-8') as file:
+            info = json.load(file)
+        ivf = np.load(os.path.join(index_dir, 'ivf.npz'))
+        return cls(np.load(os.path.join(index_dir, 'vectors.npy'), mmap_mode='r'),
+                   ivf['centroids'], ivf['offsets'], ivf['ids'], ivf['codebooks'],
+                   np.load(os.path.join(index_dir, 'codes.npy'), mmap_mode='r'), info)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def default_probes(self):
+        """ Number of IVF cells searched by default: a quarter of the cells, at least 16. """
+        return min(len(self.centroids), max(16, len(self.centroids) // 4))
+
+    def search(self, query, k=10, num_probes=None, rerank=10):
+        """ Returns the k fonts most similar to an embedding.
+
+        Args:
+            query (np.array): Embedding of shape (dim,)
+            k (int, optional): Number of results. Defaults to 10.
+            num_probes (int, optional): IVF cells searched. Defaults to None: default_probes().
+            rerank (int, optional): k * rerank PQ candidates are reranked exactly. Defaults to 10.
+
+        Returns:
+            list: Tuples (font path, cosine similarity), most similar first
+        """
+        query = normalize(query)
+        num_subspaces, _, sub_dim = self.codebooks.shape
+        num_probes = num_probes or self.default_probes()
+        cells = np.argsort(((self.centroids - query)**2).sum(axis=1))[:num_probes]
+
+        # Positions of the fonts of the probed cells in cell order, and the probe of each
+        starts, lengths = self.offsets[cells], self.offsets[cells + 1] - self.offsets[cells]
+        probes = np.repeat(np.arange(len(cells)), lengths)
+        positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + starts[probes]
+        if len(positions) == 0:
+            return []
+        # Distance table of the residual to every code per probe and subspace:
+        # |code - residual|^2 = |code|^2 - 2 code.residual + |residual|^2
+        residuals = (query - self.centroids[cells]).reshape(len(cells), num_subspaces, 1, sub_dim)
+        tables = (self.codebook_norms[:, np.newaxis] - 2 * (residuals @ self.codebooks.transpose(0, 2, 1))
+                  + (residuals**2).sum(axis=3, keepdims=True))[:, :, 0]
+        codes = np.asarray(self.codes[positions])
+        distances = tables[probes[:, np.newaxis], np.arange(num_subspaces), codes].sum(axis=1)
+        candidates = self.ids[positions]
+
+        num_candidates = min(len(candidates), k * rerank)
+        best = np.argpartition(distances, num_candidates - 1)[:num_candidates]
+        # Sorted ids read the memory map sequentially
+        candidate_ids = np.sort(candidates[best])
+        similarities = np.asarray(self.vectors[candidate_ids]) @ query
+        order = np.argsort(-similarities)[:k]
+        return [(self.paths[candidate_ids[idx]], float(similarities[idx])) for idx in order]
+
+    def search_exact(self, query, k=10):
+        """ Brute force search over all vectors, e.g. to measure the recall of search. """
+        similarities = np.asarray(self.vectors) @ normalize(query)
+        order = np.argsort(-similarities)[:k]
+        return [(self.paths[idx], float(similarities[idx])) for idx in order]
+
+
+def pixel_embedder(pool=8):
+    """ Embeds fonts by their glyphs average pooled to pool x pool pixels (no model needed). """
+    def embed(glyphs):
+        num_fonts, size, _, num_chars = glyphs.shape
+        pooled = glyphs.reshape(num_fonts, pool, size // pool, pool, size // pool, num_chars).mean(axis=(2, 4))
+        # Ink as signal, so empty space does not dominate the similarity
+        return (1. - pooled).reshape(num_fonts, -1)
+    return embed
+
+
+def encoder_embedder(model):
+    """ Embeds fonts with the latent vector of a trained model: AutoEncoder.encode, or
+        the output of the first dense layer (e.g. the EfficientNet based model).
+    """
+    import tensorflow as tf
+    if hasattr(model, 'encode'):
+        return lambda glyphs: np.asarray(model.encode(tf.constant(glyphs, dtype=tf.float32)), dtype=np.float32)
+    dense = next(layer for layer in model.layers if isinstance(layer, tf.keras.layers.Dense))
+    encoder = tf.keras.Model(model.inputs, dense.output)
+    return lambda glyphs: np.asarray(encoder.predict(glyphs, verbose=0), dtype=np.float32)
+
+
+def clip_embedder():
+    """ Embeds fonts with the CLIP image features of their glyphs, averaged over the chars. """
+    import torch
+    from PIL import Image
+    from ..data import classifier
+
+    def embed(glyphs):
+        num_fonts, _, _, num_chars = glyphs.shape
+        images = [Image.fromarray(np.uint8(glyphs[font, :, :, char] * 255), mode='L').convert('RGB')
+                  for font in range(num_fonts) for char in range(num_chars)]
+        with torch.no_grad():
+            inputs = classifier.processor(images=images, return_tensors="pt")
+            features = classifier.model.get_image_features(**inputs).numpy()
+        return normalize(features).reshape(num_fonts, num_chars, -1).mean(axis=1)
+    return embed
+
+
+def make_embedder(info):
+    """ Creates the embedder described by the info of an index. """
+    if info['embedder'] == 'pixels':
+        return pixel_embedder(info.get('pool', 8))
+    if info['embedder'] == 'clip':
+        return clip_embedder()
+    if info['embedder'] == 'encoder':
+        import tensorflow as tf
+        from .train import AutoEncoder
+        return encoder_embedder(tf.keras.models.load_model(info['model_path'],
+                                                           custom_objects={'AutoEncoder': AutoEncoder}))
+    raise ValueError(f"Unknown embedder: {info['embedder']}")
+
+
+def embed_fonts(font_file_paths, embed, chars, size=64, batch_size=256, output_path=None):
+    """ Renders and embeds fonts in batches. Fonts that can't be rendered are left out.
+
+    Args:
+        output_path (str, optional): Write the vectors to this .npy file batch by batch
+            instead of keeping them in memory. Defaults to None.
+
+    Returns:
+        tuple: Normalized embeddings of shape (num_embedded, dim) (memory mapped if
+            output_path) and the paths of the embedded fonts
+    """
+    font_file_paths = list(font_file_paths)
+    batches, embedded_paths = [], []
+    for start in range(0, len(font_file_paths), batch_size):
+        batch_paths = font_file_paths[start:start + batch_size]
+        glyphs, rendered = datarenderer.render_fonts(batch_paths, size=size, chars=chars, normalize=True,
+                                                     dtype=np.float32, compact=True)
+        if len(rendered) == 0:
+            continue
+        batches.append(normalize(embed(glyphs)))
+        embedded_paths.extend(batch_paths[idx] for idx in rendered)
+    vectors = np.concatenate(batches) if batches else np.empty((0, 0), dtype=np.float32)
+    if output_path is not None:
+        np.save(output_path, vectors)
+        vectors = np.load(output_path, mmap_mode='r')
+    return vectors, embedded_paths
+
+
+def build_font_index(index_dir, embedder=None, model_path=None, font_file_paths=None,
+                     chars="AaOoUu8Bj", size=64, batch_size=256, num_subspaces=16, pool=8):
+    """ Embeds fonts and builds the similarity index.
+
+    Args:
+        index_dir (str): Directory of the index
+        embedder (str, optional): One of EMBEDDERS. Defaults to None: 'encoder' if model_path is given, else 'pixels'.
+        model_path (str, optional): Trained model for the 'encoder' embedder. Defaults to None.
+        font_file_paths (list, optional): Fonts to index. Defaults to None: the usable fonts of the font DB.
+        chars (str, optional): Chars that are embedded, the input chars of the model. Defaults to "AaOoUu8Bj".
+        size (int, optional): Render size. Defaults to 64.
+        num_subspaces (int, optional): Number of PQ subspaces. Defaults to 16.
+        pool (int, optional): Pooled size of the 'pixels' embedder. Defaults to 8.
+
+    Returns:
+        SimilarityIndex: The index
+    """
+    if font_file_paths is None:
+        font_file_paths = fontdb_handler.font_file_list()
+    embedder = embedder or ('encoder' if model_path else 'pixels')
+    info = {'embedder': embedder, 'model_path': model_path, 'chars': chars, 'size': size, 'pool': pool}
+    vectors, info['font_file_paths'] = embed_fonts(font_file_paths, make_embedder(info), chars, size, batch_size)
+    index = SimilarityIndex.build(vectors, info, num_subspaces=num_subspaces)
+    index.save(index_dir)
+    return index
+
+
+def query_font(index, font_file_path, k=10, embed=None, **kwargs):
+    """ Returns the indexed fonts most similar to a font file.
+
+    Args:
+        index (SimilarityIndex): The index
+        font_file_path (str): Font to search for
+        k (int, optional): Number of results. Defaults to 10.
+        embed (callable, optional): Embedder of the index, reused between queries.
+            Defaults to None: created from the index info.
+        **kwargs: Further arguments of SimilarityIndex.search
+
+    Returns:
+        list: Tuples (font path, cosine similarity), most similar first
+    """
+    embed = embed or make_embedder(index.info)
+    glyphs = datarenderer.render_font(font_file_path, index.info['size'], index.info['chars'],
+                                      normalize=True, dtype=np.float32)
+    return index.search(embed(glyphs[np.newaxis])[0], k=k, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_build = subparsers.add_parser('build')
+    parser_build.add_argument('index_dir')
+    parser_build.add_argument('--embedder', choices=EMBEDDERS, default=None,
+                              help="Defaults to encoder if --model is given, else pixels")
+    parser_build.add_argument('--model', default=None, help='Trained model for the encoder embedder')
+    parser_build.add_argument('--chars', default="AaOoUu8Bj")
+    parser_build.add_argument('--num-subspaces', type=int, default=16)
+    parser_query = subparsers.add_parser('query')
+    parser_query.add_argument('index_dir')
+    parser_query.add_argument('font_file')
+    parser_query.add_argument('-k', type=int, default=10)
+    parser_query.add_argument('--num-probes', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        index = build_font_index(args.index_dir, embedder=args.embedder, model_path=args.model,
+                                 chars=args.chars, num_subspaces=args.num_subspaces)
+        print(f"Indexed {len(index)} fonts")
+    else:
+        index = SimilarityIndex.load(args.index_dir)
+        embed = make_embedder(index.info)
+        start = time.perf_counter()
+        results = query_font(index, args.font_file, k=args.k, embed=embed, num_probes=args.num_probes)
+        print(f"{(time.perf_counter() - start) * 1000:.1f} ms")
+        for font_path, similarity in results:
+            print(f"{similarity:.4f}  {font_path}")
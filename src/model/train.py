@@ -0,0 +1,491 @@
+""" Scriptable training of the glyph generation models.
+
+Builds a model from a config, streams the fonts of the train/val splits
+(see fontdb_handler.assign_splits) through a tf.data pipeline that renders
+them in parallel, trains with optional mixed precision and XLA compilation
+and reports examples/sec per epoch. The summary of the run is written with
+helperfunctions.save_summary_last_training like the notebook trainings.
+
+Usage:
+    python -m src.model.train --config config.json --set epochs=5 --set mixed_precision=auto
+"""
+
+import argparse
+import ast
+import json
+import os
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import layers
+from ..data import datarenderer, fontdb_handler, quarantine, sampling
+from . import helperfunctions as hf
+from . import registry
+
+DEFAULT_CONFIG = {
+    'model': 'autoencoder',         # key of MODELS
+    'latent_dim': 128,
+    'charset_in': "AaOoUu8Bj",
+    'charset_out': "ÄäÖöÜüß",
+    'box_size': 64,
+    'batch_size': 32,
+    'epochs': 50,
+    'learning_rate': 1e-3,
+    'loss': 'mse',
+    'mixed_precision': None,        # None, 'mixed_float16', 'mixed_bfloat16' or 'auto'
+    'jit_compile': False,
+    'intra_op_threads': 0,          # 0: TensorFlow default (number of cores)
+    'inter_op_threads': 0,
+    'render_parallel_calls': None,  # None: tf.data.AUTOTUNE
+    'split_by': 'family',           # see fontdb_handler.assign_splits
+    'max_fonts': None,              # limit the number of fonts per split, e.g. for benchmarks
+    'cache_dir': None,              # cache the rendered glyphs per split on disk
+    'glyph_format': 'uint8',        # 'uint8', 'bits' (thresholded, 1 bit per pixel) or 'float32':
+                                    # format of the cached glyphs, decoded per batch
+    'train_data': None,             # dataset of datarenderer.export_dataset instead of rendering
+    'val_data': None,
+    'shuffle_buffer': 10000,
+    'sampling': None,               # None (every font once per epoch), 'weighted' or 'stratified':
+                                    # sample the train fonts by group, see data.sampling
+    'sampling_group_by': 'family',  # 'family', 'category', 'weight' or a list of them
+    'sampling_alpha': 1.,           # 'weighted': fonts weighted by 1 / group_size**alpha
+    'sampling_per_group': 1,        # 'stratified': fonts per group and epoch
+    'seed': 42,
+    'save_path_summary': "../models/logs/",
+    'save_path_model': "../models/",
+    'registry_path': registry.DEFAULT_REGISTRY_PATH,
+}
+
+
+class AutoEncoder(tf.keras.Model):
+    """ Convolutional encoder/decoder from models_from_scratch.ipynb. """
+
+    def __init__(self, latent_dim, box_size, num_chars_in, num_chars_out, *args, **kwargs):
+        assert isinstance(latent_dim, int)
+        super().__init__(*args, **kwargs)
+        self.latent_dim = latent_dim
+        self.box_size = box_size
+        self.num_chars_in = num_chars_in
+        self.num_chars_out = num_chars_out
+
+        self.inverter_layer = lambda x: 1 - x
+
+        # Encoder
+        self.encoder_conv2d_1 = layers.Conv2D(32, (3, 3), activation="relu", padding="same")
+        self.encoder_maxpool_1 = layers.MaxPooling2D((2, 2), padding="same")
+        self.encoder_conv2d_2 = layers.Conv2D(64, (3, 3), activation="relu", padding="same")
+        self.encoder_maxpool_2 = layers.MaxPooling2D((2, 2), padding="same")
+        self.encoder_conv2d_3 = layers.Conv2D(128, (3, 3), activation="relu", padding="same")
+        self.encoder_maxpool_3 = layers.MaxPooling2D((2, 2), padding="same")
+        self.encoder_flatten = layers.Flatten()
+        self.encoder_fc1 = layers.Dense(512, activation="relu")
+        self.encoder_fc2 = layers.Dense(latent_dim, activation="relu")
+
+        # Decoder
+        self.decoder_fc1 = layers.Dense(512, activation="relu")
+        # 512 units as (4, 4, 32) for box size 64, the decoder upsamples by 16
+        self.decoder_reshape = layers.Reshape((box_size // 16, box_size // 16, 512 * 16 * 16 // box_size**2))
+        self.decoder_upsample_1 = layers.UpSampling2D((2, 2))
+        self.decoder_conv2d_1 = layers.Conv2D(128, (3, 3), activation="relu", padding="same")
+        self.decoder_upsample_2 = layers.UpSampling2D((2, 2))
+        self.decoder_conv2d_2 = layers.Conv2D(64, (3, 3), activation="relu", padding="same")
+        self.decoder_upsample_3 = layers.UpSampling2D((2, 2))
+        self.decoder_conv2d_3 = layers.Conv2D(32, (3, 3), activation="relu", padding="same")
+        self.decoder_out = layers.Conv2DTranspose(num_chars_out, (3, 3), strides=(2, 2), padding="same")
+        # With mixed precision the output (and thereby the loss) stays float32
+        self.output_cast = layers.Activation("linear", dtype="float32")
+
+        self._build_graph()
+
+    def get_config(self):
+        # Needed to save the model and to load it with load_model
+        config = super().get_config()
+        config.update({'latent_dim': self.latent_dim, 'box_size': self.box_size,
+                       'num_chars_in': self.num_chars_in, 'num_chars_out': self.num_chars_out})
+        return config
+
+    def _build_graph(self): # Just here because we want to see the output shapes in the summary.
+        input_shape = (self.box_size, self.box_size, self.num_chars_in)
+        self.build((None,) + input_shape)
+        inputs = tf.keras.Input(shape=input_shape)
+        _ = self.call(inputs)
+
+    def call(self, x):
+        z = self.encode(x)
+        y = self.decode(z)
+        return y
+
+    def encode(self, x):
+        encoded = self.inverter_layer(x)
+        encoded = self.encoder_conv2d_1(encoded)
+        encoded = self.encoder_maxpool_1(encoded)
+        encoded = self.encoder_conv2d_2(encoded)
+        encoded = self.encoder_maxpool_2(encoded)
+        encoded = self.encoder_conv2d_3(encoded)
+        encoded = self.encoder_maxpool_3(encoded)
+        encoded = self.encoder_flatten(encoded)
+        encoded = self.encoder_fc1(encoded)
+        encoded = self.encoder_fc2(encoded)
+        return encoded
+
+    def decode(self, decoded):
+        decoded = self.decoder_fc1(decoded)
+        decoded = self.decoder_reshape(decoded)
+        decoded = self.decoder_upsample_1(decoded)
+        decoded = self.decoder_conv2d_1(decoded)
+        decoded = self.decoder_upsample_2(decoded)
+        decoded = self.decoder_conv2d_2(decoded)
+        decoded = self.decoder_upsample_3(decoded)
+        decoded = self.decoder_conv2d_3(decoded)
+        decoded = self.decoder_out(decoded)
+        decoded = self.inverter_layer(decoded)
+        return self.output_cast(decoded)
+
+
+def load_model(model_path, custom_objects=None):
+    """ Loads a trained .keras model, including the subclassed AutoEncoder.
+
+    Args:
+        model_path (str): Path to the .keras model
+        custom_objects (dict, optional): Further custom layers/models. Defaults to None.
+    """
+    return tf.keras.models.load_model(model_path, custom_objects={'AutoEncoder': AutoEncoder,
+                                                                  **(custom_objects or {})})
+
+
+def build_autoencoder(config):
+    """ Builds the convolutional encoder/decoder. """
+    return AutoEncoder(config['latent_dim'], config['box_size'],
+                       len(config['charset_in']), len(config['charset_out']))
+
+
+def build_efficientnet(config):
+    """ Builds the EfficientNetB0 based model from model_segmentation.ipynb (frozen base). """
+    box_size = config['box_size']
+    if box_size < 32:
+        raise ValueError("EfficientNetB0 requires input size to be at least 32x32")
+    base_model = tf.keras.applications.EfficientNetB0(input_shape=(box_size, box_size, 3), include_top=False)
+    base_model.trainable = False
+    return tf.keras.models.Sequential([
+        layers.Input(shape=(box_size, box_size, len(config['charset_in']))),
+        layers.Conv2D(3, 1, activation='relu', padding='same'),
+        base_model,
+        layers.Flatten(),
+        layers.Dense(1024, activation="relu"),
+        layers.Dropout(0.1),
+        layers.Dense(box_size * box_size * len(config['charset_out'])),
+        # With mixed precision the output (and thereby the loss) stays float32
+        layers.Activation("sigmoid", dtype="float32"),
+        layers.Reshape((box_size, box_size, len(config['charset_out'])))
+    ])
+
+
+MODELS = {'autoencoder': build_autoencoder,
+          'efficientnet': build_efficientnet}
+
+
+class ExamplesPerSecond(tf.keras.callbacks.Callback):
+    """ Measures the training throughput per epoch and adds it to the logs (and the history). """
+
+    def __init__(self, batch_size):
+        super().__init__()
+        self.batch_size = batch_size
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.num_batches = 0
+        self.start = time.perf_counter()
+        # An epoch without batches ends where it began
+        self.end = self.start
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.num_batches += 1
+        # Validation at the end of the epoch is not part of the training time
+        self.end = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = self.end - self.start
+        # The last batch can be smaller, this slightly overestimates the throughput
+        examples_per_sec = self.num_batches * self.batch_size / seconds if seconds > 0 else 0.
+        if logs is not None:
+            logs['examples_per_sec'] = examples_per_sec
+        print(f"Epoch {epoch + 1}: {examples_per_sec:.1f} examples/sec")
+
+
+def configure_runtime(config):
+    """ Sets the threading, mixed precision policy and random seed of TensorFlow. """
+    # The threads can't change once TensorFlow is initialized (e.g. the second training
+    # in a notebook), setting the current values again is skipped
+    if tf.config.threading.get_intra_op_parallelism_threads() != config['intra_op_threads']:
+        tf.config.threading.set_intra_op_parallelism_threads(config['intra_op_threads'])
+    if tf.config.threading.get_inter_op_parallelism_threads() != config['inter_op_threads']:
+        tf.config.threading.set_inter_op_parallelism_threads(config['inter_op_threads'])
+
+    policy = config['mixed_precision']
+    if policy == 'auto':
+        # float16 is fast on GPUs, on CPUs only bfloat16 is
+        policy = 'mixed_float16' if tf.config.list_physical_devices('GPU') else 'mixed_bfloat16'
+    tf.keras.mixed_precision.set_global_policy(policy or 'float32')
+    tf.keras.utils.set_random_seed(config['seed'])
+    return policy
+
+
+def _split_paths(split, config):
+    font_file_paths = list(fontdb_handler.iter_split(split))
+    bad = quarantine.known_bad(font_file_paths, quarantine.render_config(config['box_size']))
+    font_file_paths = [path for path in font_file_paths if path not in bad]
+    if config['max_fonts'] is not None:
+        font_file_paths = font_file_paths[:config['max_fonts']]
+    return font_file_paths
+
+
+def decode_glyphs(encoded, glyph_format, shape):
+    """ Decodes glyphs of datarenderer.encode_glyphs inside the tf.data pipeline.
+
+    Args:
+        encoded (tf.Tensor): uint8 tensor, samples in the last axes
+        glyph_format (str): 'uint8', 'bits' or 'float32' (already decoded)
+        shape (tuple): Shape of one sample (size, size, num_chars)
+
+    Returns:
+        tf.Tensor: float32 glyphs of shape (..., size, size, num_chars), 0 ink, 1 background
+    """
+    if glyph_format == 'float32':
+        return encoded
+    if glyph_format == 'uint8':
+        return tf.cast(encoded, tf.float32) / 255.
+    if glyph_format == 'bits':
+        # Bit i of every byte, most significant first like np.packbits
+        masks = tf.constant([128, 64, 32, 16, 8, 4, 2, 1], dtype=tf.uint8)
+        bits = tf.bitwise.bitwise_and(encoded[..., tf.newaxis], masks) > 0
+        leading_shape = tf.shape(encoded)[:-1]
+        bits = tf.reshape(bits, tf.concat([leading_shape, [-1]], axis=0))[..., :int(np.prod(shape))]
+        return tf.reshape(1. - tf.cast(bits, tf.float32), tf.concat([leading_shape, shape], axis=0))
+    raise ValueError(f"Unknown glyph format: {glyph_format}")
+
+
+def _split_batches(dataset, config, glyph_format, shape, columns=None):
+    # Decoding after batching needs one op per batch instead of one per sample.
+    # columns selects chars of the decoded glyphs, e.g. of bits that can't be sliced packed.
+    num_chars_in = len(config['charset_in'])
+    dataset = dataset.batch(config['batch_size'])
+    if columns is None:
+        decode = lambda encoded: decode_glyphs(encoded, glyph_format, shape)
+    else:
+        columns = tf.constant(columns, dtype=tf.int32)
+        decode = lambda encoded: tf.gather(decode_glyphs(encoded, glyph_format, shape), columns, axis=-1)
+    dataset = dataset.map(decode, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.map(lambda images: (images[..., :num_chars_in], images[..., num_chars_in:]),
+                          num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def exported_dataset(path, config, training=True):
+    """ Streams a dataset written by datarenderer.export_dataset (e.g. python -m src render-export)
+        as (input chars, output chars) batches. The encoded glyphs are memory mapped and
+        decoded per batch.
+
+    Args:
+        path (str): Output path of export_dataset, without extension
+        config (Dictionary): Training config, its chars must be in the dataset
+        training (bool, optional): Shuffle the fonts. Defaults to True.
+    """
+    encoded, info = datarenderer.load_dataset(path)
+    chars = config['charset_in'] + config['charset_out']
+    missing = set(chars) - set(info['chars'])
+    if missing:
+        raise ValueError(f"Chars {''.join(sorted(missing))} are not in the dataset {path}")
+    shape = tuple(info['shape'])
+    num_fonts = len(encoded) if config['max_fonts'] is None else min(len(encoded), config['max_fonts'])
+    columns = [info['chars'].index(char) for char in chars]
+    glyph_format = info['format']
+    sample_shape = (shape[0], shape[1], len(chars))
+    decode_shape, decode_columns = sample_shape, None
+
+    if columns == list(range(len(info['chars']))):
+        # The samples are passed encoded and decoded per batch
+        def load(idx):
+            return np.asarray(encoded[idx])
+        element_shape = encoded.shape[1:]
+    elif glyph_format == 'bits':
+        # Packed bits can't be sliced by char: the bytes are passed on and the chars
+        # are selected after decoding the batch
+        def load(idx):
+            return np.asarray(encoded[idx])
+        element_shape = encoded.shape[1:]
+        decode_shape, decode_columns = shape, columns
+    else:
+        def load(idx):
+            return np.asarray(encoded[idx])[..., columns]
+        element_shape = sample_shape
+
+    dataset = tf.data.Dataset.range(num_fonts)
+    if training:
+        dataset = dataset.shuffle(num_fonts, seed=config['seed'])
+    dataset = dataset.map(lambda idx: tf.ensure_shape(tf.numpy_function(load, [idx], tf.uint8), element_shape),
+                          num_parallel_calls=tf.data.AUTOTUNE)
+    return _split_batches(dataset, config, glyph_format, decode_shape, decode_columns)
+
+
+def _sampler(font_file_paths, config):
+    """ Returns the endless sampler of config['sampling'] over the train fonts and the number of fonts per epoch. """
+    group_by = config['sampling_group_by']
+    group_by = group_by if isinstance(group_by, str) else tuple(group_by)
+    index = sampling.SamplingIndex.from_font_db(split='train').select(font_file_paths)
+    epoch_size = index.epoch_size(config['sampling'], group_by, config['sampling_per_group'])
+    if config['sampling'] == 'weighted':
+        return index.weighted_sampler(group_by, config['sampling_alpha'], seed=config['seed']), epoch_size
+    return index.stratified_sampler(group_by, config['sampling_per_group'], seed=config['seed']), epoch_size
+
+
+def make_dataset(font_file_paths, config, training=True, cache_name=None, sampler=None):
+    """ Streams the rendered glyphs of fonts as (input chars, output chars) batches.
+
+    The fonts are rendered in parallel inside the tf.data pipeline. Fonts that
+    fail to render are skipped. The glyphs are cached in config['glyph_format']
+    and decoded per batch, so the cache of 'uint8' is 4x and of 'bits' 32x
+    smaller than float32.
+
+    With a sampler (see data.sampling) the fonts are taken from the sampler
+    instead of font_file_paths. The stream differs every epoch, so it is
+    neither cached nor shuffled.
+
+    Args:
+        font_file_paths (list): Paths of the fonts
+        config (Dictionary): Training config
+        training (bool, optional): Shuffle the fonts. Defaults to True.
+        cache_name (str, optional): Name of the on-disk cache in config['cache_dir']. Defaults to None.
+        sampler (iterable, optional): Endless iterable of font paths. Defaults to None.
+
+    Returns:
+        tf.data.Dataset: Batches of shape (batch, size, size, len(charset_in)) and
+            (batch, size, size, len(charset_out))
+
+    Raises:
+        ValueError: If there are no fonts
+    """
+    if len(font_file_paths) == 0:
+        raise ValueError(f"No fonts for the {cache_name + ' split' if cache_name else 'dataset'} "
+                         "(see fontdb_handler.assign_splits and the quarantined fonts)")
+    size = config['box_size']
+    chars = config['charset_in'] + config['charset_out']
+    shape = (size, size, len(chars))
+    glyph_format = config['glyph_format']
+
+    def render(font_file_path):
+        glyphs = datarenderer.render_font(font_file_path.decode('utf-8'), size, chars, dtype=np.uint8)
+        if glyph_format == 'float32':
+            return glyphs.astype(np.float32) / 255.
+        return datarenderer.encode_glyphs(glyphs, glyph_format)
+
+    encoded_shape = shape if glyph_format != 'bits' else (-(-int(np.prod(shape)) // 8),)
+    dtype = tf.float32 if glyph_format == 'float32' else tf.uint8
+    if sampler is not None:
+        dataset = sampling.as_dataset(sampler)
+    else:
+        dataset = tf.data.Dataset.from_tensor_slices(tf.constant(font_file_paths, dtype=tf.string))
+    if training and sampler is None:
+        dataset = dataset.shuffle(len(font_file_paths), seed=config['seed'], reshuffle_each_iteration=False)
+    dataset = dataset.map(lambda path: tf.ensure_shape(tf.numpy_function(render, [path], dtype), encoded_shape),
+                          num_parallel_calls=config['render_parallel_calls'] or tf.data.AUTOTUNE,
+                          deterministic=False)
+    dataset = dataset.ignore_errors()
+    if sampler is not None:
+        return _split_batches(dataset, config, glyph_format, shape)
+    if config['cache_dir'] is not None and cache_name is not None:
+        os.makedirs(config['cache_dir'], exist_ok=True)
+        dataset = dataset.cache(os.path.join(config['cache_dir'], f"{cache_name}_{size}_{glyph_format}"))
+    else:
+        dataset = dataset.cache()
+    if training:
+        dataset = dataset.shuffle(config['shuffle_buffer'], seed=config['seed'])
+    return _split_batches(dataset, config, glyph_format, shape)
+
+
+def train(config=None):
+    """ Trains a model with the config (missing keys are taken from DEFAULT_CONFIG).
+
+    Returns:
+        tuple: The model and the trainings entry (config and history) in the format
+            of the trainings_list in the notebooks
+    """
+    config = {**DEFAULT_CONFIG, **(config or {})}
+    config['mixed_precision'] = configure_runtime(config)
+
+    steps_per_epoch = None
+    if config['train_data'] is not None:
+        if config['sampling'] is not None:
+            raise ValueError("config['sampling'] needs the font database, not an exported train_data")
+        dataset_train = exported_dataset(config['train_data'], config, training=True)
+        dataset_val = exported_dataset(config['val_data'], config, training=False)
+        train_paths = datarenderer.load_dataset(config['train_data'])[1]['font_file_paths']
+        val_paths = datarenderer.load_dataset(config['val_data'])[1]['font_file_paths']
+    else:
+        fontdb_handler.assign_splits(by=config['split_by'])
+        train_paths = _split_paths('train', config)
+        val_paths = _split_paths('val', config)
+        if config['sampling'] is not None:
+            sampler, epoch_size = _sampler(train_paths, config)
+            steps_per_epoch = max(1, -(-epoch_size // config['batch_size']))
+            dataset_train = make_dataset(train_paths, config, training=True, sampler=sampler)
+        else:
+            dataset_train = make_dataset(train_paths, config, training=True, cache_name='train')
+        dataset_val = make_dataset(val_paths, config, training=False, cache_name='val')
+    print(f"Training with {len(train_paths)} fonts, validating with {len(val_paths)} fonts")
+
+    model = MODELS[config['model']](config)
+    model.compile(optimizer=tf.keras.optimizers.Adam(config['learning_rate']),
+                  loss=config['loss'],
+                  jit_compile=config['jit_compile'])
+    model.summary()
+
+    start = time.perf_counter()
+    history = model.fit(dataset_train,
+                        epochs=config['epochs'],
+                        steps_per_epoch=steps_per_epoch,
+                        validation_data=dataset_val,
+                        callbacks=[ExamplesPerSecond(config['batch_size'])])
+
+    training = {**{key: value for key, value in config.items()
+                   if not key.startswith('save_path') and key != 'registry_path'},
+                "num_train_fonts": len(train_paths),
+                "num_val_fonts": len(val_paths),
+                "training_seconds": time.perf_counter() - start,
+                "history": history}
+    if config['save_path_summary'] is not None:
+        hf.save_summary_last_training(trainings_list=[training],
+                                      dataset_test=dataset_val,
+                                      save_path_summary=config['save_path_summary'],
+                                      save_path_model=config['save_path_model'],
+                                      add_prefix=config['model'],
+                                      registry_path=config['registry_path'])
+    return model, training
+
+
+def load_config(path=None, overrides=()):
+    """ Reads a json config and applies 'key=value' overrides (values are Python literals).
+
+    Returns:
+        Dictionary: DEFAULT_CONFIG updated with the file and the overrides
+    """
+    config = dict(DEFAULT_CONFIG)
+    if path is not None:
+        with open(path, 'r', encoding='utf-8') as file:
+            config.update(json.load(file))
+    for override in overrides:
+        key, value = override.split('=', 1)
+        if key not in DEFAULT_CONFIG:
+            raise KeyError(f"Unknown config key: {key}")
+        try:
+            config[key] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            config[key] = value
+    return config
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--config', default=None, help="json file with config values")
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help="override a config value, e.g. --set jit_compile=True")
+    args = parser.parse_args()
+    train(load_config(args.config, args.set))
@@ -0,0 +1,61 @@
+import pytest
+from fontTools import ttLib
+from fontTools.feaLib.builder import addOpenTypeFeaturesFromString
+from fontTools.pens.boundsPen import BoundsPen
+from src.benchmark import synthetic_fonts
+from src.data import composer
+
+CHARS = "AaOox\u0308"  # base letters, x for the x-height and the combining dieresis
+
+
+def _bounds(font, glyph_name):
+    pen = BoundsPen(font.getGlyphSet())
+    font.getGlyphSet()[glyph_name].draw(pen)
+    return pen.bounds
+
+
+def _components(path, char):
+    with ttLib.TTFont(path) as font:
+        glyph = font['glyf'][font.getBestCmap()[ord(char)]]
+        assert glyph.isComposite()
+        return [(component.glyphName, component.x, component.y) for component in glyph.components]
+
+
+def test_mark_is_placed_by_the_bounding_boxes(tmp_path):
+    path = synthetic_fonts.build_font(str(tmp_path / 'font.ttf'), num_glyphs=10, chars=CHARS)
+    result = composer.compose_glyphs(path)
+    assert result['composed'] == ['Ä', 'ä', 'Ö', 'ö']
+
+    with ttLib.TTFont(path) as font:
+        for char in result['composed']:
+            (base, base_x, base_y), (mark, dx, dy) = _components(result['output_path'], char)
+            assert (base, base_x, base_y) == (font.getBestCmap()[ord(composer.DIERESIS_BASES[char])], 0, 0)
+            base_bounds, mark_bounds = _bounds(font, base), _bounds(font, mark)
+            # Centered over the base letter and above it
+            assert abs((base_bounds[0] + base_bounds[2]) / 2 - (mark_bounds[0] + mark_bounds[2]) / 2 - dx) <= 0.5
+            assert mark_bounds[1] + dy > base_bounds[3]
+
+
+def test_mark_is_placed_by_the_gpos_anchors(tmp_path):
+    path = synthetic_fonts.build_font(str(tmp_path / 'font.ttf'), num_glyphs=10, chars=CHARS)
+    with ttLib.TTFont(path) as font:
+        addOpenTypeFeaturesFromString(font, """
+            markClass uni0308 <anchor 100 -20> @TOP;
+            feature mark {
+                pos base uni0041 <anchor 300 900> mark @TOP;
+            } mark;
+        """)
+        font.save(path)
+
+    result = composer.compose_glyphs(path, chars="Äa")
+    assert result['composed'] == ['Ä']
+    assert _components(result['output_path'], 'Ä')[1] == ('uni0308', 200, 920)
+    # Glyphs without anchors fall back to the bounding boxes
+    with ttLib.TTFont(path) as font:
+        assert composer.mark_offset(font, 'uni0061', 'uni0308') != (0, 0)
+
+
+def test_nothing_to_compose_without_dieresis(tmp_path):
+    path = synthetic_fonts.build_font(str(tmp_path / 'font.ttf'), num_glyphs=10, chars="AaOo")
+    assert composer.compose_glyphs(path) == {'output_path': None, 'composed': []}
+    assert not (tmp_path / 'font_composed.ttf').exists()
@@ -0,0 +1,141 @@
+import os
+from src.data import datacollector
+
+METADATA = r'''
+# This file is autogenerated
+name: "Noto Sans"
+designer: "Google"
+license: "OFL"
+category: "SANS_SERIF"
+date_added: "2015-06-01"
+fonts {
+  name: "Noto Sans"
+  style: "normal"
+  weight: 400
+  filename: "NotoSans[wdth,wght].ttf"
+  post_script_name: "NotoSans-Regular"
+  full_name: "Noto Sans"
+  copyright: "Copyright 2022 " "The Noto Project Authors"
+}
+fonts {
+  name: "Noto Sans"
+  style: "italic"
+  weight: 400
+  filename: "NotoSans-Italic[wdth,wght].ttf"
+  full_name: "Noto Sans Italic \303\234ber"
+}
+subsets: "latin"
+subsets: "latin-ext"
+axes {
+  tag: "wght"
+  min_value: 100.0
+  max_value: 900.0
+}
+source { repository_url: 'https://github.com/notofonts/latin-greek-cyrillic' }
+is_noto: true
+'''
+
+
+def test_parse_textproto():
+    message = datacollector.parse_textproto(METADATA)
+    assert message['name'] == "Noto Sans"
+    assert message['category'] == ["SANS_SERIF"]
+    assert message['subsets'] == ["latin", "latin-ext"]
+    assert message['axes'] == [{'tag': 'wght', 'min_value': 100., 'max_value': 900.}]
+    assert message['source'] == {'repository_url': 'https://github.com/notofonts/latin-greek-cyrillic'}
+    assert message['is_noto'] is True
+    regular, italic = message['fonts']
+    assert regular['weight'] == 400 and regular['style'] == 'normal'
+    assert regular['copyright'] == "Copyright 2022 The Noto Project Authors"
+    # Octal escaped UTF-8
+    assert italic['full_name'] == "Noto Sans Italic Über"
+    # Fields that aren't known as repeated become lists when they repeat
+    assert datacollector.parse_textproto('a: 1 a: 2 b: ENUM') == {'a': [1, 2], 'b': 'ENUM'}
+
+
+def test_metadata_per_font_file(tmp_path):
+    path = tmp_path / 'METADATA.pb'
+    path.write_text(METADATA, encoding='utf-8')
+    fonts = datacollector.load_directory_metadata(str(path))
+    assert list(fonts) == ["NotoSans[wdth,wght].ttf", "NotoSans-Italic[wdth,wght].ttf"]
+    italic = datacollector.parse_metadata(str(path), "NotoSans-Italic[wdth,wght].ttf")
+    assert italic['family'] == "Noto Sans" and italic['style'] == 'italic'
+    assert italic['category'] == "SANS_SERIF" and italic['categories'] == ["SANS_SERIF"]
+    assert 'post_script_name' not in italic and 'copyright' not in italic
+    # Unlisted files get the family information
+    unlisted = datacollector.parse_metadata(str(path), "Other.ttf")
+    assert unlisted['family'] == "Noto Sans" and 'style' not in unlisted
+
+    # The cache is invalidated by a new modification time
+    path.write_text(METADATA.replace('name: "Noto Sans"\ndesigner', 'name: "Noto Serif"\ndesigner'), encoding='utf-8')
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10**9))
+    assert datacollector.parse_metadata(str(path), "Other.ttf")['family'] == "Noto Serif"
+
+
+def _build_variable_font(path):
+    from fontTools.fontBuilder import FontBuilder
+    from fontTools.pens.ttGlyphPen import TTGlyphPen
+    from fontTools.ttLib.tables.TupleVariation import TupleVariation
+
+    pen = TTGlyphPen(None)
+    pen.moveTo((100, 0))
+    for point in ((100, 700), (300, 700), (300, 0)):
+        pen.lineTo(point)
+    pen.closePath()
+    glyphs = {'.notdef': TTGlyphPen(None).glyph(), 'A': pen.glyph()}
+    builder = FontBuilder(1000, isTTF=True)
+    builder.setupGlyphOrder(list(glyphs))
+    builder.setupCharacterMap({ord('A'): 'A'})
+    builder.setupGlyf(glyphs)
+    builder.setupHorizontalMetrics({'.notdef': (500, 0), 'A': (700, 100)})
+    builder.setupHorizontalHeader(ascent=800, descent=-200)
+    builder.setupNameTable({'familyName': 'Variable', 'styleName': 'Regular'})
+    builder.setupOS2()
+    builder.setupPost()
+    builder.setupFvar(axes=[('wght', 100, 400, 900, 'Weight'), ('wdth', 75, 100, 100, 'Width')],
+                      instances=[{'location': {'wght': 100, 'wdth': 100}, 'stylename': 'Thin'},
+                                 {'location': {'wght': 900, 'wdth': 100}, 'stylename': 'Black'}])
+    # The box gets 200 units wider at wght=900
+    deltas = [(0, 0), (0, 0), (200, 0), (200, 0), (0, 0), (0, 0), (0, 0), (0, 0)]
+    builder.setupGvar({'A': [TupleVariation({'wght': (0, 1, 1)}, deltas)]})
+    builder.save(path)
+    return path
+
+
+def test_variable_fonts_are_expanded_into_instances(tmp_path):
+    import numpy as np
+    from src.data import datarenderer, fontcache
+    from src.data import global_consts as g
+
+    raw = tmp_path / 'raw#1'
+    (raw / 'family').mkdir(parents=True)
+    path = _build_variable_font(str(raw / 'family' / 'Variable[wght].ttf'))
+    (raw / 'family' / 'METADATA.pb').write_text(METADATA.replace('NotoSans[wdth,wght]', 'Variable[wght]'))
+    # A '#' in a directory name is not a location
+    assert fontcache.split_instance_path(path) == (path, None)
+
+    named = datacollector.variable_font_instances(path)
+    assert [instance['name'] for _, instance in named] == ['Thin', 'Black']
+    assert named[1][0] == path + '#wdth=100,wght=900'
+    assert fontcache.split_instance_path(named[1][0]) == (path, {'wdth': 100., 'wght': 900.})
+    grid = datacollector.variable_font_instances(path, mode='grid', grid_steps=2)
+    assert [fontcache.split_instance_path(instance_path)[1] for instance_path, _ in grid] == [
+        {'wght': 100., 'wdth': 75.}, {'wght': 100., 'wdth': 100.},
+        {'wght': 900., 'wdth': 75.}, {'wght': 900., 'wdth': 100.}]
+
+    g.configure(PATH_RAW=str(raw) + '/')
+    try:
+        datacollector.collectfonts()
+        from src.data import fontdb_handler
+        font_db = fontdb_handler.load_font_db()
+    finally:
+        g.reset()
+    assert list(font_db) == [instance_path for instance_path, _ in named]
+    thin, black = font_db.values()
+    assert thin['font_file'] == path and thin['instance'] == named[0][1]
+    assert black['metadata']['family'] == "Noto Sans"
+
+    # The instances are rendered at their location
+    ink_thin, ink_black = [(datarenderer.render_font(instance_path, 32, 'A', normalize=True) < 0.5).sum()
+                           for instance_path in font_db]
+    assert ink_black > 1.5 * ink_thin
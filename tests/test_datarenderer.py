@@ -0,0 +1,14 @@
+import numpy as np
+import pytest
+from src.data import datarenderer
+
+
+@pytest.mark.parametrize('glyph_format', datarenderer.GLYPH_FORMATS)
+@pytest.mark.parametrize('num_fonts', [0, 3])
+def test_encode_decode_round_trip(glyph_format, num_fonts):
+    shape = (5, 7, 3)
+    glyphs = np.where(np.random.default_rng(0).random((num_fonts, *shape)) < 0.5, 0, 255).astype(np.uint8)
+    encoded = datarenderer.encode_glyphs(glyphs, glyph_format)
+    decoded = datarenderer.decode_glyphs(encoded, glyph_format, shape)
+    assert decoded.shape == (num_fonts, *shape)
+    np.testing.assert_array_equal(decoded, glyphs / 255.)
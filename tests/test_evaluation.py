@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from src.model import evaluation
+
+
+def _brute_force_distances(mask):
+    ys, xs = np.nonzero(mask)
+    grid_y, grid_x = np.indices(mask.shape)
+    if len(ys) == 0:
+        return np.full(mask.shape, np.inf)
+    return np.sqrt((grid_y[..., np.newaxis] - ys)**2 + (grid_x[..., np.newaxis] - xs)**2).min(axis=-1)
+
+
+def test_distance_transform_is_exact():
+    rng = np.random.default_rng(0)
+    masks = rng.random((6, 13, 17)) < np.array([0.02, 0.05, 0.1, 0.3, 0.9, 0.])[:, np.newaxis, np.newaxis]
+    distances = evaluation.distance_transform(masks)
+    for mask, distance in zip(masks, distances):
+        np.testing.assert_allclose(distance, _brute_force_distances(mask))
+
+
+def test_iou():
+    targets = np.ones((1, 4, 4, 3))
+    predictions = np.ones((1, 4, 4, 3))
+    targets[0, :2, :, 0] = 0         # 8 ink pixels
+    predictions[0, 1:3, :, 0] = 0    # 8 ink pixels, 4 shared
+    predictions[0, 0, 0, 1] = 0      # ink only in the prediction
+    np.testing.assert_allclose(evaluation.iou(predictions, targets), [[4 / 12, 0., 1.]])
+
+
+def test_ssim():
+    rng = np.random.default_rng(1)
+    targets = rng.random((2, 16, 16, 2))
+    np.testing.assert_allclose(evaluation.ssim(targets, targets), 1.)
+    noisy = np.clip(targets + rng.normal(0, 0.2, targets.shape), 0, 1)
+    assert np.all(evaluation.ssim(noisy, targets) < 0.9)
+    assert np.all(evaluation.ssim(1 - targets, targets) < 0)
+
+
+def test_chamfer():
+    targets = np.ones((1, 12, 12, 4))
+    targets[0, 2:6, 2:6, :] = 0
+    predictions = targets.copy()
+    predictions[0, :, :, 1] = np.roll(targets[0, :, :, 1], 3, axis=1)  # shifted by 3 pixels
+    predictions[0, :, :, 2] = 1                                        # empty prediction
+    predictions[0, :, :, 3] = targets[0, :, :, 3] = 1                  # both empty
+    distances = evaluation.chamfer(predictions, targets)[0]
+    assert distances[0] == 0
+    # The edges of two 4x4 squares shifted by 3: the shared part has distance 0
+    assert 0 < distances[1] <= 3
+    assert np.isnan(distances[2])
+    assert distances[3] == 0
+
+
+def test_empty_test_set_raises():
+    empty = (np.zeros((0, 8, 8, 2), np.float32), np.zeros((0, 8, 8, 1), np.float32), [])
+    with pytest.raises(ValueError, match='test set is empty'):
+        evaluation.evaluate(None, test_set=empty, charset_in='Aa', charset_out='Ä')
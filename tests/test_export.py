@@ -0,0 +1,53 @@
+import json
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+from src.benchmark import synthetic_fonts
+from src.data import global_consts as g
+from src.model import export, train
+
+
+@pytest.fixture
+def autoencoder_path(tmp_path):
+    model = train.AutoEncoder(8, 16, 2, 1)
+    path = str(tmp_path / 'ae.keras')
+    model.save(path)
+    return path
+
+
+@pytest.mark.parametrize('variant', export.VARIANTS)
+def test_convert_autoencoder(variant):
+    model = train.AutoEncoder(8, 16, 2, 1)
+    calibration = np.random.default_rng(0).random((4, 16, 16, 2), dtype=np.float32)
+    tflite_model = export.TFLiteModel(export.convert(model, variant, calibration))
+
+    # The model is converted with a batch of one, TFLiteModel resizes it
+    predictions = tflite_model.predict(calibration)
+    assert predictions.shape == (4, 16, 16, 1)
+    reference = np.asarray(model(calibration, training=False))
+    np.testing.assert_allclose(predictions, reference, atol=0.1 if variant == 'int8' else 1e-3)
+
+
+def test_export_model(autoencoder_path, tmp_path):
+    g.configure(PATH_TO_JSON_FONT_DB=str(tmp_path / '00dataset.json'))
+    try:
+        font_file_paths = synthetic_fonts.build_corpus(str(tmp_path / 'fonts'), num_fonts=4, num_glyphs=70)
+        report = export.export_model(autoencoder_path, str(tmp_path / 'export'), variants=('dynamic', 'int8'),
+                                     font_file_paths=font_file_paths, charset_in='Aa', charset_out='Ä',
+                                     size=16, num_calibration=2, num_evaluation=2)
+    finally:
+        g.reset()
+
+    for variant in ('dynamic', 'int8'):
+        assert report[variant]['mean_abs_error'] < 0.1
+        prediction = export.TFLiteModel(report[variant]['path']).predict(np.ones((3, 16, 16, 2)))
+        assert prediction.shape == (3, 16, 16, 1)
+    with open(tmp_path / 'export' / 'export_report.json', 'r', encoding='utf-8') as file:
+        assert set(json.load(file)) == {'original', 'dynamic', 'int8'}
+
+
+def test_export_needs_evaluation_fonts(autoencoder_path, tmp_path):
+    with pytest.raises(ValueError, match='evaluation'):
+        export.export_model(autoencoder_path, str(tmp_path / 'export'), font_file_paths=[],
+                            charset_in='Aa', charset_out='Ä', size=16)
@@ -0,0 +1,76 @@
+import threading
+import time
+import pytest
+from src.data.fontcache import LRUCache, instance_path, split_instance_path
+
+
+def test_factory_runs_outside_the_lock():
+    cache = LRUCache(4)
+    calls = []
+
+    def slow_factory(key):
+        def factory():
+            calls.append(key)
+            time.sleep(0.2)
+            return key
+        return factory
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=cache.get, args=(key, slow_factory(key))) for key in 'abaa']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Different keys are created in parallel, the same key only once
+    assert time.perf_counter() - start < 0.35
+    assert sorted(calls) == ['a', 'b']
+
+
+def test_errors_are_not_cached_and_eviction():
+    evicted = []
+    cache = LRUCache(2, on_evict=evicted.append)
+    with pytest.raises(ZeroDivisionError):
+        cache.get('x', lambda: 1 / 0)
+    assert cache.get('x', lambda: 'x') == 'x'
+    cache.get('y', lambda: 'y')
+    cache.get('z', lambda: 'z')
+    assert evicted == ['x']
+    assert len(cache) == 2
+
+
+@pytest.mark.parametrize('font_path, expected', [
+    ('../data/raw/gf/C#Sans/x.ttf', ('../data/raw/gf/C#Sans/x.ttf', None)),
+    ('fonts/x#1.ttf', ('fonts/x#1.ttf', None)),
+    ('fonts/x.ttf#wght=700,wdth=75.5', ('fonts/x.ttf', {'wght': 700., 'wdth': 75.5})),
+    ('C#Sans/x.ttf#wght=-1e+02', ('C#Sans/x.ttf', {'wght': -100.})),
+])
+def test_split_instance_path(font_path, expected):
+    assert split_instance_path(font_path) == expected
+
+
+def test_instance_path_round_trip():
+    path = instance_path('C#/x.ttf', {'wght': 350, 'opsz': 14.25})
+    assert split_instance_path(path) == ('C#/x.ttf', {'opsz': 14.25, 'wght': 350.})
+
+
+def test_ttfont_is_read_when_parsed(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    from src.benchmark import synthetic_fonts
+    from src.data import fontcache
+    path = synthetic_fonts.build_font(str(tmp_path / 'font.ttf'), num_glyphs=200)
+    font = fontcache.get_ttfont(path)
+    # No thread reads the shared file handle later
+    assert font.reader.file.closed
+    assert font.reader.tables.keys() <= font.tables.keys()
+    # Expanding a glyph on access isn't atomic, so the outlines are expanded up front
+    assert not any(hasattr(glyph, 'data') for glyph in font['glyf'].glyphs.values())
+
+    def coordinates(glyph_name):
+        return list(font['glyf'][glyph_name].getCoordinates(font['glyf'])[0])
+    glyph_names = font.getGlyphOrder()[1:]
+    with ThreadPoolExecutor(8) as executor:
+        parallel = list(executor.map(coordinates, glyph_names * 4))
+    fontcache.clear_cache()
+    font = fontcache.get_ttfont(path)
+    assert parallel == [coordinates(glyph_name) for glyph_name in glyph_names * 4]
@@ -0,0 +1,86 @@
+import json
+import pytest
+from src.data import fontdb_handler
+from src.data import global_consts as g
+
+
+@pytest.fixture
+def font_db(tmp_path):
+    g.configure(PATH_TO_JSON_FONT_DB=str(tmp_path / '00dataset.json'))
+    (tmp_path / '00dataset.json').write_text('{}')
+    yield tmp_path
+    g.reset()
+
+
+def _add_family(directory, family, num_styles):
+    directory.mkdir(parents=True)
+    (directory / 'METADATA.pb').write_text(f'name: "{family}"\n')
+    fonts = {}
+    for style in range(num_styles):
+        path = directory / f'{family}-{style}.ttf'
+        path.write_bytes(f'{family} {style}'.encode())
+        fonts[str(path)] = {}
+    fontdb_handler.add_fonts(fonts)
+
+
+def _splits():
+    return {path: entry['split'] for path, entry in fontdb_handler.load_font_db().items()}
+
+
+def test_split_for_key_is_deterministic_and_follows_the_fractions():
+    keys = [f'family:{idx}' for idx in range(20000)]
+    splits = [fontdb_handler.split_for_key(key) for key in keys]
+    assert splits == [fontdb_handler.split_for_key(key) for key in keys]
+    for split, fraction in fontdb_handler.SPLIT_FRACTIONS.items():
+        assert splits.count(split) / len(keys) == pytest.approx(fraction, abs=0.01)
+    assert {fontdb_handler.split_for_key(key, {'train': 1, 'test': 0}) for key in keys[:100]} == {'train'}
+
+
+def test_families_share_a_split(font_db):
+    for idx in range(30):
+        _add_family(font_db / f'family{idx}', f'Family{idx}', 3)
+    counts = fontdb_handler.assign_splits(by='family')
+    assert sum(counts.values()) == 90
+    families = {}
+    for path, split in _splits().items():
+        families.setdefault(path.rsplit('-', 1)[0], set()).add(split)
+    assert all(len(splits) == 1 for splits in families.values())
+
+
+def test_splits_are_stable_when_fonts_are_added(font_db):
+    for idx in range(10):
+        _add_family(font_db / f'family{idx}', f'Family{idx}', 2)
+    fontdb_handler.assign_splits(by='family')
+    before = _splits()
+
+    for idx in range(10, 20):
+        _add_family(font_db / f'family{idx}', f'Family{idx}', 2)
+    fontdb_handler.assign_splits(by='family')
+    after = _splits()
+    assert {path: after[path] for path in before} == before
+
+    # Reassigning from scratch gives the same splits: they only depend on the key
+    fontdb_handler.assign_splits(by='family', overwrite=True)
+    assert _splits() == after
+
+
+def test_copies_share_the_content_split(font_db):
+    fonts = {}
+    for idx in range(20):
+        for copy in ('a', 'b'):
+            path = font_db / copy / f'font{idx}.ttf'
+            path.parent.mkdir(exist_ok=True)
+            path.write_bytes(b'font %d' % idx)
+            fonts[str(path)] = {}
+    fonts[str(font_db / 'missing.ttf')] = {}
+    fontdb_handler.add_fonts(fonts)
+
+    fontdb_handler.assign_splits(by='content')
+    font_db_entries = json.loads((font_db / '00dataset.json').read_text())
+    assert 'split' not in font_db_entries[str(font_db / 'missing.ttf')]
+    for idx in range(20):
+        entry_a = font_db_entries[str(font_db / 'a' / f'font{idx}.ttf')]
+        entry_b = font_db_entries[str(font_db / 'b' / f'font{idx}.ttf')]
+        assert entry_a['split'] == entry_b['split'] and entry_a['sha256'] == entry_b['sha256']
+    assert list(fontdb_handler.iter_split('train')) == [
+        path for path, entry in font_db_entries.items() if entry.get('split') == 'train']
@@ -0,0 +1,85 @@
+import asyncio
+import os
+import subprocess
+import pytest
+from src.data import gitfetch
+
+GIT_ENV = {'GIT_AUTHOR_NAME': 'test', 'GIT_AUTHOR_EMAIL': 'test@example.com',
+           'GIT_COMMITTER_NAME': 'test', 'GIT_COMMITTER_EMAIL': 'test@example.com'}
+
+
+def _git(*args, cwd):
+    subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True, env={**os.environ, **GIT_ENV})
+
+
+def _commit(work, files, message):
+    for name, content in files.items():
+        os.makedirs(os.path.dirname(os.path.join(work, name)), exist_ok=True)
+        with open(os.path.join(work, name), 'wb') as file:
+            file.write(content)
+    _git('add', '-A', cwd=work)
+    _git('commit', '-q', '-m', message, cwd=work)
+    _git('push', '-q', 'origin', 'main', cwd=work)
+
+
+@pytest.fixture
+def remote(tmp_path):
+    """ Bare repository with two commits and the working copy that pushes to it. """
+    bare, work = tmp_path / 'remote.git', tmp_path / 'work'
+    _git('init', '-q', '--bare', '-b', 'main', str(bare), cwd=tmp_path)
+    _git('config', 'uploadpack.allowFilter', 'true', cwd=bare)
+    _git('clone', '-q', str(bare), str(work), cwd=tmp_path)
+    _git('checkout', '-q', '-b', 'main', cwd=work)
+    _commit(work, {'ofl/a/A.ttf': b'a' * 1000, 'apache/b/B.ttf': b'b' * 1000}, 'first')
+    _commit(work, {'ofl/a/A2.ttf': b'c' * 1000}, 'second')
+    return bare, work
+
+
+def _repos(bare, **repo):
+    return [{'name': 'db', 'url': str(bare), 'directories': ['ofl/'], 'private': False, **repo}]
+
+
+def test_shallow_sparse_fetch(remote, tmp_path):
+    bare, _ = remote
+    target = tmp_path / 'raw'
+    report = gitfetch.fetch_repos(_repos(bare), str(target))['db']
+
+    assert report['status'] == 'ok'
+    assert report['bytes'] > 0
+    assert sorted(os.listdir(target / 'db' / 'ofl' / 'a')) == ['A.ttf', 'A2.ttf']
+    assert not (target / 'db' / 'apache').exists()
+    count = subprocess.check_output(['git', 'rev-list', '--count', 'HEAD'], cwd=target / 'db')
+    assert count.strip() == b'1'
+
+
+def test_refetch_updates_and_restores(remote, tmp_path):
+    bare, work = remote
+    target = tmp_path / 'raw'
+    gitfetch.fetch_repos(_repos(bare), str(target))
+    os.remove(target / 'db' / 'ofl' / 'a' / 'A.ttf')
+    _commit(work, {'ofl/a/A3.ttf': b'd' * 10}, 'third')
+
+    report = gitfetch.fetch_repos(_repos(bare), str(target))['db']
+    head = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=work).decode().strip()
+    assert report['commit'] == head
+    assert sorted(os.listdir(target / 'db' / 'ofl' / 'a')) == ['A.ttf', 'A2.ttf', 'A3.ttf']
+
+
+def test_failing_repo_does_not_stop_others(remote, tmp_path):
+    bare, _ = remote
+    repos = _repos(bare) + [{'name': 'missing', 'url': str(tmp_path / 'missing.git')}]
+    reports = gitfetch.fetch_repos(repos, str(tmp_path / 'raw'), max_concurrent=2)
+    assert reports['db']['status'] == 'ok'
+    assert reports['missing']['status'] == 'error'
+
+
+def test_fetch_inside_running_loop(remote, tmp_path):
+    # E.g. a Jupyter kernel, where asyncio.run raises
+    bare, _ = remote
+
+    async def notebook_cell():
+        return gitfetch.fetch_repos(_repos(bare), str(tmp_path / 'raw'))
+
+    assert asyncio.run(notebook_cell())['db']['status'] == 'ok'
+    awaited = asyncio.run(gitfetch.fetch_repos_async(_repos(bare), str(tmp_path / 'raw2')))
+    assert awaited['db']['status'] == 'ok'
@@ -0,0 +1,32 @@
+import os
+import pytest
+from src.data import global_consts as g
+from src.data import isolation, shards
+
+
+@pytest.fixture(autouse=True)
+def reset():
+    yield
+    g.reset()
+
+
+def test_configure_keeps_the_config_file(tmp_path):
+    config = tmp_path / 'fontgen.toml'
+    config.write_text('PATH_RAW = "/toml/raw/"\nPATH_PROCESSED = "/toml/processed/"\n')
+    g.configure(str(config))
+    g.configure(PATH_PROCESSED='/set/processed/')
+    assert g.PATH_RAW == '/toml/raw/'
+    assert g.PATH_TO_JSON_FONT_DB == os.path.join('/toml/raw/', g.JSON_FONT_DB)
+    assert g.PATH_SHARDS == os.path.join('/set/processed/', 'shards/')
+
+    g.reset()
+    assert g.current_config() == (None, {})
+    assert g.PATH_RAW != '/toml/raw/'
+
+
+def test_isolation_workers_get_the_overrides():
+    g.configure(PATH_PROCESSED='/set/processed/')
+    # The font path is used as the name of the output
+    results = isolation.run_isolated(shards.output_path, ['name'], args=((0, 1),), workers=1, progress=False)
+    assert results[0]['result'] == shards.output_path('name', (0, 1))
+    assert results[0]['result'].startswith('/set/processed/')
@@ -0,0 +1,27 @@
+import os
+import numpy as np
+from fontTools import ttLib
+from src.benchmark import synthetic_fonts
+from src.data import datarenderer
+from src.model import glyphwriter
+
+
+def test_batch_results_follow_the_input_order(tmp_path):
+    font_a = synthetic_fonts.build_font(str(tmp_path / 'a.ttf'), num_glyphs=20, chars="ABOo")
+    font_b = synthetic_fonts.build_font(str(tmp_path / 'b.ttf'), num_glyphs=20, chars="ABOo")
+    # Stand-ins for generated glyphs: rendered O and o as Ö and ö
+    glyphs = datarenderer.render_font(font_a, 32, "Oo", normalize=True, dtype=np.float32)
+    font_file_paths = [font_a, font_b, font_a]
+    results = glyphwriter.insert_glyphs_batch(font_file_paths, np.stack([glyphs] * 3), str(tmp_path / 'out'),
+                                              max_workers=2, chars="Öö")
+
+    assert len(results) == 3
+    assert len({result['output_path'] for result in results}) == 3
+    for font_file_path, result in zip(font_file_paths, results):
+        assert result['inserted'] == ['Ö', 'ö']
+        assert os.path.basename(result['output_path']).endswith(
+            os.path.splitext(os.path.basename(font_file_path))[0] + '_umlauts.ttf')
+        with ttLib.TTFont(result['output_path']) as font:
+            assert {ord('Ö'), ord('ö')} <= set(font.getBestCmap())
+    # Only the renamed fonts are left, no temporary files
+    assert len(os.listdir(tmp_path / 'out')) == 3
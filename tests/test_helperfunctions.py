@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+from src.model import helperfunctions as hf
+
+
+class _Identity:
+    def predict(self, inputs, verbose=0):
+        return inputs[0] if isinstance(inputs, tuple) else inputs
+
+
+def _grid_dataset(num_examples):
+    images = np.zeros((num_examples, 8, 8), np.float32)
+    one_hot = np.zeros((num_examples, 3), np.float32)
+    return tf.data.Dataset.from_tensor_slices(((images, one_hot), images)).batch(4)
+
+
+def _tensor_dataset(num_examples):
+    glyphs = np.zeros((num_examples, 8, 8, 2), np.float32)
+    return tf.data.Dataset.from_tensor_slices((glyphs, glyphs)).batch(4)
+
+
+@pytest.mark.parametrize('model_type, dataset', [("3dTensor-3dTensor", _tensor_dataset),
+                                                 ("2dGrid-OneHot-SingleGlyph", _grid_dataset)])
+def test_predict_examples(model_type, dataset):
+    inputs, targets, predictions = hf.predict_examples(_Identity(), dataset(8), num_examples=3,
+                                                       model_type=model_type)
+    assert len(targets) == len(predictions) == 3
+    with pytest.raises(ValueError, match='empty'):
+        hf.predict_examples(_Identity(), dataset(0), model_type=model_type)
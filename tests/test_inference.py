@@ -0,0 +1,83 @@
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+import numpy as np
+import pytest
+from src.benchmark import synthetic_fonts
+from src.model import inference
+
+
+class ConstantModel:
+    """ Predicts gray glyphs, in place of a trained model. """
+
+    def predict(self, inputs, verbose=0):
+        return np.full((len(inputs), 16, 16, len(inference.CHARSET_OUT)), 0.5, dtype=np.float32)
+
+
+@pytest.fixture
+def font_file_path(tmp_path):
+    # Umlauts can be composed from the base letters and the combining dieresis
+    return synthetic_fonts.build_font(str(tmp_path / 'font.ttf'), num_glyphs=20, chars="AaOoUu8Bj̈")
+
+
+def test_generate_composes_umlauts_without_keeping_files(font_file_path, tmp_path):
+    generator = inference.GlyphGenerator(ConstantModel(), size=16, composed_dir=str(tmp_path / 'composed'),
+                                         max_composed=1)
+    result = generator.generate(font_file_path)
+    assert result['composed'] == list("ÄäÖöÜü")
+    assert result['glyphs'].shape == (16, 16, 7)
+    # ß is generated, the composed umlauts are rendered
+    assert np.all(result['glyphs'][..., 6] == 0.5)
+    assert not np.all(result['glyphs'][..., 0] == 0.5)
+    assert os.listdir(tmp_path / 'composed') == []
+    assert generator.generate(font_file_path)['composed'] == result['composed']
+    assert generator._composed.stats()['hits'] == 1
+
+
+def test_compose_errors_are_reported(tmp_path):
+    broken = tmp_path / 'broken.ttf'
+    broken.write_bytes(b'no font')
+    generator = inference.GlyphGenerator(ConstantModel(), size=16, composed_dir=str(tmp_path / 'composed'))
+    result = generator.generate(str(broken))
+    assert 'Umlauts could not be composed' in result['analysis']
+    assert result['glyphs'] is None
+
+
+def test_store_upload_keeps_the_most_recent_uploads(tmp_path):
+    first = inference.store_upload(b'first', str(tmp_path), max_uploads=2)
+    second = inference.store_upload(b'second', str(tmp_path), max_uploads=2)
+    mtime_ns = os.stat(first).st_mtime_ns
+    os.utime(first, ns=(10**9, mtime_ns))
+    os.utime(second, ns=(2 * 10**9, os.stat(second).st_mtime_ns))
+    # Uploading the same content again marks it as used without changing the file
+    assert inference.store_upload(b'first', str(tmp_path), max_uploads=2) == first
+    assert os.stat(first).st_mtime_ns == mtime_ns
+    third = inference.store_upload(b'third', str(tmp_path), max_uploads=2)
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(path) for path in (first, third))
+
+
+class FailingGenerator:
+    charset_out = inference.CHARSET_OUT
+    stats = {}
+
+    def generate(self, font_file_path):
+        raise RuntimeError('model failed')
+
+
+@pytest.mark.parametrize('body, status, error', [(b'', 400, 'Content-Length'), (b'font', 500, 'model failed')])
+def test_post_errors_are_json(tmp_path, body, status, error):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), inference.make_handler(FailingGenerator(), str(tmp_path)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        request = urllib.request.Request(f"http://127.0.0.1:{server.server_address[1]}/generate", data=body)
+        with pytest.raises(urllib.error.HTTPError) as response:
+            urllib.request.urlopen(request, timeout=10)
+        assert response.value.code == status
+        assert error in json.loads(response.value.read())['error']
+    finally:
+        server.shutdown()
+        server.server_close()
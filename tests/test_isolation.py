@@ -0,0 +1,35 @@
+import os
+import time
+from src.data import isolation
+
+# The functions run in spawned workers, so they are builtins instead of test functions:
+# the "font path" is their argument.
+
+
+def test_results_and_errors():
+    results = isolation.run_isolated(int, ['1', 'x', '3'], workers=2, progress=False)
+    assert [result['status'] for result in results] == ['ok', 'error', 'ok']
+    assert [result['result'] for result in results] == [1, None, 3]
+    assert results[1]['error'].startswith('ValueError')
+
+
+def test_timeout_kills_and_replaces_the_worker():
+    start = time.perf_counter()
+    results = isolation.run_isolated(time.sleep, [30, 0, 0], timeout=1, workers=1, progress=False)
+    assert time.perf_counter() - start < 20
+    assert [result['status'] for result in results] == ['timeout', 'ok', 'ok']
+    assert isolation.verdict_entry(results[0]) == {'usable': False, 'filters': ['timeout'],
+                                                   'isolation_error': results[0]['error']}
+
+
+def test_memory_limit():
+    results = isolation.run_isolated(bytearray, [8 << 30, 1 << 20], memory_limit_mb=1024, workers=1,
+                                     progress=False)
+    assert [result['status'] for result in results] == ['memory_limit', 'ok']
+    assert len(results[1]['result']) == 1 << 20
+
+
+def test_crash_replaces_the_worker():
+    results = isolation.run_isolated(os._exit, [3, 4], workers=1, progress=False)
+    assert [result['status'] for result in results] == ['crashed', 'crashed']
+    assert [result['error'] for result in results] == ['Worker exited with code 3', 'Worker exited with code 4']
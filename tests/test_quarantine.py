@@ -0,0 +1,48 @@
+import multiprocessing
+import pytest
+from src.data import global_consts as g
+from src.data import quarantine
+
+
+@pytest.fixture
+def registry_dir(tmp_path):
+    g.configure(PATH_TO_JSON_FONT_DB=str(tmp_path / '00dataset.json'))
+    yield tmp_path
+    g.reset()
+
+
+def _record(index):
+    quarantine.record_failures({f'font{index}.ttf': 'error'}, quarantine.render_config(64))
+
+
+def test_corrupt_registry_is_treated_as_empty(registry_dir):
+    (registry_dir / '00failures.json').write_text('{"font.ttf": {"render:64"')
+    with pytest.warns(UserWarning):
+        assert quarantine.load_registry() == {}
+    with pytest.warns(UserWarning):
+        quarantine.record_failures({'font.ttf': 'error'}, 'parse')
+    assert list(quarantine.load_registry()) == ['font.ttf']
+
+
+def test_concurrent_writers_keep_all_failures(registry_dir):
+    # The child processes inherit the configured path
+    with multiprocessing.get_context('fork').Pool(4) as pool:
+        pool.map(_record, range(16))
+    assert len(quarantine.load_registry()) == 16
+
+
+def test_deferred_failures_are_merged(registry_dir):
+    deferred = str(registry_dir / 'failures.jsonl')
+    quarantine.defer_failures(deferred)
+    try:
+        _record(0)
+        _record(0)
+        _record(1)
+    finally:
+        quarantine.defer_failures(None)
+    assert quarantine.load_registry() == {}
+
+    assert quarantine.merge_deferred([deferred]) == 3
+    registry = quarantine.load_registry()
+    assert registry['font0.ttf']['render:64']['count'] == 2
+    assert registry['font1.ttf']['render:64']['count'] == 1
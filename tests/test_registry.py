@@ -0,0 +1,64 @@
+import pytest
+from src.model.registry import ExperimentRegistry, higher_is_better
+
+
+@pytest.fixture
+def registry(tmp_path):
+    registry = ExperimentRegistry(str(tmp_path / 'experiments.sqlite'))
+    yield registry
+    registry.close()
+
+
+class History:
+    def __init__(self, history):
+        self.history = history
+
+
+def test_best_and_diff_respect_the_direction_of_metrics(registry):
+    registry.log_run('a', {'batch_size': 32, 'seed': 1},
+                     {'val_loss': [0.5, 0.2, 0.3], 'examples_per_sec': [100., 300., 200.]})
+    registry.log_run('b', {'batch_size': 64, 'seed': 1},
+                     {'val_loss': [0.4, 0.25], 'examples_per_sec': [400., 350.]})
+
+    assert higher_is_better('examples_per_sec') and higher_is_better('val_accuracy')
+    assert not higher_is_better('val_loss')
+    assert registry.diff('a', 'b') == {'params': {'batch_size': (32, 64)},
+                                       'metrics': {'examples_per_sec': (300., 400.), 'val_loss': (0.2, 0.25)}}
+    assert [(run['name'], run['best'], run['best_epoch']) for run in registry.best('examples_per_sec')] == \
+        [('b', 400., 0), ('a', 300., 1)]
+    assert [run['name'] for run in registry.best('val_loss')] == ['a', 'b']
+
+
+def test_log_training_takes_the_training_seconds(registry):
+    training = {'batch_size': 32, 'training_seconds': 12.5, 'history': History({'loss': [0.3, 0.1]})}
+    registry.log_training(training, 'run', model_type='3dTensor-3dTensor')
+    run = registry.get('run')
+    assert run['seconds'] == 12.5
+    assert run['model_type'] == '3dTensor-3dTensor'
+    assert registry.metrics('run') == {'loss': [0.3, 0.1]}
+
+
+def test_import_logs(registry, tmp_path):
+    log_dir = tmp_path / 'logs'
+    log_dir.mkdir()
+    name = '20240102_030405_3dTensor-3dTensor_autoencoder_val_loss_0.2000_train_loss_0.1000'
+    (log_dir / f'{name}_summary.txt').write_text(
+        'Model: "auto_encoder"\n'
+        'Total params: 1,234\n'
+        '_____\n'
+        'latent_dim: 128\n'
+        'training_seconds: 12.5\n'
+        'training_loss: [0.3, 0.1]\n'
+        'validation_loss: [0.4, 0.2]\n', encoding='utf-8')
+    (log_dir / f'{name}_loss.png').write_bytes(b'')
+    (tmp_path / f'{name}_model.keras').write_bytes(b'')
+
+    assert registry.import_logs(str(log_dir)) == [name]
+    run = registry.get(name)
+    assert run['created'] == '2024-01-02T03:04:05'
+    assert run['model_type'] == '3dTensor-3dTensor'
+    assert run['seconds'] == 12.5
+    assert run['params'] == {'model_name': 'auto_encoder', 'total_params': 1234, 'latent_dim': 128,
+                             'training_seconds': 12.5}
+    assert set(run['artifacts']) == {'summary', 'loss', 'model'}
+    assert registry.metrics(name) == {'loss': [0.3, 0.1], 'val_loss': [0.4, 0.2]}
@@ -0,0 +1,42 @@
+import numpy as np
+from src.benchmark import synthetic_fonts
+from src.data import datarenderer
+from src.data.renderplan import RenderPlan
+
+REQUESTS = [("AaOoUu8Bj", dict(size=2, normalize=True)),
+            ("ß", dict(size=32)),
+            ("AaOoUu8BjÄäÖöÜüß", dict(size=32, dtype=np.uint8)),
+            ("ÄäB", dict(size=32, normalize=True, invert=True, dtype=np.float32)),
+            ("ab", dict(size=16, invert=True))]
+
+
+def _plan():
+    plan = RenderPlan()
+    for chars, kwargs in REQUESTS:
+        plan.add(chars, **kwargs)
+    return plan
+
+
+def test_passes_merge_the_chars_per_size():
+    assert _plan().passes() == ((2, "AaOoUu8Bj"), (32, "ßAaOoUu8BjÄäÖöÜü"), (16, "ab"))
+
+
+def test_fan_out_equals_render_font(tmp_path):
+    path = synthetic_fonts.build_font(str(tmp_path / 'font.ttf'), num_glyphs=30)
+    for glyphs, (chars, kwargs) in zip(_plan().render_font(path), REQUESTS):
+        expected = datarenderer.render_font(path, chars=chars, **kwargs)
+        assert glyphs.dtype == expected.dtype
+        np.testing.assert_array_equal(glyphs, expected)
+
+
+def test_render_equals_render_fonts(tmp_path):
+    font_file_paths = synthetic_fonts.build_corpus(str(tmp_path), num_fonts=3, num_glyphs=30)
+    font_file_paths.insert(1, str(tmp_path / 'missing.ttf'))
+    results, indices = _plan().render(font_file_paths, use_registry=False, compact=True)
+    assert indices.tolist() == [0, 2, 3]
+    for glyphs, (chars, kwargs) in zip(results, REQUESTS):
+        expected, expected_indices = datarenderer.render_fonts(font_file_paths, chars=chars, use_registry=False,
+                                                               compact=True, **kwargs)
+        assert expected_indices.tolist() == indices.tolist()
+        assert glyphs.dtype == expected.dtype
+        np.testing.assert_array_equal(glyphs, expected)
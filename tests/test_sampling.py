@@ -0,0 +1,47 @@
+import json
+import pytest
+from src.data import fontdb_handler
+from src.data import global_consts as g
+from src.data import sampling
+
+
+@pytest.fixture
+def font_db(tmp_path):
+    g.configure(PATH_TO_JSON_FONT_DB=str(tmp_path / '00dataset.json'))
+    fonts = {}
+    for idx in range(4):
+        path = tmp_path / 'urls' / f'font{idx}.ttf'
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(b'font %d' % (idx % 2))
+        fonts[str(path)] = {'split': 'train'}
+    fonts[str(tmp_path / 'family' / 'Sans.ttf')] = {'split': 'train', 'metadata': {'family': 'Sans'}}
+    (tmp_path / '00dataset.json').write_text(json.dumps(fonts))
+    yield tmp_path
+    g.reset()
+
+
+def test_content_keys_are_stored_in_the_db(font_db, monkeypatch):
+    index = sampling.SamplingIndex.from_font_db(split='train')
+    assert index.group_sizes('family')['Sans'] == 1
+    assert sorted(index.group_sizes('family').values()) == [1, 2, 2]
+    hashes = [entry.get('sha256') for entry in fontdb_handler.load_font_db().values()]
+    assert sum(sha256 is not None for sha256 in hashes) == 4
+
+    def fail(path):
+        raise AssertionError(f"{path} hashed again")
+    monkeypatch.setattr(fontdb_handler, 'file_sha256', fail)
+    assert sampling.SamplingIndex.from_font_db(split='train').group_sizes('family') == index.group_sizes('family')
+
+
+def test_select_and_epoch_size(font_db):
+    index = sampling.SamplingIndex.from_font_db(split='train')
+    selected = index.select([str(font_db / 'urls' / 'font0.ttf'), str(font_db / 'urls' / 'font1.ttf'),
+                             str(font_db / 'urls' / '.' / 'font2.ttf')])
+    assert len(selected) == 3
+    assert selected.epoch_size('weighted') == 3
+    # font0 and font2 have the same content
+    assert selected.epoch_size('stratified', per_group=1) == 2
+    assert set(selected.stratified_epoch(per_group=1)) <= set(selected.paths.tolist())
+    assert index.select([]).epoch_size('stratified') == 0
+    with pytest.raises(ValueError):
+        index.epoch_size('uniform')
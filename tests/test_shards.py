@@ -0,0 +1,84 @@
+import json
+import os
+import numpy as np
+import pytest
+from src.benchmark import synthetic_fonts
+from src.data import global_consts as g
+from src.data import datarenderer, quarantine, shards
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    overrides = {'PATH_RAW': str(tmp_path / 'raw') + os.sep, 'PATH_PROCESSED': str(tmp_path / 'processed') + os.sep}
+    os.makedirs(overrides['PATH_RAW'])
+    os.makedirs(overrides['PATH_PROCESSED'])
+    g.configure(**overrides)
+    yield tmp_path, [argument for name, value in overrides.items() for argument in ('--set', f'{name}={value}')]
+    g.reset()
+
+
+def _font_db(tmp_path, num_fonts):
+    font_file_paths = synthetic_fonts.build_corpus(str(tmp_path / 'fonts'), num_fonts=num_fonts, num_glyphs=70)
+    with open(g.PATH_TO_JSON_FONT_DB, 'w', encoding='utf-8') as file:
+        json.dump({path: {} for path in font_file_paths}, file)
+    return font_file_paths
+
+
+def _write_shard(name, shard, num_fonts):
+    glyphs = np.zeros((num_fonts, 4, 4, 2), dtype=np.uint8)
+    datarenderer.export_dataset([f'{name}{shard[0]}-{idx}.ttf' for idx in range(num_fonts)],
+                                shards.output_path(name, shard, extension=''), size=4, chars='Aa',
+                                glyphs=(glyphs, np.arange(num_fonts)))
+
+
+def _write_failure(stage, shard, font):
+    with open(shards.failures_path(stage, shard), 'a', encoding='utf-8') as file:
+        file.write(json.dumps({'font': font, 'config': quarantine.render_config(4), 'error': 'error'}) + '\n')
+
+
+def test_reduce_render_and_failures(data_dir):
+    os.makedirs(g.PATH_SHARDS)
+    _write_shard('glyphs', (0, 2), 2)
+    _write_shard('glyphs', (1, 2), 1)
+    _write_failure('render-export', (1, 2), 'bad.ttf')
+
+    output = os.path.join(g.PATH_PROCESSED, 'glyphs')
+    assert shards.reduce('render-export', 2, output=output) == 3
+    glyphs, info = datarenderer.load_dataset(output)
+    assert glyphs.shape == (3, 4, 4, 2)
+    assert info['font_file_paths'] == ['glyphs0-0.ttf', 'glyphs0-1.ttf', 'glyphs1-0.ttf']
+    assert quarantine.render_config(4) in quarantine.load_registry()[os.path.normpath('bad.ttf')]
+    assert os.listdir(g.PATH_SHARDS) == []
+
+
+def test_reduce_keeps_failures_if_a_shard_is_missing(data_dir):
+    os.makedirs(g.PATH_SHARDS)
+    _write_shard('glyphs', (0, 2), 1)
+    _write_failure('render-export', (0, 2), 'bad.ttf')
+
+    with pytest.raises(FileNotFoundError, match=r'\[1\]'):
+        shards.reduce('render-export', 2, output=os.path.join(g.PATH_PROCESSED, 'glyphs'))
+    # Nothing is merged or removed, the reduce can be retried
+    assert quarantine.load_registry() == {}
+    assert os.path.exists(shards.failures_path('render-export', (0, 2)))
+    assert os.path.exists(shards.output_path('glyphs', (0, 2)))
+
+
+def test_run_local_with_an_empty_shard(data_dir):
+    tmp_path, global_args = data_dir
+    font_file_paths = _font_db(tmp_path, 1)
+    stage_args = ['--format', 'bits', '--size', '16', '--chars', 'Aa', '--output', str(tmp_path / 'glyphs')]
+
+    exit_codes = shards.run_local('render-export', 2, stage_args, global_args)
+    assert exit_codes == {0: 0, 1: 0}
+    assert shards.reduce('render-export', 2, output=str(tmp_path / 'glyphs')) == 1
+    glyphs, info = datarenderer.load_dataset(str(tmp_path / 'glyphs'))
+    assert info['font_file_paths'] == [os.path.normpath(font_file_paths[0])]
+    assert glyphs.shape == (1, 16 * 16 * 2 // 8)
+
+
+def test_run_local_fails_if_a_shard_fails(data_dir):
+    # No font database
+    _, global_args = data_dir
+    with pytest.raises(RuntimeError, match='not reducing'):
+        shards.run_local('filter', 2, global_args=global_args)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from src.model import similarity
+
+
+def _recall(index, queries, k=10, **kwargs):
+    return np.mean([len({path for path, _ in index.search(query, k, **kwargs)} &
+                        {path for path, _ in index.search_exact(query, k)}) / k for query in queries])
+
+
+def _index(vectors):
+    return similarity.SimilarityIndex.build(vectors, {'font_file_paths': [f'font{idx}.ttf'
+                                                                          for idx in range(len(vectors))]})
+
+
+def test_recall_on_random_vectors():
+    rng = np.random.default_rng(0)
+    index = _index(similarity.normalize(rng.normal(size=(3000, 64))))
+    queries = similarity.normalize(rng.normal(size=(50, 64)))
+    assert _recall(index, queries) >= 0.65
+    # Searching all cells leaves only the PQ error, which the reranking removes
+    assert _recall(index, queries, num_probes=len(index.centroids), rerank=50) >= 0.95
+
+
+def test_recall_on_clustered_vectors():
+    rng = np.random.default_rng(1)
+    centers = rng.normal(size=(50, 64))
+    vectors = similarity.normalize(centers[rng.integers(0, 50, 3000)] + 0.5 * rng.normal(size=(3000, 64)))
+    index = _index(vectors)
+    assert _recall(index, vectors[:50] + 0.1 * rng.normal(size=(50, 64))) >= 0.95
+
+
+def test_save_and_load(tmp_path):
+    rng = np.random.default_rng(2)
+    index = _index(similarity.normalize(rng.normal(size=(500, 32))))
+    index.save(str(tmp_path))
+    loaded = similarity.SimilarityIndex.load(str(tmp_path))
+    query = rng.normal(size=32)
+    assert loaded.search(query) == index.search(query)
+    # The best result is the vector itself
+    assert index.search(index.vectors[7], k=1)[0] == ('font7.ttf', pytest.approx(1.))
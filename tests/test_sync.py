@@ -0,0 +1,45 @@
+import os
+from src.data import sync
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(content)
+
+
+def test_same_content_is_transferred_once_and_linked(tmp_path):
+    source, destination = tmp_path / 'source', tmp_path / 'destination'
+    blob = source / 'blobs' / 'ab' / 'cd' / 'abcd.ttf'
+    _write(blob, b'font' * 1000)
+    # Working tree files are hardlinks to the blob, as written by the blob store
+    os.makedirs(source / 'gf' / 'a')
+    os.link(blob, source / 'gf' / 'a' / 'A.ttf')
+    _write(source / 'other.ttf', b'other')
+
+    result = sync.sync_tree(str(source), str(destination))
+    assert sorted(result['copied']) == ['blobs/ab/cd/abcd.ttf', 'gf/a/A.ttf', 'other.ttf']
+    assert result['linked'] == ['gf/a/A.ttf']
+    assert result['bytes'] == 4000 + 5
+    assert os.path.samefile(destination / 'blobs' / 'ab' / 'cd' / 'abcd.ttf', destination / 'gf' / 'a' / 'A.ttf')
+
+    # A second sync has nothing to do, a new link to known content is not transferred
+    assert sync.sync_tree(str(source), str(destination))['copied'] == []
+    os.link(blob, source / 'gf' / 'a' / 'B.ttf')
+    result = sync.sync_tree(str(source), str(destination))
+    assert result['linked'] == ['gf/a/B.ttf'] and result['bytes'] == 0
+
+
+def test_prefixes_default_to_the_configured_raw_directory(tmp_path):
+    import json
+    from src.data import global_consts as g
+    source, destination = tmp_path / 'source', tmp_path / 'destination'
+    _write(source / 'raw' / g.JSON_FONT_DB, json.dumps({'/old/raw/gf/A.ttf': {}}).encode())
+    g.configure(PATH_RAW='/old/raw/')
+    try:
+        sync.sync_data(str(source), str(destination), destination_prefix='/new/raw/')
+    finally:
+        g.reset()
+
+    with open(destination / 'raw' / g.JSON_FONT_DB, 'r', encoding='utf-8') as file:
+        assert list(json.load(file)) == [os.path.normpath('/new/raw/gf/A.ttf')]
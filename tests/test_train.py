@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+from src.data import datarenderer
+
+tf = pytest.importorskip('tensorflow')
+from src.model import train
+
+CHARS = "AaOoUu8BjÄäÖöÜüßXYZ"
+
+
+def _export(tmp_path, glyph_format, num_fonts=5, size=16):
+    rng = np.random.default_rng(0)
+    glyphs = rng.integers(0, 256, (num_fonts, size, size, len(CHARS)), dtype=np.uint8)
+    glyphs = np.where(glyphs < 128, 0, 255).astype(np.uint8)
+    path = str(tmp_path / glyph_format)
+    datarenderer.export_dataset([f'font{idx}.ttf' for idx in range(num_fonts)], path, size=size, chars=CHARS,
+                                glyph_format=glyph_format, glyphs=(glyphs, np.arange(num_fonts)))
+    return path, glyphs
+
+
+@pytest.mark.parametrize('glyph_format', ['bits', 'uint8'])
+@pytest.mark.parametrize('shape', [(8, 8, 3), (5, 7, 3)])
+def test_decode_glyphs_matches_numpy(glyph_format, shape):
+    # (5, 7, 3) doesn't fill the last byte of the bits
+    rng = np.random.default_rng(1)
+    glyphs = rng.integers(0, 256, (4, *shape), dtype=np.uint8)
+    encoded = datarenderer.encode_glyphs(glyphs, glyph_format)
+    np.testing.assert_allclose(np.asarray(train.decode_glyphs(tf.constant(encoded), glyph_format, shape)),
+                               datarenderer.decode_glyphs(encoded, glyph_format, shape), atol=1e-6)
+
+
+@pytest.mark.parametrize('glyph_format', ['bits', 'uint8'])
+def test_exported_dataset_selects_chars(tmp_path, glyph_format):
+    path, glyphs = _export(tmp_path, glyph_format)
+    config = {**train.DEFAULT_CONFIG, 'box_size': 16, 'batch_size': 2,
+              'charset_in': 'Bj8', 'charset_out': 'ßÄ'}
+    batches = list(train.exported_dataset(path, config, training=False))
+
+    columns = [CHARS.index(char) for char in 'Bj8ßÄ']
+    expected = glyphs[..., columns] / 255.
+    inputs = np.concatenate([np.asarray(batch[0]) for batch in batches])
+    outputs = np.concatenate([np.asarray(batch[1]) for batch in batches])
+    np.testing.assert_array_equal(inputs, expected[..., :3])
+    np.testing.assert_array_equal(outputs, expected[..., 3:])
+
+
+def test_one_epoch_on_synthetic_fonts(tmp_path):
+    from src.benchmark import synthetic_fonts
+    from src.data import global_consts as g
+    g.configure(PATH_TO_JSON_FONT_DB=str(tmp_path / '00dataset.json'))
+    try:
+        font_file_paths = synthetic_fonts.build_corpus(str(tmp_path / 'fonts'), num_fonts=6, num_glyphs=70)
+        for split, paths in (('train', font_file_paths[:4]), ('val', font_file_paths[4:])):
+            datarenderer.export_dataset(paths, str(tmp_path / split), chars="AaOoUu8BjÄäÖöÜüß",
+                                        glyph_format='bits')
+    finally:
+        g.reset()
+
+    config = {'latent_dim': 8, 'batch_size': 2, 'epochs': 1, 'save_path_summary': None,
+              'train_data': str(tmp_path / 'train'), 'val_data': str(tmp_path / 'val')}
+    model, training = train.train(config)
+    history = training['history'].history
+    assert np.isfinite(history['loss'][0]) and np.isfinite(history['val_loss'][0])
+    assert history['examples_per_sec'][0] > 0
+
+
+@pytest.mark.parametrize('sampling', ['weighted', 'stratified'])
+def test_one_epoch_with_sampling(tmp_path, sampling):
+    from src.benchmark import synthetic_fonts
+    from src.data import fontdb_handler
+    from src.data import global_consts as g
+    g.configure(PATH_TO_JSON_FONT_DB=str(tmp_path / '00dataset.json'))
+    try:
+        font_file_paths = synthetic_fonts.build_corpus(str(tmp_path / 'fonts'), num_fonts=6, num_glyphs=70)
+        (tmp_path / '00dataset.json').write_text('{}')
+        fontdb_handler.add_fonts({path: {'split': 'train' if idx < 4 else 'val'}
+                                  for idx, path in enumerate(font_file_paths)})
+        config = {'latent_dim': 8, 'box_size': 16, 'batch_size': 2, 'epochs': 2, 'save_path_summary': None,
+                  'split_by': 'content', 'sampling': sampling, 'sampling_group_by': ['category', 'weight']}
+        model, training = train.train(config)
+    finally:
+        g.reset()
+    history = training['history'].history
+    assert len(history['loss']) == 2 and np.isfinite(history['loss'][-1])
+    assert training['num_train_fonts'] == 4
+
+
+def test_make_dataset_without_fonts_raises():
+    with pytest.raises(ValueError, match='No fonts for the val split'):
+        train.make_dataset([], train.DEFAULT_CONFIG, training=True, cache_name='val')